@@ -1,34 +1,75 @@
 """
 This module provides API routes for interacting with the broadcastr backend/database.
 """
+import time
+_import_start = time.perf_counter()
+
 from flask import Flask, jsonify, request
 from flask_cors import CORS
+from api_batch import batch_bp
+from api_genres import genres_bp
 from api_broadcast import broadcast_bp
 from api_direct_messages import direct_messages_bp
 from api_following import following_bp
+from api_leaderboard import leaderboard_bp
 from api_like import like_bp
+from api_similarity import similarity_bp
 from api_song_swap import song_swap_bp
 from api_user_profile import user_profile_bp
-import related_type_enum
+from query_log import query_log_bp
+from refresh_scheduler import refresh_scheduler_bp
+from response_cache import response_cache_bp
+import compression
+import constants
+import data_version
+import http_cache
+import instrumentation
+import leaderboard
+import replica
+import response_cache
+import scrobbles
 import sql_query
 import db_query
+import top_artist_index
+
+_setup_start = time.perf_counter()
+instrumentation.record_startup_phase("import", _setup_start - _import_start)
 
 app = Flask(__name__)
 
+app.register_blueprint(batch_bp, url_prefix='/')
+app.register_blueprint(genres_bp, url_prefix='/')
 app.register_blueprint(broadcast_bp, url_prefix='/')
 app.register_blueprint(direct_messages_bp, url_prefix='/')
 app.register_blueprint(following_bp, url_prefix='/')
+app.register_blueprint(leaderboard_bp, url_prefix='/')
 app.register_blueprint(like_bp, url_prefix='/')
+app.register_blueprint(similarity_bp, url_prefix='/')
 app.register_blueprint(song_swap_bp, url_prefix='/')
 app.register_blueprint(user_profile_bp, url_prefix='/')
+app.register_blueprint(query_log_bp, url_prefix='/')
+app.register_blueprint(refresh_scheduler_bp, url_prefix='/')
+app.register_blueprint(response_cache_bp, url_prefix='/')
 
 CORS(app)
+instrumentation.init_app(app)
+compression.init_app(app)
+replica.init_app(app)
+instrumentation.record_startup_phase("app_setup", time.perf_counter() - _setup_start)
 
 def query_listens_for_artist(username, artistname, periodname):
     """
     Return the number of scrobbles (playcount) for a single user+artist+period.
     Returns 0 if no record is found.
     """
+    user_id = sql_query.query_user_id(username)
+    artist_id = sql_query.query_artist_id(artistname)
+    if not user_id or not artist_id:
+        return 0
+    count = top_artist_index.playcount(user_id, artist_id, sql_query.query_period_id(periodname))
+    if count is not None:
+        return count
+
     sql = """
     SELECT TA.Playcount
       FROM TopArtist AS TA
@@ -55,6 +96,21 @@ def query_top_listeners_for_artist(artistname, periodname, limit: int = 10):
     Return a list of up to `limit` tuples (username, playcount),
     ordered by playcount DESC, for a given artist + period.
     """
+    artist_id = sql_query.query_artist_id(artistname)
+    if not artist_id:
+        return []
+    listeners = top_artist_index.top_listeners(artist_id, sql_query.query_period_id(periodname), limit)
+    if listeners is not None:
+        if not listeners:
+            return []
+        conn = sql_query.get_db_connection()
+        placeholders = ", ".join("?" for _ in listeners)
+        usernames = dict(conn.execute(
+            f"SELECT UserID, LastFmProfileName FROM User WHERE UserID IN ({placeholders})",
+            [user_id for user_id, _ in listeners]).fetchall())
+        conn.close()
+        return [(usernames[user_id], playcount) for user_id, playcount in listeners if user_id in usernames]
+
     sql = """
     SELECT U.LastFmProfileName AS username,
            TA.Playcount            AS playcount
@@ -88,13 +144,23 @@ def api_listens():
     # First try to get from TopArtist table
     count = query_listens_for_artist(user, artist, period)
     
-    # If not found in TopArtist table, query Last.fm API directly
+    # If not found in TopArtist table, count the user's stored scrobbles,
+    # or query Last.fm API directly if they do not cover the period
     if count == 0:
-        count = db_query.get_artist_playcount(user, artist, period)
+        count = scrobbles.playcount(user, period, artist)
+        if count is None:
+            count = db_query.get_artist_playcount(user, artist, period)
         
     return jsonify({ "user": user, "artist": artist, "period": period, "plays": count })
 
+def _top_listeners_scopes(args):
+    scopes = [data_version.SCOPE_TOP_ARTISTS]
+    if args.get("current_user", ""):
+        scopes.append(data_version.user_top_scope(args.get("current_user", "")))
+    return scopes
+
 @app.route("/api/artist/top-listeners")
+@http_cache.conditional(_top_listeners_scopes, cache_control=constants.CACHE_CONTROL_TOP_DATA)
 def api_top_listeners():
     artist = request.args.get("artist", "")
     period = request.args.get("period", "")
@@ -109,7 +175,9 @@ def api_top_listeners():
     if current_user:
         current_user_plays = db_listeners.get(current_user, 0)
         if current_user_plays == 0:
-            current_user_plays = db_query.get_artist_playcount(current_user, artist, period)
+            current_user_plays = scrobbles.playcount(current_user, period, artist)
+            if current_user_plays is None:
+                current_user_plays = db_query.get_artist_playcount(current_user, artist, period)
             if current_user_plays > 0:
                 db_listeners[current_user] = current_user_plays
     
@@ -127,12 +195,29 @@ def api_top_listeners():
         "topListeners": top_listeners
     })
 
+def _top_for_days(kind, user, limit, days):
+    """
+    Computes a user's top artists or tracks over the last number of days from
+    their scrobbles (see scrobbles.top).
+    """
+    user_id = sql_query.query_user_id(user)
+    if not user_id:
+        return None
+    return scrobbles.top(user_id, kind, limit, days=max(1, days))
+
 @app.route("/api/user/top-artists")
+@http_cache.conditional(lambda args: [data_version.user_top_scope(args.get("user", ""))],
+                        cache_control=constants.CACHE_CONTROL_TOP_DATA)
+@response_cache.cached(lambda args: [data_version.user_top_scope(args.get("user", ""))])
 def api_user_top_artists():
     """
     Gets top artists and number of scrobbles (listens) for a user.
     Example:
         GET /api/user/top-artists?user=LastFmProfileName&period=PeriodName&limit=n
+        GET /api/user/top-artists?user=LastFmProfileName&days=n&limit=n
+    With days, the top artists of the last n days are computed from the user's
+    scrobbles (400 if days is not a number, 404 if their stored history does
+    not reach back that far).
     Returns JSON:
       {
         "topArtists": [
@@ -159,9 +244,17 @@ def api_user_top_artists():
      LIMIT ?
     """
 
-    conn = sql_query.get_db_connection()
-    rows = conn.execute(sql, (user, period, limit)).fetchall()
-    conn.close()
+    days = request.args.get("days", "")
+    if days:
+        if not days.isdecimal():
+            return jsonify({"error": "Invalid days"}), 400
+        rows = _top_for_days("artist", user, limit, int(days))
+        if rows is None:
+            return jsonify({"error": "Listening history for these days is not available"}), 404
+    else:
+        conn = sql_query.get_db_connection()
+        rows = conn.execute(sql, (user, period, limit)).fetchall()
+        conn.close()
 
     top_artists = [
         {
@@ -177,11 +270,18 @@ def api_user_top_artists():
     return jsonify({ "topArtists": top_artists })
 
 @app.route("/api/user/top-tracks")
+@http_cache.conditional(lambda args: [data_version.user_top_scope(args.get("user", ""))],
+                        cache_control=constants.CACHE_CONTROL_TOP_DATA)
+@response_cache.cached(lambda args: [data_version.user_top_scope(args.get("user", ""))])
 def api_user_top_tracks():
     """
     Gets top tracks and number of scrobbles (listens) for a user.
     Example:
         GET /api/user/top-tracks?user=LastFmProfileName&period=PeriodName&limit=n
+        GET /api/user/top-tracks?user=LastFmProfileName&days=n&limit=n
+    With days, the top tracks of the last n days are computed from the user's
+    scrobbles (400 if days is not a number, 404 if their stored history does
+    not reach back that far).
     Returns JSON:
       {
         "topTracks": [
@@ -215,9 +315,17 @@ def api_user_top_tracks():
         LIMIT ?
     """
 
-    conn = sql_query.get_db_connection()
-    rows = conn.execute(sql, (user, period, limit)).fetchall()
-    conn.close()
+    days = request.args.get("days", "")
+    if days:
+        if not days.isdecimal():
+            return jsonify({"error": "Invalid days"}), 400
+        rows = _top_for_days("track", user, limit, int(days))
+        if rows is None:
+            return jsonify({"error": "Listening history for these days is not available"}), 404
+    else:
+        conn = sql_query.get_db_connection()
+        rows = conn.execute(sql, (user, period, limit)).fetchall()
+        conn.close()
 
     top_tracks = [
         {
@@ -233,6 +341,7 @@ def api_user_top_tracks():
     return jsonify({ "topTracks": top_tracks })
 
 @app.route("/api/user/top-broadcasted-tracks")
+@http_cache.conditional(lambda args: [data_version.SCOPE_LEADERBOARD])
 def api_user_top_broadcasted_tracks():
     """
     Gets top broadcasted tracks for a user and the number of likes.
@@ -258,41 +367,40 @@ def api_user_top_broadcasted_tracks():
 
     user_id = sql_query.query_user_id(user)
 
-    sql = """
+    # Ranking comes from the precomputed leaderboard, so only the track
+    # details of the top broadcasts need to be looked up.
+    ranked_broadcasts = leaderboard.top_user_broadcasts(user_id, limit)
+    if not ranked_broadcasts:
+        return jsonify({ "topTracks": [] })
+
+    placeholders = ", ".join("?" for _ in ranked_broadcasts)
+    sql = f"""
         SELECT Broadcast.BroadcastID AS broadcastid, Track.TrackID AS trackid,
                Track.TrackName AS track, Artist.ArtistName AS artist,
-               Track.LastFmTrackUrl AS lastfmtrackurl,
-               COUNT(Like.LikeID) AS likes
-        FROM Broadcast 
+               Track.LastFmTrackUrl AS lastfmtrackurl
+        FROM Broadcast
         INNER JOIN Track ON Broadcast.RelatedID = Track.TrackID
         INNER JOIN Artist ON Track.ArtistID = Artist.ArtistID
-        LEFT JOIN Like ON Broadcast.BroadcastID = Like.RelatedID
-          AND Like.RelatedTypeID = ?
-        WHERE Broadcast.RelatedTypeID = ?
-          AND Broadcast.UserID = ?
-          AND Broadcast.Deleted = 0
-        GROUP BY Broadcast.BroadcastID, Track.TrackID, Track.TrackName,
-            Artist.ArtistName, Track.LastFmTrackUrl
-        ORDER BY COUNT(Like.LikeID) DESC, Broadcast.Timestamp DESC
-        LIMIT ?
+        WHERE Broadcast.BroadcastID IN ({placeholders})
     """
 
     conn = sql_query.get_db_connection()
-    rows = conn.execute(sql, (related_type_enum.RelatedType.BROADCAST.value,
-                              related_type_enum.RelatedType.TRACK.value,
-                              user_id, limit)).fetchall()
+    rows = conn.execute(sql, [broadcast_id for broadcast_id, _ in ranked_broadcasts]).fetchall()
     conn.close()
 
+    rows_by_id = {row["broadcastid"]: row for row in rows}
+
     top_broadcasted_tracks = [
         {
-          "broadcastid":    row["broadcastid"],
-          "trackid":        row["trackid"],
-          "track":          row["track"],
-          "artist":         row["artist"],
-          "lastfmtrackurl": row["lastfmtrackurl"],
-          "likes":          row["likes"]
+          "broadcastid":    broadcast_id,
+          "trackid":        rows_by_id[broadcast_id]["trackid"],
+          "track":          rows_by_id[broadcast_id]["track"],
+          "artist":         rows_by_id[broadcast_id]["artist"],
+          "lastfmtrackurl": rows_by_id[broadcast_id]["lastfmtrackurl"],
+          "likes":          likes
         }
-        for row in rows
+        for broadcast_id, likes in ranked_broadcasts
+        if broadcast_id in rows_by_id
     ]
 
     return jsonify({ "topTracks": top_broadcasted_tracks })
@@ -0,0 +1,93 @@
+"""
+This module provides the batch API route, which runs several read-only API
+queries in one request.
+
+Sub-queries are dispatched to the existing GET routes inside one
+sql_query.connection_scope(), so they share a single database connection and
+each user/artist/period id is resolved only once for the whole batch.  The
+sub-responses are combined without being decoded and re-encoded.
+"""
+from flask import Blueprint, current_app, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+import constants
+import json_response
+import sql_query
+
+batch_bp = Blueprint('batch', __name__)
+
+BATCH_PATH = "/api/batch"
+
+
+def _run_query(path, args):
+    """
+    Dispatches one sub-query to its GET route.
+    Returns:
+        (status code, JSON encoded body)
+    """
+    if not path.startswith("/api/") or path == BATCH_PATH:
+        return 400, json_response.dumps({"error": f"Path cannot be batched: {path}"})
+
+    with current_app.test_request_context(path, method="GET", query_string=args):
+        try:
+            response = current_app.make_response(current_app.dispatch_request())
+        except HTTPException as error:
+            return error.code, json_response.dumps({"error": error.description})
+        body = response.get_data()
+
+    if response.mimetype != json_response.JSON_MIMETYPE:
+        body = json_response.dumps(body.decode("utf-8", "replace"))
+    return response.status_code, body
+
+
+@batch_bp.route(BATCH_PATH, methods=['POST'])
+def api_batch():
+    """
+    Runs several GET API queries in one request.
+    Example:
+        POST /api/batch
+        {
+          "defaults": { "user": "LastFmProfileName", "period": "overall" },
+          "queries": [
+            { "id": "artists", "path": "/api/user/top-artists", "args": { "limit": 5 } },
+            { "id": "tracks", "path": "/api/user/top-tracks", "args": { "limit": 5 } },
+            { "id": "followers", "path": "/api/user/followers" }
+          ]
+        }
+    Params:
+        defaults: optional args passed to every query (a query's own args take precedence)
+        queries: list of { "id": str, "path": str, "args": { str: value } };
+                 the id defaults to the query's position in the list
+    Raises:
+        400 Bad Request: If the body is not a JSON object with a list of queries.
+        400 Bad Request: If more than constants.BATCH_MAX_QUERIES queries are given.
+    Returns JSON:
+      {
+        "results": {
+          "artists": { "status": int, "body": { …the route's JSON response… } },
+          …
+        }
+      }
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("queries"), list):
+        return jsonify({"error": "Missing or invalid queries"}), 400
+
+    queries = payload["queries"]
+    defaults = payload.get("defaults") or {}
+    if len(queries) > constants.BATCH_MAX_QUERIES:
+        return jsonify({"error": f"At most {constants.BATCH_MAX_QUERIES} queries may be batched"}), 400
+    if not isinstance(defaults, dict) or not all(isinstance(query, dict) for query in queries):
+        return jsonify({"error": "Missing or invalid queries"}), 400
+
+    results = []
+    with sql_query.connection_scope():
+        for position, query in enumerate(queries):
+            args = {key: str(value) for key, value in {**defaults, **(query.get("args") or {})}.items()}
+            status, body = _run_query(str(query.get("path", "")), args)
+            results.append((str(query.get("id", position)), status, body))
+
+    document = b",".join(
+        json_response.dumps(query_id) + b':{"status":' + str(status).encode() + b',"body":' + body + b"}"
+        for query_id, status, body in results)
+    return current_app.response_class(b'{"results":{' + document + b"}}", mimetype=json_response.JSON_MIMETYPE)
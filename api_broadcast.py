@@ -2,12 +2,23 @@
 This module provides supporting functions for API routes pertaining to broadcasts.
 """
 from flask import Blueprint, jsonify, request
+import data_version
+import http_cache
+import json_response
+import leaderboard
+import response_cache
 import related_type_enum
 import sql_query
 import validation
 
 broadcast_bp = Blueprint('broadcast', __name__)
 
+# shape=normalized moves each broadcastr's profile pictures into a "users" side table
+BROADCAST_USER_PICTURES = ("users", {
+    "user": {"user_pfp_sm": "pfp_sm", "user_pfp_med": "pfp_med",
+             "user_pfp_lg": "pfp_lg", "user_pfp_xl": "pfp_xl"},
+})
+
 @broadcast_bp.route("/api/create-broadcast", methods=['POST'])
 def api_create_broadcast():
     """
@@ -66,14 +77,25 @@ def api_delete_broadcast():
     cursor.close()
     connection.close()
 
+    leaderboard.record_broadcast_deleted(broadcast_id)
+    data_version.bump(data_version.SCOPE_BROADCASTS, data_version.SCOPE_LEADERBOARD)
+
     return jsonify({"success": True}), 200
 
 @broadcast_bp.route("/api/get-broadcasts")
+@http_cache.conditional(lambda args: [data_version.SCOPE_BROADCASTS])
+@response_cache.cached(lambda args: [data_version.SCOPE_BROADCASTS])
 def api_get_broadcasts():
     """
     Retrieves broadcasts.  User and Type are optional.
     Example:
         GET /api/get-broadcasts?user=LastFmProfileName&type=type&limit=n
+                               &fields=id,user,title&shape=normalized
+    Params:
+        fields: optional comma separated list of the keys to return for each broadcast
+        shape: "normalized" to return each user's profile pictures once, in
+               "users": { LastFmProfileName: { "pfp_sm": str, "pfp_med": str,
+               "pfp_lg": str, "pfp_xl": str } }, instead of on every broadcast
     Returns JSON:
       {
         "broadcasts": [
@@ -173,32 +195,8 @@ def api_get_broadcasts():
     # print(f"Broadcasts query: {sql}")
 
     connection = sql_query.get_db_connection()
-    cursor = connection.cursor()
-
-    cursor.execute(sql, (limit,))
-    rows = cursor.fetchall()
-
-    cursor.close()
-    connection.close()
+    cursor = connection.execute(sql, (limit,))
 
-    broadcasts = [
-        {
-          "id":             row["id"],
-          "user":           row["user"],
-          "user_pfp_sm":    row["user_pfp_sm"],
-          "user_pfp_med":   row["user_pfp_med"],
-          "user_pfp_lg":    row["user_pfp_lg"],
-          "user_pfp_xl":    row["user_pfp_xl"],
-          "title":          row["title"],
-          "body":           row["body"],
-          "timestamp":      row["timestamp"],
-          "type":           row["type"],
-          "relatedid":      row["relatedid"],
-          "relatedto":      row["relatedto"],
-          "track_url":      row["track_url"],
-          "likes":          row["likes"]
-        }
-        for row in rows
-    ]
-
-    return jsonify({ "broadcasts": broadcasts })
+    return json_response.rows_response(
+        "broadcasts", cursor, connection, fields=json_response.requested_fields(request.args),
+        side_table=BROADCAST_USER_PICTURES if json_response.normalized_requested(request.args) else None)
@@ -5,6 +5,8 @@ from flask import Blueprint, jsonify, request
 import related_type_enum
 
 import constants
+import data_version
+import response_cache
 import sql_query
 
 following_bp = Blueprint('following', __name__)
@@ -49,6 +51,8 @@ def api_user_follow():
     cursor.close()
     connection.close()
 
+    data_version.bump(data_version.SCOPE_FOLLOWING)
+
     sql_query.store_broadcast(0,
                               constants.SYSTEM_ACCOUNT_ID,
                               "New Following",
@@ -98,9 +102,12 @@ def api_user_unfollow():
     cursor.close()
     connection.close()
 
+    data_version.bump(data_version.SCOPE_FOLLOWING)
+
     return jsonify({"success": f"Following {following_id} successfully removed."}), 200
 
 @following_bp.route("/api/user/followers")
+@response_cache.cached(lambda args: [data_version.SCOPE_FOLLOWING])
 def api_user_followers():
     """
     Retrieves records for who is following a user.
@@ -144,6 +151,7 @@ def api_user_followers():
     return jsonify({ "followers": followers })
 
 @following_bp.route("/api/user/following")
+@response_cache.cached(lambda args: [data_version.SCOPE_FOLLOWING])
 def api_user_following():
     """
     Retrieves records for who a user is following.
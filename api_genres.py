@@ -0,0 +1,79 @@
+"""
+This module provides supporting functions for API routes pertaining to artist
+tags and users' genre profiles (see artist_tags.py).
+"""
+from flask import Blueprint, jsonify, request
+import artist_tags
+import constants
+import data_version
+import http_cache
+import sql_query
+
+genres_bp = Blueprint('genres', __name__)
+
+@genres_bp.route("/api/artist/tags")
+@http_cache.conditional(lambda args: [data_version.SCOPE_ARTIST_TAGS])
+def api_artist_tags():
+    """
+    Retrieves an artist's top tags (fetched from Last.fm once, then stored).
+    Example:
+        GET /api/artist/tags?artist=ArtistName
+    Raises:
+        400 Bad Request: If the artist is not provided.
+    Returns JSON:
+      {
+        "artist": str,
+        "tags": [
+          { "tag": str, "count": int },
+          …
+        ]
+      }
+    """
+    artist = request.args.get("artist", "")
+
+    if not artist:
+        return jsonify({"error": "Missing or invalid artist"}), 400
+
+    tags = [{ "tag": tag, "count": count } for tag, count in artist_tags.tags(artist)]
+
+    return jsonify({ "artist": artist, "tags": tags })
+
+@genres_bp.route("/api/user/genres")
+@http_cache.conditional(lambda args: [data_version.user_top_scope(args.get("user", "")),
+                                      data_version.SCOPE_ARTIST_TAGS],
+                        cache_control=constants.CACHE_CONTROL_TOP_DATA)
+def api_user_genres():
+    """
+    Retrieves a user's genre breakdown: their top artists' playcounts in a
+    period spread over the artists' stored tags.  Never calls Last.fm; tags
+    not stored yet are fetched in the background.
+    Example:
+        GET /api/user/genres?user=LastFmProfileName&period=PeriodName&limit=n
+    Raises:
+        400 Bad Request: If the user is not provided or invalid.
+    Returns JSON:
+      {
+        "user": str,
+        "period": str,
+        "coverage": float,
+        "genres": [
+          { "genre": str, "plays": int, "share": float },
+          …
+        ]
+      }
+      (coverage is the share of the user's top artist plays whose artists'
+      tags are stored; share is each genre's share of the tagged plays)
+    """
+    user = request.args.get("user", "")
+    period = request.args.get("period", "overall")
+    limit = request.args.get("limit", "")
+    limit = 10 if not limit.isnumeric() else int(limit)
+
+    user_id = sql_query.query_user_id(user)
+
+    if user_id == 0:
+        return jsonify({"error": "Missing or invalid user"}), 400
+
+    genres, coverage = artist_tags.genre_profile(user_id, period, limit)
+
+    return jsonify({ "user": user, "period": period, "coverage": coverage, "genres": genres })
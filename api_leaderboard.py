@@ -0,0 +1,96 @@
+"""
+This module provides supporting functions for API routes pertaining to leaderboards.
+"""
+from flask import Blueprint, jsonify, request
+import data_version
+import http_cache
+import leaderboard
+import sql_query
+
+leaderboard_bp = Blueprint('leaderboard', __name__)
+
+@leaderboard_bp.route("/api/leaderboard")
+@http_cache.conditional(lambda args: [data_version.SCOPE_LEADERBOARD])
+def api_leaderboard():
+    """
+    Retrieves the top users on a leaderboard.
+    Example:
+        GET /api/leaderboard?board=swag&limit=n
+    Params:
+        board: swag, likes (likes received on broadcasts), or broadcasts
+        limit: numeric value indicating the number of records to return
+    Raises:
+        400 Bad Request: If the board is not provided or invalid.
+    Returns JSON:
+      {
+        "leaderboard": [
+          { "rank": int, "user": str, "score": int },
+          …
+        ]
+      }
+    """
+    board = request.args.get("board", "")
+    limit = request.args.get("limit", "")
+    limit = 10 if not limit.isnumeric() else int(limit)
+
+    if board not in leaderboard.BOARDS:
+        return jsonify({"error": "Missing or invalid board"}), 400
+
+    top = leaderboard.top(board, limit)
+    names = sql_query.query_user_names([user_id for user_id, _ in top])
+    entries = []
+    rank = 0
+    previous_score = None
+    for position, (user_id, score) in enumerate(top, 1):
+        # Users with equal scores share a rank
+        if score != previous_score:
+            rank = position
+            previous_score = score
+        entries.append({
+            "rank":     rank,
+            "user":     names.get(user_id, 0),
+            "score":    score
+        })
+
+    return jsonify({ "leaderboard": entries })
+
+@leaderboard_bp.route("/api/leaderboard/rank")
+@http_cache.conditional(lambda args: [data_version.SCOPE_LEADERBOARD])
+def api_leaderboard_rank():
+    """
+    Retrieves a user's rank on a leaderboard.
+    Example:
+        GET /api/leaderboard/rank?board=swag&user=LastFmProfileName
+    Raises:
+        400 Bad Request: If the board is not provided or invalid.
+        400 Bad Request: If the user is not provided or invalid.
+    Returns JSON:
+      { "user": str, "rank": int, "score": int, "total": int }
+      (rank is 0 if the user is not on the leaderboard)
+    """
+    board = request.args.get("board", "")
+    user = request.args.get("user", "")
+
+    if board not in leaderboard.BOARDS:
+        return jsonify({"error": "Missing or invalid board"}), 400
+
+    user_id = sql_query.query_user_id(user)
+
+    if user_id == 0:
+        return jsonify({"error": "Missing or invalid user"}), 400
+
+    rank, score, total = leaderboard.rank(board, user_id)
+
+    return jsonify({ "user": user, "rank": rank, "score": score, "total": total })
+
+@leaderboard_bp.route("/api/leaderboard/rebuild", methods=['POST'])
+def api_leaderboard_rebuild():
+    """
+    Rebuilds all leaderboards from the database.  Used for recovery if the
+    precomputed leaderboards are suspected to have drifted.
+    Example:
+        POST /api/leaderboard/rebuild
+    Returns:
+        200 Success: The number of members on each rebuilt leaderboard.
+    """
+    return jsonify({"success": leaderboard.rebuild()}), 200
@@ -0,0 +1,105 @@
+"""
+This module provides supporting functions for API routes pertaining to related
+artists and similar users (precomputed offline, see similarity.py).
+"""
+from flask import Blueprint, jsonify, request
+import constants
+import http_cache
+import similarity
+import sql_query
+
+similarity_bp = Blueprint('similarity', __name__)
+
+def _limit():
+    limit = request.args.get("limit", "")
+    limit = 10 if not limit.isnumeric() else int(limit)
+    return min(limit, constants.SIMILARITY_TOP_K)
+
+@similarity_bp.route("/api/artist/related")
+@http_cache.conditional(version=lambda args: (similarity.version(), None))
+def api_related_artists():
+    """
+    Retrieves the artists whose listeners most overlap an artist's ("fans of X
+    also listen to").
+    Example:
+        GET /api/artist/related?artist=ArtistName&limit=n
+    Params:
+        artist: the artist's name
+        limit: numeric value indicating the number of records to return (at most 50)
+    Raises:
+        400 Bad Request: If the artist is not provided or invalid.
+        503 Service Unavailable: If related artists have not been built.
+    Returns JSON:
+      {
+        "artist": str,
+        "relatedArtists": [
+          { "artist": str, "score": float, "sharedListeners": int },
+          …
+        ]
+      }
+    """
+    artist = request.args.get("artist", "")
+    artist_id = sql_query.query_artist_id(artist)
+
+    if artist_id == 0:
+        return jsonify({"error": "Missing or invalid artist"}), 400
+
+    related = similarity.related_artists(artist_id, _limit())
+
+    if related is None:
+        return jsonify({"error": "Related artists are not available yet"}), 503
+
+    return jsonify({
+        "artist": artist,
+        "relatedArtists": [
+            {
+                "artist":           sql_query.query_artist_name(related_id),
+                "score":            round(score, 4),
+                "sharedListeners":  shared
+            }
+            for related_id, score, shared in related
+        ]
+    })
+
+@similarity_bp.route("/api/user/similar-users")
+@http_cache.conditional(version=lambda args: (similarity.version(), None))
+def api_similar_users():
+    """
+    Retrieves the users whose top artists and tracks are most like a user's.
+    Example:
+        GET /api/user/similar-users?user=LastFmProfileName&limit=n
+    Params:
+        user: the user's last.fm profile name
+        limit: numeric value indicating the number of records to return (at most 50)
+    Raises:
+        400 Bad Request: If the user is not provided or invalid.
+        503 Service Unavailable: If similar users have not been built.
+    Returns JSON:
+      {
+        "user": str,
+        "similarUsers": [
+          { "user": str, "score": float, "shared": int },
+          …
+        ]
+      }
+      (shared is the number of top artists and tracks the users have in common)
+    """
+    user = request.args.get("user", "")
+    user_id = sql_query.query_user_id(user)
+
+    if user_id == 0:
+        return jsonify({"error": "Missing or invalid user"}), 400
+
+    similar = similarity.similar_users(user_id, _limit())
+
+    if similar is None:
+        return jsonify({"error": "Similar users are not available yet"}), 503
+
+    entries = []
+    for similar_id, score, shared in similar:
+        # Skip users deleted since the last build
+        name = sql_query.query_user_name(similar_id)
+        if name:
+            entries.append({ "user": name, "score": round(score, 4), "shared": shared })
+
+    return jsonify({ "user": user, "similarUsers": entries })
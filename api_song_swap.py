@@ -4,12 +4,21 @@ This module provides supporting functions for API routes pertaining to song swap
 from flask import Blueprint, jsonify, request
 
 import constants
+import json_response
 import related_type_enum
 import sql_query
 import validation
 
 song_swap_bp = Blueprint('song-swap', __name__)
 
+# shape=normalized moves both swap participants' profile pictures into a "users" side table
+SONG_SWAP_USER_PICTURES = ("users", {
+    "initiated_user": {"initiated_user_pfp_sm": "pfp_sm", "initiated_user_pfp_med": "pfp_med",
+                       "initiated_user_pfp_lg": "pfp_lg", "initiated_user_pfp_xl": "pfp_xl"},
+    "matched_user": {"matched_user_pfp_sm": "pfp_sm", "matched_user_pfp_med": "pfp_med",
+                     "matched_user_pfp_lg": "pfp_lg", "matched_user_pfp_xl": "pfp_xl"},
+})
+
 @song_swap_bp.route("/api/initiate-song-swap", methods=['POST'])
 def api_initiate_song_swap():
     """
@@ -239,6 +248,12 @@ def api_get_song_swaps():
         If neither is specified, all song swaps are returned (based on limit)
     Example:
         GET /api/get-song-swaps?user=LastFmProfileName&songswapid=n&limit=n
+                               &fields=id,initiated_user,matched_user&shape=normalized
+    Params:
+        fields: optional comma separated list of the keys to return for each song swap
+        shape: "normalized" to return each user's profile pictures once, in
+               "users": { LastFmProfileName: { "pfp_sm": str, "pfp_med": str,
+               "pfp_lg": str, "pfp_xl": str } }, instead of on every song swap
     Returns JSON:
       {
         "songSwaps": [
@@ -327,46 +342,11 @@ def api_get_song_swaps():
     # print(f"song swaps query: {sql}")
 
     conn = sql_query.get_db_connection()
-    rows = conn.execute(sql, (limit,)).fetchall()
-    conn.close()
-
-    song_swaps = [
-        {
-            "id":                           row["id"],
-            "initiated_user_id":            row["initiated_user_id"],
-            "initiated_user":               row["initiated_user"],
-            "initiated_user_pfp_sm":        row["initiated_user_pfp_sm"],
-            "initiated_user_pfp_med":       row["initiated_user_pfp_med"],
-            "initiated_user_pfp_lg":        row["initiated_user_pfp_lg"],
-            "initiated_user_pfp_xl":        row["initiated_user_pfp_xl"],
-            "matched_user_id":              row["matched_user_id"],
-            "matched_user":                 row["matched_user"],
-            "matched_user_pfp_sm":          row["matched_user_pfp_sm"],
-            "matched_user_pfp_med":         row["matched_user_pfp_med"],
-            "matched_user_pfp_lg":          row["matched_user_pfp_lg"],
-            "matched_user_pfp_xl":          row["matched_user_pfp_xl"],
-            "initiated_track_id":           row["initiated_track_id"],
-            "initiated_track_name":         row["initiated_track_name"],
-            "initiated_track_url":          row["initiated_track_url"],
-            "initiated_artist_id":          row["initiated_artist_id"],
-            "initiated_artist_name":        row["initiated_artist_name"],
-            "matched_track_id":             row["matched_track_id"],
-            "matched_track_name":           row["matched_track_name"],
-            "matched_track_url":            row["matched_track_url"],
-            "matched_artist_id":            row["matched_artist_id"],
-            "matched_artist_name":          row["matched_artist_name"],
-            "initiated_reaction":           row["initiated_reaction"],
-            "matched_reaction":             row["matched_reaction"],
-            "swap_initiated_timestamp":     row["swap_initiated_timestamp"],
-            "initiated_track_timestamp":    row["initiated_track_timestamp"],
-            "matched_track_timestamp":      row["matched_track_timestamp"],
-            "initiated_reaction_timestamp": row["initiated_reaction_timestamp"],
-            "matched_reaction_timestamp":   row["matched_reaction_timestamp"]
-        }
-        for row in rows
-    ]
-
-    return jsonify({ "songSwaps": song_swaps })
+    cursor = conn.execute(sql, (limit,))
+
+    return json_response.rows_response(
+        "songSwaps", cursor, conn, fields=json_response.requested_fields(request.args),
+        side_table=SONG_SWAP_USER_PICTURES if json_response.normalized_requested(request.args) else None)
 
 @song_swap_bp.route("/api/find-song-swap-match", methods=['GET'])
 def api_find_song_swap_match():
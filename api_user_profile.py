@@ -5,13 +5,23 @@ from flask import Blueprint, jsonify, request
 import bcrypt
 
 import constants
+import data_version
 import db_query
+import http_cache
+import json_response
+import refresh_scheduler
+import refresh_state
 import related_type_enum
 import sql_query
 
 user_profile_bp = Blueprint('user-profile', __name__)
 
+# Profiles include email addresses, so they are never kept in the response
+# cache; an exact lookup can be revalidated by the client with its ETag instead.
+# A partial search may match any user, so it is always served in full.
 @user_profile_bp.route("/api/user/profile")
+@http_cache.conditional(lambda args: None if args.get("partial", "false").lower() == "true"
+                        else [data_version.user_scope(args.get("user", ""))])
 def api_user_profile():
     """
     Retrieves a user's profile information.
@@ -41,7 +51,7 @@ def api_user_profile():
                User.Pfpsmall AS pfpsm, User.PfpMedium as pfpmed, User.PfpLarge AS pfplg,
                User.PfpExtraLarge AS pfpxl, User.Swag AS swag
         FROM User
-        WHERE LastFmProfileName LIKE ?
+        WHERE LastFmProfileName LIKE ? ESCAPE '\\'
         ORDER BY LastFmProfileName
         LIMIT 10
     """
@@ -50,7 +60,8 @@ def api_user_profile():
         separator = "%"
         search_term = separator + separator.join(user) + separator
     else:
-        search_term = user
+        # Only the one profile name (its ETag covers only that user)
+        search_term = user.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
     rows = conn.execute(sql, (search_term,)).fetchall()
     conn.close()
 
@@ -86,6 +97,7 @@ def api_user_get_users():
     Example:
         GET /api/user/get-users?includebootstrapped=0&loggedinwithindays=7&search_term=&limit=50
     Params:
+        fields: optional comma separated list of the keys to return for each user
         includebootstrapped: 0 to exclude bootstrapped users, 1 to include them
         loggedinwithindays: 0 for all, otherwise limit to number of days since user 
                             has last logged in.
@@ -152,28 +164,12 @@ def api_user_get_users():
     conn = sql_query.get_db_connection()
 
     if search_term != "":
-        rows = conn.execute(sql, (search_term, limit)).fetchall()
+        cursor = conn.execute(sql, (search_term, limit))
     else:
-        rows = conn.execute(sql, (limit,)).fetchall()
-    conn.close()
+        cursor = conn.execute(sql, (limit,))
 
-    users = [
-        {
-          "id":             row["id"],
-          "profile":        row["profile"],
-          "profileurl":     row["profileurl"],
-          "bootstrapped":   row["bootstrapped"],
-          "lastlogin":      row["lastlogin"],
-          "pfpsm":          row["pfpsm"],
-          "pfpmed":         row["pfpmed"],
-          "pfplg":          row["pfplg"],
-          "pfpxl":          row["pfpxl"],
-          "swag":           row["swag"]
-        }
-        for row in rows
-    ]
-
-    return jsonify({ "userProfile": users })
+    return json_response.rows_response("userProfile", cursor, conn,
+                                       fields=json_response.requested_fields(request.args))
 
 @user_profile_bp.route("/api/user/create-profile", methods=['POST'])
 def api_user_create_profile():
@@ -230,7 +226,7 @@ def api_user_create_profile():
     connection.close()
 
     # Refresh/store all last.fm data for this user
-    db_query.refresh_user_data(user)
+    db_query.run_last_fm_task(refresh_scheduler.refresh, user_id, user, refresh_scheduler.SOURCE_SIGNUP)
 
     sql_query.store_broadcast(0,
                               constants.SYSTEM_ACCOUNT_ID,
@@ -294,9 +290,11 @@ def api_user_login():
     cursor.close()
     connection.close()
 
+    data_version.bump(data_version.user_scope(user))
+
     # If the user data has not been refreshed in the last day, refresh it.
-    if sql_query.user_refresh_due(user_id):
-        db_query.refresh_user_data(user)
+    if refresh_state.due(user_id):
+        db_query.run_last_fm_task(refresh_scheduler.refresh, user_id, user, refresh_scheduler.SOURCE_LOGIN)
 
     return jsonify({"success": True, "error": ""}), 201
 
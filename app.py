@@ -1,11 +1,62 @@
 from flask import Flask, render_template, request, jsonify
+import artist_tags
+import constants
 import db_query
+import json_response
 import sql_query
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 
+# Key of the list in top data responses, by kind
+TOP_DATA_KEYS = {"artist": "topArtists", "album": "topAlbums", "track": "topTracks"}
+
+def _page_args():
+    """
+    Reads the pagination parameters of the request body: page (from 1) and
+    limit (rows per page, at most constants.TOP_DATA_MAX_PAGE_SIZE).
+    """
+    page = request.json.get('page')
+    limit = request.json.get('limit')
+    page = max(1, int(page)) if str(page).isnumeric() else 1
+    limit = min(max(1, int(limit)), constants.TOP_DATA_MAX_PAGE_SIZE) if str(limit).isnumeric() \
+        else constants.TOP_DATA_PAGE_SIZE
+    return page, limit
+
+def _top_data_response(kind, passthrough):
+    """
+    Responds with a page of a user's top artists, albums or tracks for a period
+    from the local store, streamed if it is large.  With passthrough, a user
+    and period the store has no data for are looked up on Last.fm instead.
+    Returns JSON:
+      {
+        "topArtists" | "topAlbums" | "topTracks": [
+          { "artist": str, "playcount": int, "lastupdated": str }
+          (albums and tracks also have "album"/"track", tracks "url"),
+          …
+        ],
+        "user": str, "period": str, "page": int, "limit": int,
+        "source": "local" or "lastfm" (lastupdated is null)
+      }
+      (a page shorter than limit is the last one)
+    """
+    username = request.json.get('input')
+    period = request.json.get('period')
+    page, limit = _page_args()
+    extra = {'user': username, 'period': period, 'page': page, 'limit': limit, 'source': 'local'}
+
+    if passthrough:
+        connection, cursor = sql_query.query_top_data(kind, username, period, 1)
+        stored = cursor.fetchone() is not None
+        connection.close()
+        if not stored:
+            rows = db_query.get_top_data_page(kind, username, period, limit, page)
+            return json_response.json_response({TOP_DATA_KEYS[kind]: rows, **extra, 'source': 'lastfm'})
+
+    connection, cursor = sql_query.query_top_data(kind, username, period, limit, (page - 1) * limit)
+    return json_response.rows_response(TOP_DATA_KEYS[kind], cursor, connection, extra=extra)
+
 
 @app.route('/')
 def index():
@@ -17,30 +68,21 @@ def backend_functions():
 
 @app.route('/get_top_artist_plays', methods=['POST'])
 def get_top_artist_plays():
-    user_input = request.json.get('input')
-    period = request.json.get('period')
-    result = db_query.get_top_artist_plays(user_input, period)
-    return jsonify({'output': result})
+    return _top_data_response("artist", passthrough=True)
 
 @app.route('/get_top_album_plays', methods=['POST'])
 def get_top_album_plays():
-    user_input = request.json.get('input')
-    period = request.json.get('period')
-    result = db_query.get_top_album_plays(user_input, period)
-    return jsonify({'output': result})
+    return _top_data_response("album", passthrough=True)
 
 @app.route('/get_top_track_plays', methods=['POST'])
 def get_top_track_plays():
-    user_input = request.json.get('input')
-    period = request.json.get('period')
-    result = db_query.get_top_track_plays(user_input, period)
-    return jsonify({'output': result})
+    return _top_data_response("track", passthrough=True)
 
 @app.route('/get_artist_tags', methods=['POST'])
 def get_artist_tags():
     artist_input = request.json.get('artist')
-    result = db_query.get_artist_tag_counts(artist_input)
-    return jsonify({'output': result})
+    tags = [{'tag': tag, 'count': count} for tag, count in artist_tags.tags(artist_input)]
+    return jsonify({'artist': artist_input, 'tags': tags})
 
 # @app.route('/query_users', methods=['POST'])
 # def query_users():
@@ -56,10 +98,7 @@ def store_top_artists():
 
 @app.route('/query_top_artists', methods=['POST'])
 def query_top_artists():
-    user_input = request.json.get('input')
-    period = request.json.get('period')
-    result = sql_query.query_top_artists(user_input, period)
-    return jsonify({'output': result})
+    return _top_data_response("artist", passthrough=False)
 
 @app.route('/store_top_albums', methods=['POST'])
 def store_top_albums():
@@ -70,10 +109,7 @@ def store_top_albums():
 
 @app.route('/query_top_albums', methods=['POST'])
 def query_top_albums():
-    user_input = request.json.get('input')
-    period = request.json.get('period')
-    result = sql_query.query_top_albums(user_input, period)
-    return jsonify({'output': result})
+    return _top_data_response("album", passthrough=False)
 
 @app.route('/store_top_tracks', methods=['POST'])
 def store_top_tracks():
@@ -84,16 +120,39 @@ def store_top_tracks():
 
 @app.route('/query_top_tracks', methods=['POST'])
 def query_top_tracks():
-    user_input = request.json.get('input')
-    period = request.json.get('period')
-    result = sql_query.query_top_tracks(user_input, period)
-    return jsonify({'output': result})
+    return _top_data_response("track", passthrough=False)
 
 @app.route('/get_user_info', methods=['POST'])
 def get_user_info():
+    """
+    Responds with a user's profile information from the local store, or from
+    Last.fm if the user is not a broadcastr user.
+    Returns JSON:
+      { "user": { "name": str, "url": str, "playcount": int (null locally),
+                  "images": { "small": str, "medium": str, "large": str, "extralarge": str } },
+        "source": "local" or "lastfm" }
+    """
     user_input = request.json.get('input')
-    result = db_query.get_user_info_data(user_input)
-    return jsonify({'output': result})
+    connection = sql_query.get_db_connection()
+    row = connection.execute(
+        "SELECT LastFmProfileName, LastFmProfileUrl, PfpSmall, PfpMedium, PfpLarge, PfpExtraLarge "
+        "FROM User WHERE LastFmProfileName = ?", (user_input,)).fetchone()
+    connection.close()
+
+    if row is not None:
+        user = {
+            'name': row['LastFmProfileName'],
+            'url': row['LastFmProfileUrl'],
+            'playcount': None,
+            'images': {'small': row['PfpSmall'], 'medium': row['PfpMedium'],
+                       'large': row['PfpLarge'], 'extralarge': row['PfpExtraLarge']}
+        }
+        return jsonify({'user': user, 'source': 'local'})
+
+    user = db_query.get_user_info_data(user_input)
+    if user is None:
+        return jsonify({'error': 'Missing or invalid user'}), 404
+    return jsonify({'user': user, 'source': 'lastfm'})
 
 @app.route('/store_last_fm_user_info', methods=['POST'])
 def store_user_last_fm_info():
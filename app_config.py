@@ -0,0 +1,150 @@
+"""
+This module provides lazily loaded configuration values for the broadcastr backend.
+
+Values come from the Config table, which is read on first use (never at import
+time) and cached for the life of the process.  The cache is re-read at most
+every constants.CONFIG_RELOAD_SECONDS; a fingerprint of the table contents
+detects changes, bumps version() and notifies on_change() listeners.  An
+environment variable with the same name as a config key (e.g. LAST_FM_API_KEY)
+overrides the database value.
+"""
+import hashlib
+import os
+import threading
+import time
+
+import constants
+import instrumentation
+import sql_query
+
+_lock = threading.Lock()
+_values = None
+_fingerprint = None
+_loaded_at = 0.0
+_version = 0
+_loads = 0
+_listeners = []
+
+
+def _fingerprint_of(values):
+    digest = hashlib.sha1()
+    for config_key, config_value in sorted(values.items()):
+        digest.update(f"{config_key}\0{config_value}\0".encode())
+    return digest.hexdigest()
+
+
+def _load():
+    """
+    Reads the Config table into the cache.  Must be called with _lock held.
+    Returns:
+        list of listeners to notify if the contents changed, else an empty list
+    """
+    global _values, _fingerprint, _loaded_at, _version, _loads
+
+    start = time.perf_counter()
+    connection = sql_query.get_db_connection()
+    try:
+        values = {row["ConfigKey"]: row["ConfigValue"] or ""
+                  for row in connection.execute("SELECT ConfigKey, ConfigValue FROM Config")}
+    finally:
+        connection.close()
+    elapsed = time.perf_counter() - start
+
+    if _loads == 0:
+        instrumentation.record_startup_phase("config_load", elapsed)
+    _loads += 1
+    _loaded_at = time.monotonic()
+
+    fingerprint = _fingerprint_of(values)
+    changed = _values is not None and fingerprint != _fingerprint
+    _values = values
+    if fingerprint != _fingerprint:
+        _fingerprint = fingerprint
+        _version += 1
+    return list(_listeners) if changed else []
+
+
+def _ensure_loaded():
+    """
+    Loads the cache on first use and re-reads it once it is older than
+    constants.CONFIG_RELOAD_SECONDS.
+    """
+    if _values is not None and time.monotonic() - _loaded_at < constants.CONFIG_RELOAD_SECONDS:
+        return
+    with _lock:
+        if _values is not None and time.monotonic() - _loaded_at < constants.CONFIG_RELOAD_SECONDS:
+            return
+        listeners = _load()
+    for listener in listeners:
+        listener()
+
+
+def get(config_key, default=""):
+    """
+    Gets a configuration value.
+    Args:
+        config_key: The key of the config value to look up
+        default: Value returned if the key is neither set in the environment nor the Config table
+    Returns:
+        str config value matching the key
+    """
+    override = os.environ.get(config_key)
+    if override is not None:
+        return override
+    _ensure_loaded()
+    return _values.get(config_key, default)
+
+
+def reload():
+    """
+    Re-reads the Config table immediately (e.g. after it was edited).
+    Returns:
+        True if the configuration changed since it was previously loaded
+    """
+    with _lock:
+        previous = _fingerprint
+        listeners = _load()
+        changed = previous is not None and previous != _fingerprint
+    for listener in listeners:
+        listener()
+    return changed
+
+
+def warm():
+    """
+    Loads the configuration now rather than on first use, e.g. in a preloading
+    server process before it forks workers.
+    """
+    _ensure_loaded()
+
+
+def version():
+    """
+    Returns a number that increases every time the configuration changes
+    (0 before the configuration is first loaded).
+    """
+    return _version
+
+
+def on_change(listener):
+    """
+    Registers a function (called with no arguments) to run whenever a reload
+    finds that the configuration changed.
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def stats():
+    """
+    Returns cache statistics for debugging.
+    """
+    with _lock:
+        return {
+            "loaded":       _values is not None,
+            "loads":        _loads,
+            "version":      _version,
+            "age_seconds":  time.monotonic() - _loaded_at if _values is not None else None,
+            "keys":         sorted(_values) if _values is not None else [],
+            "overridden":   sorted(key for key in (_values or {}) if key in os.environ),
+        }
@@ -0,0 +1,335 @@
+"""
+This module caches artists' Last.fm tags (artist.gettoptags) and aggregates
+them into users' genre profiles.
+
+Tags are stored normalized: each distinct tag name (lowercased) once in the
+Tag table, and each artist's top constants.ARTIST_TAGS_KEPT tags in the
+ArtistTag table with Last.fm's count (0-100, relative to the artist's top tag)
+and the share of the artist's kept counts it makes up.  ArtistTagFetch records
+when each artist's tags were last fetched, including artists Last.fm has no
+tags for, so they are not fetched again until they are stale.  A fetch that
+gets a Last.fm error response stores nothing, so the artist is fetched again
+later.  These tables are created on first use.
+
+Tags are filled lazily: tags() fetches an artist's tags the first time they
+are asked for.  Reads of tags and genre profiles also start a background batch
+(at most one per process every constants.ARTIST_TAG_REFRESH_INTERVAL_SECONDS,
+and one at a time across processes) that fetches the tags of up to
+constants.ARTIST_TAG_REFRESH_BATCH listened-to artists, never-fetched artists
+first and then those fetched more than constants.ARTIST_TAG_MAX_AGE_DAYS ago.
+Batches share the Last.fm call budget of refresh_scheduler.py: a batch
+fetches no more artists than the calls left in the budget window, and its
+calls are logged against it.
+
+A genre profile (genre_profile()) spreads each of a user's TopArtist
+playcounts over the artist's tags by their shares and sums them per tag, so
+it is computed locally, without any Last.fm call.  Writes bump the
+data_version.SCOPE_ARTIST_TAGS scope.
+"""
+import fcntl
+import threading
+import time
+
+import constants
+import data_version
+import db_query
+import instrumentation
+import refresh_scheduler
+import sql_query
+
+_tables_ready = False
+_lock = threading.Lock()
+_refreshing = False
+_last_refresh = None
+
+
+def _ensure_tables(connection):
+    global _tables_ready
+    if _tables_ready:
+        return
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS Tag (
+            TagID INTEGER PRIMARY KEY AUTOINCREMENT,
+            TagName TEXT NOT NULL UNIQUE
+        )
+        """)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ArtistTag (
+            ArtistID INTEGER NOT NULL,
+            TagID INTEGER NOT NULL,
+            Count INTEGER NOT NULL,
+            Share REAL NOT NULL,
+            PRIMARY KEY (ArtistID, TagID)
+        ) WITHOUT ROWID
+        """)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ArtistTagFetch (
+            ArtistID INTEGER NOT NULL PRIMARY KEY,
+            FetchedAt INTEGER NOT NULL
+        )
+        """)
+    _tables_ready = True
+
+
+def _parse(data):
+    """
+    Returns the (lowercased name, count) pairs of the top tags in an
+    artist.gettoptags response (none for an error response), by count descending.
+    """
+    counts = {}
+    for tag in data.get("toptags", {}).get("tag", []):
+        name = tag.get("name", "").strip().lower()
+        if name:
+            counts[name] = counts.get(name, 0) + int(tag.get("count", 0))
+    ranked = sorted(counts.items(), key=lambda pair: (-pair[1], pair[0]))
+    return [(name, count) for name, count in ranked[:constants.ARTIST_TAGS_KEPT] if count > 0]
+
+
+def store(artist_id, tags):
+    """
+    Replaces an artist's tags and records when they were fetched, in one transaction.
+    Args:
+        artist_id: The numeric artist id
+        tags: list of (tag name, count), as returned by _parse()
+    """
+    total = sum(count for _, count in tags)
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        connection.execute("BEGIN")
+        connection.executemany("INSERT OR IGNORE INTO Tag (TagName) VALUES (?)", [(name,) for name, _ in tags])
+        tag_ids = {}
+        if tags:
+            placeholders = ", ".join("?" for _ in tags)
+            tag_ids = dict(connection.execute(
+                f"SELECT TagName, TagID FROM Tag WHERE TagName IN ({placeholders})",
+                [name for name, _ in tags]).fetchall())
+        connection.execute("DELETE FROM ArtistTag WHERE ArtistID = ?", (artist_id,))
+        connection.executemany(
+            "INSERT INTO ArtistTag (ArtistID, TagID, Count, Share) VALUES (?, ?, ?, ?)",
+            [(artist_id, tag_ids[name], count, count / total) for name, count in tags])
+        connection.execute(
+            """
+            INSERT INTO ArtistTagFetch (ArtistID, FetchedAt) VALUES (?, ?)
+            ON CONFLICT(ArtistID) DO UPDATE SET FetchedAt = excluded.FetchedAt
+            """,
+            (artist_id, int(time.time())))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def fetch(artist_id, artistname):
+    """
+    Fetches an artist's tags from Last.fm and stores them.
+    Returns:
+        list of (tag name, count), or None if Last.fm returned an error (nothing is stored)
+    """
+    data = db_query.get_artist_tags(artistname)
+    if "error" in data:
+        print(f"Last.fm error fetching tags of {artistname}: {data.get('message', data['error'])}")
+        return None
+    tags = _parse(data)
+    store(artist_id, tags)
+    return tags
+
+
+def _stored(artist_id):
+    """
+    Returns an artist's stored tags as a list of (tag name, count), or None if
+    they were never fetched.
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        if connection.execute("SELECT 1 FROM ArtistTagFetch WHERE ArtistID = ?", (artist_id,)).fetchone() is None:
+            return None
+        rows = connection.execute(
+            """
+            SELECT Tag.TagName, ArtistTag.Count FROM ArtistTag
+            JOIN Tag ON ArtistTag.TagID = Tag.TagID
+            WHERE ArtistTag.ArtistID = ?
+            ORDER BY ArtistTag.Count DESC, Tag.TagName
+            """,
+            (artist_id,)).fetchall()
+    finally:
+        connection.close()
+    return [(row["TagName"], row["Count"]) for row in rows]
+
+
+def tags(artistname):
+    """
+    Gets an artist's top tags, fetching them from Last.fm only if they were
+    never fetched (or, without storing them, if the artist is not in the database).
+    Args:
+        artistname: The artist's name
+    Returns:
+        list of (tag name, count) by count descending
+    """
+    _maybe_refresh()
+    artist_id = sql_query.query_artist_id(artistname)
+    if not artist_id:
+        return _parse(db_query.get_artist_tags(artistname))
+    stored = _stored(artist_id)
+    if stored is None:
+        stored = fetch(artist_id, artistname)
+        if stored is None:
+            return []
+        data_version.bump(data_version.SCOPE_ARTIST_TAGS)
+    return stored
+
+
+def genre_profile(user_id, period, limit):
+    """
+    Aggregates a user's top artists in a period into genres, from stored tags only.
+    Args:
+        user_id: The numeric user id
+        period: The period name
+        limit: The maximum number of genres
+    Returns:
+        (list of rows of genre, plays (playcount attributed to the genre) and
+         share (of the playcount attributed to any genre), by plays descending;
+         share of the user's playcount of artists whose tags are stored)
+    """
+    _maybe_refresh()
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        totals = connection.execute(
+            """
+            SELECT SUM(TopArtist.Playcount) AS Playcount,
+                   SUM(CASE WHEN ArtistTagFetch.ArtistID IS NULL THEN 0 ELSE TopArtist.Playcount END) AS Fetched
+            FROM TopArtist
+            JOIN Period ON TopArtist.PeriodID = Period.PeriodID
+            LEFT JOIN ArtistTagFetch ON TopArtist.ArtistID = ArtistTagFetch.ArtistID
+            WHERE TopArtist.UserID = ? AND Period.PeriodName = ?
+            """,
+            (user_id, period)).fetchone()
+        rows = connection.execute(
+            """
+            SELECT Tag.TagName AS genre, SUM(TopArtist.Playcount * ArtistTag.Share) AS plays
+            FROM TopArtist
+            JOIN Period ON TopArtist.PeriodID = Period.PeriodID
+            JOIN ArtistTag ON TopArtist.ArtistID = ArtistTag.ArtistID
+            JOIN Tag ON ArtistTag.TagID = Tag.TagID
+            WHERE TopArtist.UserID = ? AND Period.PeriodName = ?
+            GROUP BY Tag.TagName
+            ORDER BY plays DESC, genre
+            """,
+            (user_id, period)).fetchall()
+    finally:
+        connection.close()
+
+    tagged = sum(row["plays"] for row in rows)
+    genres = [{"genre": row["genre"], "plays": round(row["plays"]), "share": round(row["plays"] / tagged, 4)}
+              for row in rows[:limit]]
+    coverage = (totals["Fetched"] or 0) / totals["Playcount"] if totals["Playcount"] else 0
+    return genres, round(coverage, 4)
+
+
+#################################################
+#   Background refresh                           #
+#################################################
+
+def refresh_batch(size=constants.ARTIST_TAG_REFRESH_BATCH):
+    """
+    Fetches the tags of up to size listened-to artists whose tags were never
+    fetched or are stale, unless another process is already doing so.
+    Artists whose fetch gets a Last.fm error are skipped, to be fetched again
+    by a later batch.  At most the calls left in the refresh budget are made
+    (see refresh_scheduler.py), and they are logged against it.
+    Returns:
+        the number of artists whose tags were fetched
+    """
+    stale_before = int(time.time()) - constants.ARTIST_TAG_MAX_AGE_DAYS * 86400
+    size = min(size, refresh_scheduler.budget_remaining())
+    if size <= 0:
+        return 0
+    with open(constants.ARTIST_TAG_LOCK_PATH, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        connection = sql_query.get_db_connection(primary=True)
+        try:
+            _ensure_tables(connection)
+            artists = connection.execute(
+                """
+                SELECT Artist.ArtistID, Artist.ArtistName FROM Artist
+                LEFT JOIN ArtistTagFetch ON Artist.ArtistID = ArtistTagFetch.ArtistID
+                WHERE Artist.ArtistID IN (SELECT ArtistID FROM TopArtist)
+                  AND (ArtistTagFetch.FetchedAt IS NULL OR ArtistTagFetch.FetchedAt < ?)
+                ORDER BY COALESCE(ArtistTagFetch.FetchedAt, 0), Artist.ArtistID
+                LIMIT ?
+                """,
+                (stale_before, size)).fetchall()
+        finally:
+            connection.close()
+
+        fetched = 0
+        started = time.time()
+        with instrumentation.counting() as counters:
+            try:
+                for artist in artists:
+                    if fetch(artist["ArtistID"], artist["ArtistName"]) is not None:
+                        fetched += 1
+                    time.sleep(constants.LAST_FM_API_CALL_SLEEP_TIME)
+            finally:
+                if counters["last_fm_calls"]:
+                    refresh_scheduler.log_calls(refresh_scheduler.SOURCE_ARTIST_TAGS, started,
+                                                counters["last_fm_calls"])
+    if fetched:
+        data_version.bump(data_version.SCOPE_ARTIST_TAGS)
+    return fetched
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        refresh_batch()
+    except Exception as error:  # pylint: disable=broad-except
+        print(f"Artist tag refresh failed: {error!r}")
+    finally:
+        _refreshing = False
+
+
+def _maybe_refresh():
+    """
+    Starts a background batch if none ran in this process for the refresh interval.
+    """
+    global _refreshing, _last_refresh
+    if _last_refresh is not None and time.monotonic() - _last_refresh < constants.ARTIST_TAG_REFRESH_INTERVAL_SECONDS:
+        return
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+        _last_refresh = time.monotonic()
+    threading.Thread(target=_refresh_in_background, name="broadcastr-artist-tags", daemon=True).start()
+
+
+def reset_after_fork():
+    """
+    Resets the refresh state inherited from the master process; called in a
+    new gunicorn worker (see gunicorn.conf.py).
+    """
+    global _lock, _refreshing, _last_refresh
+    _lock = threading.Lock()
+    _refreshing = False
+    _last_refresh = None
+
+
+if __name__ == "__main__":
+    # Fetch every missing or stale tag, within the refresh budget: python artist_tags.py
+    while True:
+        wait = refresh_scheduler.budget_wait()
+        if wait > 0:
+            time.sleep(wait)
+        elif not refresh_batch():
+            break
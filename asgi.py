@@ -0,0 +1,329 @@
+"""
+This module provides an ASGI entry point for the broadcastr API, so that
+requests waiting on Last.fm do not hold a worker thread.
+
+Every request is still served by the Flask app (api.app, with all of its
+blueprints), run in a small thread pool.  On the Last.fm-bound routes
+(DEFERRED_PATHS) db_query is told not to call Last.fm itself: when the
+request needs a Last.fm response it does not have yet, it stops, its thread
+is released, the calls are made with an async HTTP client (at most
+constants.ASGI_LAST_FM_CONCURRENCY at once per process), and the request is
+run again with the responses.  Those routes only read when they are run again.
+
+Work that makes many Last.fm calls one after another (the refresh run at
+login and signup, see db_query.run_last_fm_task) is not run in the request:
+once the request's code has returned, the server runs it in a thread of its
+own (at most constants.ASGI_TASK_THREADS at once), making its Last.fm calls
+with the same async client, and sends the response when it completes.  So
+the request's own side effects (checking the password, the login timestamp)
+happen once, and the refresh runs once, whatever number of calls it makes.
+
+Example:
+    uvicorn asgi:application --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+"""
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import api
+import app_config
+import constants
+import db_query
+import instrumentation
+
+# Routes whose Last.fm calls are made asynchronously
+DEFERRED_PATHS = ("/api/artist/listens", "/api/artist/top-listeners", "/api/user/login")
+
+_pending = contextvars.ContextVar("pending_last_fm_urls", default=None)
+_executor = None
+_task_executor = None
+_client = None
+_semaphore = None
+
+
+def _deferred_response(error):
+    """
+    Flask error handler recording the Last.fm urls a request is waiting for.
+    """
+    pending = _pending.get()
+    if pending is None:
+        raise error
+    pending.extend(error.urls)
+    return "", 503
+
+
+api.app.register_error_handler(db_query.LastFmDeferred, _deferred_response)
+
+
+def _thread_pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(app_config.get("ASGI_THREADS", str(constants.ASGI_THREADS))),
+            thread_name_prefix="broadcastr-asgi")
+    return _executor
+
+
+def _task_pool():
+    global _task_executor
+    if _task_executor is None:
+        _task_executor = ThreadPoolExecutor(max_workers=constants.ASGI_TASK_THREADS,
+                                            thread_name_prefix="broadcastr-asgi-task")
+    return _task_executor
+
+
+#################################################
+#   WSGI bridge                                  #
+#################################################
+
+def _environ(scope, body):
+    """
+    Builds the WSGI environ of an ASGI http request.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = f"HTTP_{key}"
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _begin(results):
+    """
+    Sets up the context a request is run in.
+    Returns:
+        (list that collects the Last.fm urls the request is waiting for,
+         list that collects the request's Last.fm tasks)
+    """
+    pending = []
+    tasks = []
+    _pending.set(pending)
+    db_query.last_fm_results.set(results)
+    db_query.last_fm_tasks.set(tasks)
+    return pending, tasks
+
+
+def _start(environ):
+    """
+    Runs the Flask app up to its first body chunk.
+    Returns:
+        (status code, headers, response iterable, iterator, first chunk or None)
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    iterable = api.app(environ, start_response)
+    chunks = iter(iterable)
+    first = next(chunks, None)
+    return started["status"], started["headers"], iterable, chunks, first
+
+
+def _close(iterable):
+    close = getattr(iterable, "close", None)
+    if close is not None:
+        close()
+
+
+#################################################
+#   Async Last.fm calls                          #
+#################################################
+
+async def _get(url):
+    """
+    Calls the Last.fm API without blocking the event loop.
+    Returns:
+        decoded json response
+    """
+    global _client, _semaphore
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=constants.ASGI_LAST_FM_TIMEOUT_SECONDS)
+        _semaphore = asyncio.Semaphore(constants.ASGI_LAST_FM_CONCURRENCY)
+    async with _semaphore:
+        response = await _client.get(url)
+    return response.json()
+
+
+async def _fetch(url):
+    instrumentation.record_last_fm_call()
+    return await _get(url)
+
+
+class _TaskFetcher:
+    """
+    Makes a Last.fm task's calls on the event loop, from the task's thread
+    (see db_query.last_fm_fetcher).  Calls are counted on the task's thread,
+    so they count towards the task (e.g. a refresh's Last.fm budget).  They
+    start constants.LAST_FM_API_CALL_SLEEP_TIME apart, as db_query spaces out
+    the calls it makes itself, so a task calls Last.fm at the same rate in
+    either server; calls prefetched together still overlap.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.results = {}
+        self.next_start = 0.0   # loop time the task's next call may start at
+
+    async def _get_at(self, url, start):
+        await asyncio.sleep(max(0.0, start - self.loop.time()))
+        return await _get(url)
+
+    async def _get_all(self, urls, starts):
+        return await asyncio.gather(*(self._get_at(url, start) for url, start in zip(urls, starts)))
+
+    def _gather(self, urls):
+        starts = []
+        for _ in urls:
+            instrumentation.record_last_fm_call()
+            self.next_start = max(self.next_start, self.loop.time())
+            starts.append(self.next_start)
+            self.next_start += constants.LAST_FM_API_CALL_SLEEP_TIME
+        future = asyncio.run_coroutine_threadsafe(self._get_all(urls, starts), self.loop)
+        self.results.update(zip(urls, future.result()))
+
+    def prefetch(self, urls):
+        """
+        Makes the calls not made yet at once, keeping their responses for get().
+        """
+        missing = [url for url in dict.fromkeys(urls) if url not in self.results]
+        if missing:
+            self._gather(missing)
+
+    def get(self, url):
+        """
+        Returns the (prefetched) response of a call.
+        """
+        if url not in self.results:
+            self._gather([url])
+        return self.results.pop(url)
+
+
+def _run_task(function, args):
+    try:
+        function(*args)
+    except Exception as error:  # pylint: disable=broad-except
+        print(f"Last.fm task {function.__qualname__} failed: {error!r}")
+
+
+async def _run_tasks(tasks, loop):
+    """
+    Runs a request's Last.fm tasks, one after another, in the task threads.
+    """
+    for function, args in tasks:
+        context = contextvars.copy_context()
+        context.run(db_query.last_fm_fetcher.set, _TaskFetcher(loop))
+        await loop.run_in_executor(_task_pool(), context.run, _run_task, function, args)
+
+
+#################################################
+#   ASGI application                             #
+#################################################
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def _lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _client is not None:
+                await _client.aclose()
+                _client = None
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    ASGI application serving the broadcastr API.
+    """
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    body = await _read_body(receive)
+    loop = asyncio.get_running_loop()
+    executor = _thread_pool()
+
+    # Run the request until it has every Last.fm response it needs; after
+    # ASGI_MAX_LAST_FM_ROUNDS (or if an async call fails) it calls Last.fm itself.
+    results = {} if scope["path"] in DEFERRED_PATHS else None
+    for round_number in range(constants.ASGI_MAX_LAST_FM_ROUNDS + 1):
+        if round_number == constants.ASGI_MAX_LAST_FM_ROUNDS:
+            results = None
+        context = contextvars.copy_context()
+        pending, tasks = context.run(_begin, results)
+        status, headers, iterable, chunks, chunk = await loop.run_in_executor(
+            executor, context.run, _start, _environ(scope, body))
+        if not pending:
+            break
+
+        await loop.run_in_executor(executor, context.run, _close, iterable)
+        urls = list(dict.fromkeys(pending))
+        try:
+            responses = await asyncio.gather(*(_fetch(url) for url in urls))
+        except (httpx.HTTPError, ValueError) as error:
+            print(f"Async last.fm call failed, calling it from the request: {error!r}")
+            results = None
+            continue
+        results.update(zip(urls, responses))
+
+    if tasks:
+        await _run_tasks(tasks, loop)
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    try:
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(executor, context.run, next, chunks, None)
+    finally:
+        await loop.run_in_executor(executor, context.run, _close, iterable)
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
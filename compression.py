@@ -0,0 +1,85 @@
+"""
+This module provides response compression for the broadcastr API.
+
+JSON/text responses of at least constants.COMPRESSION_MIN_BYTES are compressed
+with brotli (when the brotli package is installed and the client accepts it)
+or gzip.  Streamed responses are compressed on the fly, batch by batch.
+"""
+import zlib
+
+from flask import request
+
+import constants
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/html", "text/plain", "text/css", "application/javascript")
+
+
+def _choose_encoding(accept_encodings):
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def _compressor(encoding):
+    """
+    Returns (compress(chunk) -> bytes, flush() -> bytes) for an encoding.
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=constants.BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(constants.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def _compress_stream(chunks, encoding):
+    compress, flush = _compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    yield flush()
+
+
+def compress_response(response):
+    """
+    after_request hook that compresses eligible responses.
+    """
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    encoding = _choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < constants.COMPRESSION_MIN_BYTES:
+            return response
+        compress, flush = _compressor(encoding)
+        response.set_data(compress(data) + flush())
+
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_app(app):
+    """
+    Installs response compression on a Flask app.
+    """
+    app.after_request(compress_response)
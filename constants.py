@@ -9,15 +9,167 @@ DEFAULT_PFP = "https://w7.pngwing.com/pngs/135/630/png-transparent-falling-in-lo
 # Time, in seconds, the system will wait after/between calls to the last.fm API
 LAST_FM_API_CALL_SLEEP_TIME = 0.05
 
+# Default base url of the last.fm API (overridable with the LAST_FM_API_BASE_URL env var)
+LAST_FM_API_BASE_URL = "http://ws.audioscrobbler.com/2.0/"
+
+# Seconds a call to the last.fm API may take (well under REFRESH_LEASE_SECONDS / 3,
+# so a refresh renews its lease in time)
+LAST_FM_API_TIMEOUT_SECONDS = 10
+
 # Configuration key for retrieving the last.fm API key from the database
 LAST_FM_API_CONFIG_KEY = "LAST_FM_API_KEY"
 
-# User data will be refreshed on login after this many days
+# Cached Config table values are re-read (and checked for changes) after this many seconds
+CONFIG_RELOAD_SECONDS = 300
+
+# User data will be refreshed on login after this many days.  A refresh finding the
+# user's Last.fm playcount unchanged skips their top data, unless it was last
+# refreshed this many days ago (see refresh_state.py)
 REFRESH_DAYS = "1"
+REFRESH_IDLE_MAX_DAYS = 3
+
+# Statements slower than this many milliseconds are logged along with their query plan
+SLOW_QUERY_THRESHOLD_MS = 100
+
+# Number of statements /api/debug/slow-queries returns by default
+SLOW_QUERY_TOP_N = 20
+
+# Maximum number of distinct normalized statements the slow-query log keeps stats for
+SLOW_QUERY_MAX_STATEMENTS = 500
+
+# List endpoints returning more rows than this are streamed in batches of this size
+JSON_STREAM_BATCH_ROWS = 500
+
+# Data versions read for conditional GETs (ETags) are memoized in process for this many
+# seconds; writes made by other workers become visible to ETag checks after at most this long
+DATA_VERSION_MAX_AGE_SECONDS = 2
+
+# Cache-Control for users' top data, which only changes when their data is refreshed
+CACHE_CONTROL_TOP_DATA = "private, max-age=60"
+
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESSION_MIN_BYTES = 1024
+
+# Compression levels (gzip 1-9, brotli 0-11); moderate levels keep CPU per request low
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Cached GET responses are served for at most this many seconds, even if no write invalidates them
+RESPONSE_CACHE_TTL_SECONDS = 60
+
+# Limits of the in-process response cache (per gunicorn worker)
+RESPONSE_CACHE_MAX_ENTRIES = 2000
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Database backing the optional response cache tier shared by all workers on a host
+RESPONSE_CACHE_DB = "./data/response_cache.db"
+
+# Expired shared response cache entries are purged after this many writes
+RESPONSE_CACHE_SHARED_PURGE_EVERY = 500
+
+# Maximum number of sub-queries in one /api/batch request
+BATCH_MAX_QUERIES = 20
+
+# ASGI server (asgi.py): threads running the Flask app per process (overridable with
+# the ASGI_THREADS config value), threads running requests' Last.fm tasks (refreshes),
+# and concurrent/timeout limits of its async Last.fm calls
+ASGI_THREADS = 8
+ASGI_TASK_THREADS = 4
+ASGI_LAST_FM_CONCURRENCY = 32
+ASGI_LAST_FM_TIMEOUT_SECONDS = 10
+
+# Times a request may stop to wait for async Last.fm calls before it calls Last.fm itself
+ASGI_MAX_LAST_FM_ROUNDS = 4
+
+# PostgreSQL backend (storage.py, selected with DATABASE_URL): connections kept open
+# and the most open at once per process, seconds a request waits for a free
+# connection, and translated statements cached per process
+PG_POOL_MIN_CONNECTIONS = 1
+PG_POOL_MAX_CONNECTIONS = 10
+PG_POOL_TIMEOUT_SECONDS = 30
+PG_STATEMENT_CACHE_SIZE = 2048
+
+# Read replica (replica.py, enabled with READ_REPLICA_DB): maximum age in seconds of
+# the snapshot GET requests may read from (overridable with READ_REPLICA_MAX_LAG_SECONDS);
+# a new snapshot is taken once it is half that old
+READ_REPLICA_MAX_LAG_SECONDS = 30
+
+# Columnar snapshot of the TopArtist table (top_artist_index.py), memory-mapped by every
+# worker; it is fully rebuilt from the database once it is older than the max age
+TOP_ARTIST_INDEX_PATH = "./data/top_artist_index.bin"
+TOP_ARTIST_INDEX_MAX_AGE_SECONDS = 300
+
+# Related artists and similar users (similarity.py), built offline from this period's
+# top data: files memory-mapped by every worker, neighbours kept per artist/user, and
+# the fewest listeners an artist must share with another to be related to it
+RELATED_ARTISTS_PATH = "./data/related_artists.bin"
+SIMILAR_USERS_PATH = "./data/similar_users.bin"
+SIMILARITY_PERIOD = "overall"
+SIMILARITY_TOP_K = 50
+RELATED_ARTISTS_MIN_SHARED_LISTENERS = 2
+
+# Artist tags (artist_tags.py): top tags kept per artist, and background refreshes
+# fetching the tags of at most this many artists per batch, at most one batch per
+# interval per process (serialized across processes by the lock file), refetching
+# tags older than the max age
+ARTIST_TAGS_KEPT = 10
+ARTIST_TAG_REFRESH_BATCH = 50
+ARTIST_TAG_REFRESH_INTERVAL_SECONDS = 300
+ARTIST_TAG_MAX_AGE_DAYS = 30
+ARTIST_TAG_LOCK_PATH = "./data/artist_tags.lock"
+
+# Rows per page of the legacy top data endpoints (app.py) by default, and at most
+# (Last.fm's own maximum, for pages passed through to it)
+TOP_DATA_PAGE_SIZE = 50
+TOP_DATA_MAX_PAGE_SIZE = 1000
+
+# Background refresh scheduler (refresh_scheduler.py): users are queued once their
+# data was last checked the min age ago, and refreshed highest priority first for
+# as long as all refreshes made fewer Last.fm calls than the budget in the budget
+# window.  Priority is staleness (in hours, capped at the max) scaled up by how
+# recently the user logged in (halving every half life), their followers and
+# whether they are in the top of any leaderboard, with these weights.  The queue
+# is replanned at the plan interval; the refresh log is kept for the log age and
+# stats cover the stats window
+REFRESH_SCHEDULER_MIN_AGE_SECONDS = 6 * 3600
+REFRESH_SCHEDULER_MAX_STALENESS_HOURS = 30 * 24
+REFRESH_SCHEDULER_PLAN_SECONDS = 60
+REFRESH_BUDGET_LAST_FM_CALLS = 300
+REFRESH_BUDGET_WINDOW_SECONDS = 300
+REFRESH_PRIORITY_LOGIN_HALF_LIFE_DAYS = 7
+REFRESH_PRIORITY_LOGIN_WEIGHT = 4.0
+REFRESH_PRIORITY_FOLLOWERS_WEIGHT = 1.0
+REFRESH_PRIORITY_LEADERBOARD_WEIGHT = 2.0
+REFRESH_PRIORITY_LEADERBOARD_SIZE = 25
+REFRESH_LOG_MAX_AGE_SECONDS = 7 * 86400
+REFRESH_STATS_WINDOW_SECONDS = 3600
+REFRESH_SCHEDULER_LOCK_PATH = "./data/refresh_scheduler.lock"
+
+# A refresh's lease on a user (refresh_lease.py) expires after this many seconds
+# unless the refresh renews it (it does between its Last.fm calls, so only a
+# refresh whose worker died loses it), and refreshes waiting for it check
+# whether it was released this often
+REFRESH_LEASE_SECONDS = 180
+REFRESH_LEASE_POLL_SECONDS = 0.2
 
 # Periods use when refreshing top artist/track data
 REFRESH_PERIODS = ["overall", "7day", "1month", "12month"]
 
+# Length in days of the windowed periods top data is computed for from scrobbles
+PERIOD_DAYS = {"7day": 7, "1month": 30, "3month": 90, "6month": 180, "12month": 365}
+
+# Scrobble ingestion (user.getrecenttracks): plays per page (the Last.fm maximum),
+# pages fetched per refresh (older history is backfilled over later refreshes),
+# and rows kept per period when top data is computed from scrobbles
+SCROBBLE_PAGE_SIZE = 200
+SCROBBLE_MAX_PAGES_PER_REFRESH = 10
+SCROBBLE_TOP_ARTISTS = 20
+SCROBBLE_TOP_TRACKS = 50
+
+# Leaderboards are rebuilt from the database after this many seconds so that
+# each worker picks up writes made by other workers
+LEADERBOARD_MAX_AGE_SECONDS = 300
+
 # Amount of swag a user receives when someone likes their broadcast
 SWAG_LIKED_BROADCAST = 1
 
@@ -0,0 +1,155 @@
+"""
+This module tracks versions of groups of data ("scopes") so read endpoints can
+tell whether their data changed without re-running their queries.
+
+Write paths call bump() for the scopes they modify, which increments a row in
+the DataVersion table (created on first use) so that every gunicorn worker
+sees the change.  Readers call current(), which reads the versions by primary
+key and memoizes them in process for constants.DATA_VERSION_MAX_AGE_SECONDS;
+bumps made by this process clear the memo immediately.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+import constants
+import sql_query
+
+SCOPE_BROADCASTS = "broadcasts"     # broadcasts, their likes, and the profile data shown with them
+SCOPE_LEADERBOARD = "leaderboard"   # swag, likes received and broadcast counts
+SCOPE_TOP_ARTISTS = "top-artists"   # any user's TopArtist data (artist listener rankings)
+SCOPE_FOLLOWING = "following"       # Following relationships
+SCOPE_ARTIST_TAGS = "artist-tags"   # artists' stored tags (genre profiles)
+
+_lock = threading.Lock()
+_memo = {}
+_table_ready = False
+_listeners = []
+
+
+def user_top_scope(username):
+    """
+    Returns the scope covering a user's top artist/album/track data.
+    """
+    return f"user-top:{username}"
+
+
+def user_scope(username):
+    """
+    Returns the scope covering a user's User row: profile, last login, swag
+    and profile pictures.  Profile names are matched case-insensitively.
+    """
+    return f"users:{username.lower()}"
+
+
+def _ensure_table(connection):
+    global _table_ready
+    if _table_ready:
+        return
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS DataVersion (
+            Scope TEXT NOT NULL PRIMARY KEY,
+            Version INTEGER NOT NULL,
+            LastModified TEXT NOT NULL
+        )
+        """)
+    _table_ready = True
+
+
+def bump(*scopes):
+    """
+    Records that the data in the given scopes changed.
+    Returns:
+        dict of the new version by scope, read in the bump's transaction
+    """
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_table(connection)
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                """
+                INSERT INTO DataVersion (Scope, Version, LastModified)
+                VALUES (?, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT(Scope) DO UPDATE
+                    SET Version = DataVersion.Version + 1, LastModified = CURRENT_TIMESTAMP
+                """,
+                [(scope,) for scope in scopes])
+            placeholders = ", ".join("?" for _ in scopes)
+            versions = dict(connection.execute(
+                f"SELECT Scope, Version FROM DataVersion WHERE Scope IN ({placeholders})", scopes).fetchall())
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+    with _lock:
+        for scope in scopes:
+            _memo.pop(scope, None)
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener(versions)
+    return versions
+
+
+def on_bump(listener):
+    """
+    Registers a function called with the dict of new versions by scope
+    whenever this process bumps scopes (e.g. to evict cached responses tagged
+    with them).
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def reset_after_fork():
+    """
+    Forgets the versions memoized by the parent process; called in a new
+    gunicorn worker (see gunicorn.conf.py).
+    """
+    global _lock
+    _lock = threading.Lock()
+    _memo.clear()
+
+
+def _parse_timestamp(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+
+def current(*scopes):
+    """
+    Gets the current versions of the given scopes.
+    Returns:
+        (tuple of int versions in the order given (0 for never-bumped scopes),
+         datetime the newest of them last changed, or None if none were bumped)
+    """
+    now = time.monotonic()
+    results = {}
+    with _lock:
+        for scope in scopes:
+            entry = _memo.get(scope)
+            if entry is not None and now - entry[2] < constants.DATA_VERSION_MAX_AGE_SECONDS:
+                results[scope] = entry
+
+    missing = [scope for scope in scopes if scope not in results]
+    if missing:
+        # Always the primary: the replica compares these with its own versions
+        connection = sql_query.get_db_connection(primary=True)
+        try:
+            _ensure_table(connection)
+            placeholders = ", ".join("?" for _ in missing)
+            rows = connection.execute(
+                f"SELECT Scope, Version, LastModified FROM DataVersion WHERE Scope IN ({placeholders})",
+                missing).fetchall()
+        finally:
+            connection.close()
+        loaded = {row["Scope"]: (row["Version"], _parse_timestamp(row["LastModified"]), now) for row in rows}
+        with _lock:
+            for scope in missing:
+                results[scope] = loaded.get(scope, (0, None, now))
+                _memo[scope] = results[scope]
+
+    modified = [results[scope][1] for scope in scopes if results[scope][1] is not None]
+    return tuple(results[scope][0] for scope in scopes), max(modified) if modified else None
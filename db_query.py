@@ -1,93 +1,266 @@
+import contextvars
+import os
 import time
 import requests
-import pprint as pp
 
+import app_config
 import constants
+import data_version
+import instrumentation
+import refresh_lease
+import refresh_state
+import scrobbles
 import sql_query
+import top_artist_index
 
-key = sql_query.query_config(constants.LAST_FM_API_CONFIG_KEY)
+# Base url of the last.fm API.  Can be pointed at a local stub (see tools/lastfm_stub.py)
+base_url = os.getenv("LAST_FM_API_BASE_URL", constants.LAST_FM_API_BASE_URL)
+
+def _api_key(api_key=None):
+	"""
+	Returns the given last.fm API key, or the configured one.  The key is looked
+	up on first use rather than at import so importing this module never opens
+	the database.
+	"""
+	return api_key or app_config.get(constants.LAST_FM_API_CONFIG_KEY)
+
+class LastFmDeferred(Exception):
+	"""
+	Raised while serving a request in the ASGI server (see asgi.py) when the
+	request needs last.fm responses that have not been fetched yet.  The
+	server fetches the urls without holding a thread and runs the request again.
+	"""
+	def __init__(self, urls):
+		super().__init__(f"{len(urls)} last.fm call(s) deferred")
+		self.urls = urls
+
+# Decoded last.fm responses by url, set by the ASGI server for requests whose
+# last.fm calls it makes itself.  None (the default) means call last.fm directly.
+last_fm_results = contextvars.ContextVar("last_fm_results", default=None)
+
+# Set by the ASGI server: the list collecting a request's last.fm tasks (see
+# run_last_fm_task), and, while one runs, the object making its last.fm calls
+# (with get(url) and prefetch(urls) methods).
+last_fm_tasks = contextvars.ContextVar("last_fm_tasks", default=None)
+last_fm_fetcher = contextvars.ContextVar("last_fm_fetcher", default=None)
+
+def _last_fm_get(url):
+	"""
+	Calls the last.fm API and returns the decoded json response.
+	Args:
+		url: The full last.fm API request url
+	Returns:
+		json response data
+	"""
+	results = last_fm_results.get()
+	if results is not None:
+		if url not in results:
+			raise LastFmDeferred([url])
+		return results[url]
+
+	fetcher = last_fm_fetcher.get()
+	if fetcher is not None:
+		return fetcher.get(url)
+
+	instrumentation.record_last_fm_call()
+	return requests.get(url, timeout=constants.LAST_FM_API_TIMEOUT_SECONDS).json()
+
+def prefetch_last_fm(urls):
+	"""
+	Declares the last.fm calls about to be made, so the ASGI server can fetch
+	them all at once instead of one round trip at a time.  Does nothing when
+	last.fm is called directly.
+	"""
+	results = last_fm_results.get()
+	if results is not None:
+		missing = [url for url in urls if url not in results]
+		if missing:
+			raise LastFmDeferred(missing)
+		return
+
+	fetcher = last_fm_fetcher.get()
+	if fetcher is not None:
+		fetcher.prefetch(urls)
+
+def run_last_fm_task(function, *args):
+	"""
+	Runs work that makes many last.fm calls one after another (a user's
+	refresh) for a request.  In the ASGI server the work is run once the
+	request's own code has returned, in a thread of its own with its last.fm
+	calls made asynchronously, and the response is sent when it completes;
+	so the request is not run again for each of those calls.
+	Args:
+		function: The function to run
+		args: Its arguments
+	Returns:
+		the function's result, or None when it is left to the ASGI server
+	"""
+	tasks = last_fm_tasks.get()
+	if tasks is None:
+		return function(*args)
+	tasks.append((function, args))
+	return None
+
+def _last_fm_pause():
+	"""
+	Sleeps between last.fm calls, unless they are made by the ASGI server
+	(which spaces them out itself), and renews the lease of the refresh
+	running (see refresh_lease.keep).
+	"""
+	if last_fm_results.get() is None and last_fm_fetcher.get() is None:
+		time.sleep(constants.LAST_FM_API_CALL_SLEEP_TIME)
+	refresh_lease.keep()
+
+def _top_artists_url(username, period, api_key=None, limit=20, page=1):
+	return f"{base_url}?method=user.gettopartists&user={username}&api_key={_api_key(api_key)}&format=json&limit={limit}&period={period}&page={page}"
+
+def _top_albums_url(username, period, api_key=None, limit=50, page=1):
+	return f"{base_url}?method=user.gettopalbums&user={username}&api_key={_api_key(api_key)}&format=json&limit={limit}&period={period}&page={page}"
+
+def _top_tracks_url(username, period, api_key=None, limit=50, page=1):
+	return f"{base_url}?method=user.gettoptracks&user={username}&api_key={_api_key(api_key)}&format=json&limit={limit}&period={period}&page={page}"
+
+def _user_info_url(username, api_key=None):
+	return f"{base_url}?method=user.getinfo&user={username}&api_key={_api_key(api_key)}&format=json"
+
+def _recent_tracks_url(username, page=1, from_uts=None, to_uts=None, api_key=None, limit=constants.SCROBBLE_PAGE_SIZE):
+	url = f"{base_url}?method=user.getrecenttracks&user={username}&api_key={_api_key(api_key)}&format=json&limit={limit}&page={page}"
+	if from_uts is not None:
+		url += f"&from={from_uts}"
+	if to_uts is not None:
+		url += f"&to={to_uts}"
+	return url
 
 # NOTE: PERIOD CAN BE "7day", "1month", "3month", "6month", "12month", or "overall"
-def get_top_artists(username, period, api_key=key, limit=20):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=user.gettopartists&user={username}&api_key={api_key}&format=json&limit={limit}&period={period}"
-	return requests.get(url).json()
-
-def get_top_albums(username, period, api_key=key, limit=50):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=user.gettopalbums&user={username}&api_key={api_key}&format=json&limit={limit}&period={period}"
-	return requests.get(url).json()
-
-def get_top_tracks(username, period, api_key=key, limit=50):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=user.gettoptracks&user={username}&api_key={api_key}&format=json&limit={limit}&period={period}"
-	return requests.get(url).json()
-
-def get_artist_tags(artistname, api_key=key):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=artist.gettoptags&artist={artistname}&api_key={api_key}&format=json&autocorrect=0"
-	# print(requests.get(url).json())
-	return requests.get(url).json()
-
-def get_artist_playcount(username, artist_name, period, api_key=key):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=user.gettopartists&user={username}&api_key={api_key}&format=json&limit=1000&period={period}"
-	data = requests.get(url).json()
+def get_top_artists(username, period, api_key=None, limit=20):
+	return _last_fm_get(_top_artists_url(username, period, api_key, limit))
+
+def get_top_albums(username, period, api_key=None, limit=50):
+	return _last_fm_get(_top_albums_url(username, period, api_key, limit))
+
+def get_top_tracks(username, period, api_key=None, limit=50):
+	return _last_fm_get(_top_tracks_url(username, period, api_key, limit))
+
+def get_artist_tags(artistname, api_key=None):
+	url = f"{base_url}?method=artist.gettoptags&artist={artistname}&api_key={_api_key(api_key)}&format=json&autocorrect=0"
+	return _last_fm_get(url)
+
+def get_artist_playcount(username, artist_name, period, api_key=None):
+	data = _last_fm_get(_top_artists_url(username, period, api_key, limit=1000))
 	for artist in data.get("topartists", {}).get("artist", []):
 		if artist["name"].lower() == artist_name.lower():
 			return int(artist["playcount"])
 	return 0
 
-def get_track_playcount(username, track_name, artist_name, period, api_key=key):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=user.gettoptracks&user={username}&api_key={api_key}&format=json&limit=1000&period={period}"
-	data = requests.get(url).json()
+def get_track_playcount(username, track_name, artist_name, period, api_key=None):
+	data = _last_fm_get(_top_tracks_url(username, period, api_key, limit=1000))
 	for track in data.get("toptracks", {}).get("track", []):
 		if track["name"].lower() == track_name.lower() and track["artist"]["name"].lower() == artist_name.lower():
 			return int(track["playcount"])
 	return 0
 
-def get_user_info(username, api_key=key):
-	url = f"http://ws.audioscrobbler.com/2.0/?method=user.getinfo&user={username}&api_key={api_key}&format=json"
-	return requests.get(url).json()
-
-def get_top_artist_plays(username, period):
-	top_artists_data = get_top_artists(username, period)["topartists"]["artist"]
-	top_artists = []
-	top_artist_plays = []
-	for i in range(len(top_artists_data)):
-		top_artist_plays.append(top_artists_data[i]["playcount"])
-		top_artists.append(top_artists_data[i]["name"])
-	return pp.pformat(list(zip(top_artists, top_artist_plays)))
-
-def get_top_album_plays(username, period):
-	top_albums_data = get_top_albums(username, period)["topalbums"]["album"]
-	top_albums = []
-	top_albums_artist = []
-	top_albums_plays = []
-	for i in range(len(top_albums_data)):
-		top_albums_plays.append(top_albums_data[i]["playcount"])
-		top_albums_artist.append(top_albums_data[i]["artist"]["name"])
-		top_albums.append(top_albums_data[i]["name"])
-	return pp.pformat(list(zip(top_albums, top_albums_artist, top_albums_plays)))
-
-def get_top_track_plays(username, period):
-	top_tracks_data = get_top_tracks(username, period)["toptracks"]["track"]
-	top_tracks = []
-	top_tracks_artist = []
-	top_tracks_plays = []
-	for i in range(len(top_tracks_data)):
-		top_tracks_plays.append(top_tracks_data[i]["playcount"])
-		top_tracks_artist.append(top_tracks_data[i]["artist"]["name"])
-		top_tracks.append(top_tracks_data[i]["name"])
-	return pp.pformat(list(zip(top_tracks, top_tracks_artist, top_tracks_plays)))
-
-def get_artist_tag_counts(artistname):
-	artist_tags_data = get_artist_tags(artistname)["toptags"]["tag"]
-	artist_tags = []
-	artist_tags_count = []
-	for i in range(len(artist_tags_data)):
-		artist_tags.append(artist_tags_data[i]["name"])
-		artist_tags_count.append(artist_tags_data[i]["count"])
-	return pp.pformat(list(zip(artist_tags, artist_tags_count)))
+def get_user_info(username, api_key=None):
+	return _last_fm_get(_user_info_url(username, api_key))
+
+def get_recent_tracks(username, page=1, from_uts=None, to_uts=None, api_key=None):
+	return _last_fm_get(_recent_tracks_url(username, page, from_uts, to_uts, api_key))
+
+# Last.fm top data urls and response members, by kind (see get_top_data_page)
+_TOP_DATA_LAST_FM = {
+	"artist": (_top_artists_url, "topartists", "artist"),
+	"album": (_top_albums_url, "topalbums", "album"),
+	"track": (_top_tracks_url, "toptracks", "track"),
+}
+
+def get_top_data_page(kind, username, period, limit, page):
+	"""
+	Gets a page of a user's top artists, albums or tracks from Last.fm, in the
+	row format of sql_query.query_top_data.
+	Args:
+		kind: "artist", "album" or "track"
+		username: The last.fm profile name of the user
+		period: The period to query data for
+		limit: The number of rows per page
+		page: The page number, starting at 1
+	Returns:
+		list of dicts (empty if Last.fm returned an error)
+	"""
+	url_builder, member, item = _TOP_DATA_LAST_FM[kind]
+	items = _last_fm_get(url_builder(username, period, limit=limit, page=page)).get(member, {}).get(item, [])
+	# Last.fm can return more items than the limit on some pages
+	rows = []
+	for entry in items[:limit]:
+		if kind == "artist":
+			row = {"artist": entry["name"]}
+		else:
+			row = {kind: entry["name"], "artist": entry["artist"]["name"]}
+		if kind == "track":
+			row["url"] = entry.get("url", "")
+		row.update(playcount=int(entry["playcount"]), lastupdated=None)
+		rows.append(row)
+	return rows
 
 def get_user_info_data(username):
-	user_info_data = get_user_info(username)["user"]
-	return pp.pformat(zip(user_info_data))
+	"""
+	Gets a user's Last.fm profile information.
+	Returns:
+		dict of name, url, playcount and images (by size), or None if Last.fm
+		does not know the user
+	"""
+	user = get_user_info(username).get("user")
+	if user is None:
+		return None
+	return {
+		"name": user["name"],
+		"url": user.get("url", ""),
+		"playcount": int(user.get("playcount", 0)),
+		"images": {image["size"]: image["#text"] for image in user.get("image", []) if image.get("size")}
+	}
+
+def _top_snapshot(kind, data):
+	"""
+	Converts a last.fm top artists, albums or tracks response into rows for
+	sql_query.store_top_data.
+	Args:
+		kind: "artist", "album" or "track"
+		data: The decoded last.fm response
+	Returns:
+		list of row dicts, or None if last.fm returned an error
+	"""
+	_, member, item = _TOP_DATA_LAST_FM[kind]
+	if member not in data:
+		return None
+	rows = []
+	for entry in data.get(member, {}).get(item, []):
+		artist = entry if kind == "artist" else entry["artist"]
+		rows.append({
+			"name": entry["name"],
+			"artist": artist["name"],
+			"artistmbid": artist.get("mbid", ""),
+			"mbid": entry.get("mbid", ""),
+			"url": entry.get("url", ""),
+			"playcount": int(entry["playcount"]),
+		})
+	return rows
+
+def _snapshot_entries(rows):
+	"""
+	Returns top data rows in the form their hashes are computed from (see
+	refresh_state.content_hash).
+	"""
+	return sorted((row["name"], row["artist"], row["playcount"]) for row in rows)
+
+def _store_top_snapshot(username, period, kind, data):
+	"""
+	Replaces a user's top data of one kind for a period with a last.fm response.
+	"""
+	rows = _top_snapshot(kind, data)
+	if rows is None:
+		print(f"Could not get last.fm top {kind} data for user: {username}")
+		return
+	userid = sql_query.query_user_id(username)
+	periodid = sql_query.query_period_id(period)
+	sql_query.store_top_data(userid, {(kind, periodid): rows})
 
 def store_top_albums(username, period):
 	"""
@@ -98,33 +271,8 @@ def store_top_albums(username, period):
 	Returns:
 		string indicating success
 	"""
-	# Get the user's database id
-	userid = sql_query.query_user_id(username)
-
-	# Get the period id (should eventually be passed in by id rather than name?)
-	periodid = sql_query.query_period_id(period)
-
-	# Wipe user top albums data for this period.
-	sql_query.delete_top_albums(userid, periodid)
-
-	# Get updated data
-	top_albums_data = get_top_albums(username, period)["topalbums"]["album"]
-	# print(top_albums_data)
-
-	# Store updated data
-	for _, top_album in enumerate(top_albums_data):
-		albumname = top_album["name"]
-		artistname = top_album["artist"]["name"]
-		artistmbid = top_album["artist"]["mbid"]
-		artistid = sql_query.query_artist_id(artistname)
-		if artistid == 0:
-			artistid = sql_query.store_artist(artistname, artistmbid)
-		albummbid = top_album["mbid"]
-		albumid = sql_query.query_album_id(albumname, artistid)
-		if albumid == 0:
-			albumid = sql_query.store_album(albumname, artistid, albummbid)
-
-		sql_query.store_top_album(userid, albumid, periodid, top_album["playcount"])
+	_store_top_snapshot(username, period, "album", get_top_albums(username, period))
+	data_version.bump(data_version.user_top_scope(username))
 
 	return "top albums stored successfully!"
 
@@ -137,28 +285,9 @@ def store_top_artists(username, period):
 	Returns:
 		string indicating success
 	"""
-	# Get the user's database id
-	userid = sql_query.query_user_id(username)
-
-	# Get the period id (should eventually be passed in by id rather than name?)
-	periodid = sql_query.query_period_id(period)
-
-	# Wipe user top artists data for this period.
-	sql_query.delete_top_artists(userid, periodid)
-
-	# Get updated data
-	top_artists_data = get_top_artists(username, period)["topartists"]["artist"]
-	# print(top_artists_data)
-
-	# Store updated data
-	for _, top_artist in enumerate(top_artists_data):
-		artistname = top_artist["name"]
-		artistmbid = top_artist["mbid"]
-		artistid = sql_query.query_artist_id(artistname)
-		if artistid == 0:
-			artistid = sql_query.store_artist(artistname, artistmbid)
-
-		sql_query.store_top_artist(userid, artistid, periodid, top_artist["playcount"])
+	_store_top_snapshot(username, period, "artist", get_top_artists(username, period))
+	top_artist_index.record_user(sql_query.query_user_id(username))
+	data_version.bump(data_version.user_top_scope(username), data_version.SCOPE_TOP_ARTISTS)
 
 	return "top artists stored successfully!"
 
@@ -171,36 +300,96 @@ def store_top_tracks(username, period):
 	Returns:
 		string indicating success
 	"""
-	# Get the user's database id
-	userid = sql_query.query_user_id(username)
-
-	# Get the period id (should eventually be passed in by id rather than name?)
-	periodid = sql_query.query_period_id(period)
-
-	# Wipe user top tracks data for this period.
-	sql_query.delete_top_tracks(userid, periodid)
-
-	# Get updated data
-	top_tracks_data = get_top_tracks(username, period)["toptracks"]["track"]
-	# print(top_tracks_data)
-
-	# Store updated data
-	for _, top_track in enumerate(top_tracks_data):
-		trackname = top_track["name"]
-		artistname = top_track["artist"]["name"]
-		artistmbid = top_track["artist"]["mbid"]
-		artistid = sql_query.query_artist_id(artistname)
-		if artistid == 0:
-			artistid = sql_query.store_artist(artistname, artistmbid)
-		trackmbid = top_track["mbid"]
-		trackurl = top_track["url"]
-		trackid = sql_query.query_track_id(trackname, artistid)
-		trackid = sql_query.store_track(trackid, trackname, artistid, trackmbid, trackurl)
-
-		sql_query.store_top_track(userid, trackid, periodid, top_track["playcount"])
+	_store_top_snapshot(username, period, "track", get_top_tracks(username, period))
+	data_version.bump(data_version.user_top_scope(username))
 
 	return "top tracks stored successfully!"
 
+def _recent_scrobbles(username, page, from_uts=None, to_uts=None):
+	"""
+	Fetches a page of a user's scrobbles, newest first.
+	Returns:
+		(list of scrobbled tracks, without the one playing now (it has no date), total number of pages)
+	"""
+	data = get_recent_tracks(username, page, from_uts, to_uts).get("recenttracks", {})
+	tracks = data.get("track", [])
+	if isinstance(tracks, dict):
+		tracks = [tracks]
+	total_pages = int(data.get("@attr", {}).get("totalPages", "0") or 0)
+	return [track for track in tracks if "date" in track], total_pages
+
+def ingest_scrobbles(username):
+	"""
+	Appends a user's new scrobbles to the Scrobble table and computes their top
+	artist and track data locally for every period the stored history
+	covers (see scrobbles.py).  Only plays made since the stored watermark are
+	fetched, plus, until the history reaches the user's first scrobble, older
+	pages; at most constants.SCROBBLE_MAX_PAGES_PER_REFRESH pages in all.
+	Args:
+		username: The last.fm profile name of the user
+	Returns:
+		list of the refresh periods whose top data was computed locally
+	"""
+	userid = sql_query.query_user_id(username)
+	newest, oldest, complete = scrobbles.watermark(userid)
+	budget = constants.SCROBBLE_MAX_PAGES_PER_REFRESH
+	fetched = []
+
+	if newest is not None:
+		# Plays since the watermark.  Pages are numbered newest first, so when
+		# there are more than the budget allows, the oldest pages are fetched
+		# (keeping the stored history free of gaps); "to" pins the page
+		# boundaries while new plays come in.
+		tracks, total_pages = _recent_scrobbles(username, 1, from_uts=newest)
+		_last_fm_pause()
+		budget -= 1
+		if tracks and total_pages > 1:
+			pinned = int(tracks[0]["date"]["uts"])
+			if total_pages - 1 > budget:
+				tracks = []
+				pages = range(total_pages, total_pages - budget, -1)
+			else:
+				pages = range(2, total_pages + 1)
+			for page in pages:
+				tracks += _recent_scrobbles(username, page, from_uts=newest, to_uts=pinned)[0]
+				_last_fm_pause()
+				budget -= 1
+		fetched += tracks
+
+	# Backfill older plays, one page at a time below the oldest one stored.
+	# "to" includes plays at the oldest time, which are stored only once.
+	while not complete and budget > 0:
+		tracks, total_pages = _recent_scrobbles(username, 1, to_uts=oldest)
+		_last_fm_pause()
+		budget -= 1
+		fetched += tracks
+		older = [int(track["date"]["uts"]) for track in tracks
+				 if oldest is None or int(track["date"]["uts"]) < oldest]
+		if older:
+			oldest = min(older)
+		complete = not older or total_pages <= 1
+
+	plays = [(int(track["date"]["uts"]),
+			  {"name": track["name"], "artist": track["artist"]["#text"], "mbid": track.get("mbid", ""),
+			   "artistmbid": track["artist"].get("mbid", ""), "url": track.get("url", "")})
+			 for track in fetched]
+
+	newest = max([newest or 0] + [played_at for played_at, _ in plays])
+	history = (newest, oldest or 0, complete)
+	refresh_lease.keep(check=True)
+	scrobbles.append(userid, plays, history)
+
+	# Every period the history covers is materialized, including 3month and
+	# 6month, which are not refreshed from Last.fm
+	periods = [period for period in ["overall", *constants.PERIOD_DAYS]
+			   if scrobbles.covers(history, scrobbles.period_days(period))]
+	if periods:
+		scrobbles.rollup(userid, periods)
+		data_version.bump(data_version.user_top_scope(username), data_version.SCOPE_TOP_ARTISTS)
+
+	print(f"Ingested {len(plays)} scrobbles for {username}, top data computed locally for: {periods}")
+	return [period for period in constants.REFRESH_PERIODS if period in periods]
+
 def store_all_users_last_fm_info():
 	"""
 	Fetches and stores last.fm profile data such as profile pics and profile url for all users.
@@ -223,15 +412,17 @@ def store_all_users_last_fm_info():
 	cursor.close()
 	connection.close()
 
-def store_user_last_fm_info(username):
+def store_user_last_fm_info(username, result=None):
 	"""
 	Fetches and stores a user's last.fm profile data such as profile pics and profile url.
 	Args:
 		username: The user's last.fm profile name
+		result: The user's user.getinfo response, if already fetched
 	"""
 	user_id = sql_query.query_user_id(username)
 
-	result = get_user_info(username)
+	if result is None:
+		result = get_user_info(username)
 
 	if "user" in result:
 		user_result = result["user"]
@@ -264,6 +455,9 @@ def store_user_last_fm_info(username):
 		cursor.close()
 		connection.close()
 
+		# Profile pictures are shown alongside broadcasts
+		data_version.bump(data_version.SCOPE_BROADCASTS, data_version.user_scope(username))
+
 		print(f"Last.fm profile data stored for user: {username}")
 	else:
 		print(f"Could not locate Last.fm profile data for user: {username}")
@@ -272,16 +466,90 @@ def refresh_user_data(username):
 
     print(f"Refreshing user data for {username}")
 
-	# Store user data from last.fm such as profile pictures and profile url
-    store_user_last_fm_info(username)
+    userid = sql_query.query_user_id(username)
+    seen_playcount, refreshed_at, hashes = refresh_state.load(userid)
 
-	# Store last.fm top artist and track data for this user for all periods
+    prefetch_last_fm([_user_info_url(username)])
+    user_info = get_user_info(username)
+    playcount = int(user_info["user"].get("playcount", 0)) if "user" in user_info else None
+
+	# Store user data from last.fm such as profile pictures and profile url
+    store_user_last_fm_info(username, user_info)
+
+    # A user whose playcount has not moved since a recent refresh has not scrobbled
+    if playcount is not None and playcount == seen_playcount \
+            and refreshed_at > time.time() - constants.REFRESH_IDLE_MAX_DAYS * 86400:
+        refresh_state.record_check(userid)
+        print(f"No new scrobbles for {username}, top data not refreshed")
+        return
+
+    # Compute top data from the user's scrobbles for the periods their stored history covers
+    ingest = app_config.get("SCROBBLE_INGESTION", "1") == "1"
+    local_periods = ingest_scrobbles(username) if ingest else []
+    periods = [period for period in constants.REFRESH_PERIODS if period not in local_periods]
+    prefetch_last_fm([_top_artists_url(username, period) for period in periods]
+                     + [_top_tracks_url(username, period) for period in periods])
+
+    # Hashes of the rows now stored, starting from those of the last refresh
+    current = dict(hashes)
+    local_ids = {sql_query.query_period_id(period) for period in local_periods}
+    if local_ids:
+        for key, entries in sql_query.query_top_snapshots(userid, ("artist", "track")).items():
+            if key[1] in local_ids:
+                current[key] = refresh_state.content_hash(entries)
+
+	# Store last.fm top artist and track data for this user for the other periods,
+    # writing only the rows that changed
     # periods = ["overall", "7day", "1month", "12month", "6month", "3month"]
+    snapshots = {}
+    for period in periods:
+        periodid = sql_query.query_period_id(period)
+        fetched = {("artist", periodid): _top_snapshot("artist", get_top_artists(username, period))}
+        _last_fm_pause()
+        fetched[("track", periodid)] = _top_snapshot("track", get_top_tracks(username, period))
+        _last_fm_pause()
+        if any(rows is None for rows in fetched.values()):
+            print(f"Could not get last.fm top data for user: {username}, period: {period}")
+            continue
+        for key, rows in fetched.items():
+            current[key] = refresh_state.content_hash(_snapshot_entries(rows))
+            if current[key] != hashes.get(key):
+                snapshots[key] = rows
+
+    # Albums are refreshed only for periods whose artist or track data changed
+    # (fetched, or computed from scrobbles), or that have none stored yet
+    album_periods = []
     for period in constants.REFRESH_PERIODS:
-        store_top_artists(username, period)
-        time.sleep(constants.LAST_FM_API_CALL_SLEEP_TIME)
-        store_top_tracks(username, period)
-        time.sleep(constants.LAST_FM_API_CALL_SLEEP_TIME)
+        periodid = sql_query.query_period_id(period)
+        if ("album", periodid) not in hashes \
+                or any(current.get((kind, periodid)) != hashes.get((kind, periodid)) for kind in ("artist", "track")):
+            album_periods.append((period, periodid))
+    prefetch_last_fm([_top_albums_url(username, period) for period, _ in album_periods])
+    for period, periodid in album_periods:
+        rows = _top_snapshot("album", get_top_albums(username, period))
+        _last_fm_pause()
+        if rows is None:
+            # Keep the period's old hashes so its albums are fetched again next time
+            for kind in ("artist", "track"):
+                current[(kind, periodid)] = hashes.get((kind, periodid))
+            continue
+        current[("album", periodid)] = refresh_state.content_hash(_snapshot_entries(rows))
+        if current[("album", periodid)] != hashes.get(("album", periodid)):
+            snapshots[("album", periodid)] = rows
+
+    # Artist, album and track rows of every changed period are written in one transaction
+    refresh_lease.keep(check=True)
+    if snapshots:
+        sql_query.store_top_data(userid, snapshots)
+    refresh_state.record_refresh(userid, playcount, {key: value for key, value in current.items() if value is not None})
+
+    # Replace the user's rows in the top artist index, then invalidate anything read from the old ones
+    if local_periods or any(kind == "artist" for kind, _ in snapshots):
+        top_artist_index.record_user(userid)
+        data_version.bump(data_version.user_top_scope(username), data_version.SCOPE_TOP_ARTISTS)
+    elif snapshots:
+        data_version.bump(data_version.user_top_scope(username))
+    print(f"Top data stored for {username} (kind, period id): {sorted(snapshots)}")
 
 # if __name__ == "__main__":
 	# print(get_top_artist_plays("cjonas41"))
@@ -0,0 +1,90 @@
+"""
+Production gunicorn configuration for the broadcastr API.
+
+Example:
+    gunicorn -c gunicorn.conf.py api:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+
+The app is imported once in the master process (preload_app) and the data
+every worker reads on its first requests (Config, Period and RelatedType
+rows, the leaderboards and the top artist index) is loaded before the workers
+are forked, so it is shared copy-on-write rather than re-read by each worker.  Database handles
+are never shared across the fork: warming closes its connections, and
+post_fork() resets the per-process handles and memos in each worker.
+
+Sizing can be overridden with WEB_CONCURRENCY (workers), GUNICORN_THREADS,
+GUNICORN_TIMEOUT and GUNICORN_MAX_REQUESTS; PORT is set by the hosting service.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+
+# SQLite serializes writes, so a few processes with several threads each (to
+# overlap requests waiting on Last.fm) rather than many single-threaded workers
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count() * 2 + 1, 8))))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+preload_app = True
+
+# A login can refresh the user's Last.fm data, which takes several seconds
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers to bound memory growth; the jitter keeps them from restarting together
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = 500
+
+accesslog = "-"
+errorlog = "-"
+
+
+def when_ready(server):
+    """
+    Warms the shared caches in the master process, after the app is loaded
+    and before any worker is forked.
+    """
+    import app_config
+    import leaderboard
+    import replica
+    import sql_query
+    import top_artist_index
+
+    replica.refresh()
+    app_config.warm()
+    sql_query.warm_reference_data()
+    leaderboard.rebuild()
+    top_artist_index.rebuild()
+
+    # Move everything loaded so far out of the collector's reach, so garbage
+    # collections in the workers do not write to (and so copy) those pages
+    gc.freeze()
+    server.log.info("Warmed config, reference data, leaderboards and the top artist index before forking workers")
+
+
+def post_fork(server, worker):
+    """
+    Resets per-process database handles and memos inherited from the master,
+    and starts the worker's background refresh scheduler thread.
+    """
+    import artist_tags
+    import data_version
+    import instrumentation
+    import refresh_scheduler
+    import replica
+    import response_cache
+    import storage
+    import top_artist_index
+
+    artist_tags.reset_after_fork()
+    data_version.reset_after_fork()
+    instrumentation.reset_after_fork()
+    refresh_scheduler.reset_after_fork()
+    replica.reset_after_fork()
+    response_cache.reset_after_fork()
+    storage.reset_after_fork()
+    top_artist_index.reset_after_fork()
+    refresh_scheduler.start()
+    server.log.info(f"Worker {worker.pid} ready")
@@ -0,0 +1,82 @@
+"""
+This module provides HTTP conditional request support (ETag, Last-Modified,
+304 Not Modified) for read endpoints.
+
+A route decorated with conditional() names the data_version scopes its
+response depends on (or a function returning its own version marker, for data
+held in process such as the leaderboards).  The ETag is derived from the
+request path, its query arguments and those versions, so it can be checked
+before the route runs: when the client's If-None-Match (or If-Modified-Since)
+still matches, a 304 is returned without running the route's queries or
+sending a payload.
+"""
+import functools
+import hashlib
+
+from flask import make_response, request
+
+import data_version
+import replica
+
+# Cache-Control for data that changes on user actions: clients may store it
+# but must revalidate (cheaply, via the ETag) on every use
+CACHE_CONTROL_REVALIDATE = "private, no-cache"
+
+
+def _etag(versions, last_modified):
+    digest = hashlib.sha1()
+    digest.update(request.path.encode())
+    for key, value in sorted(request.args.items(multi=True)):
+        digest.update(f"\0{key}={value}".encode())
+    digest.update(f"\0{versions}\0{last_modified.isoformat() if last_modified else ''}".encode())
+    return digest.hexdigest()[:32]
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def _set_headers(response, etag, last_modified, cache_control):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def conditional(scopes=None, version=None, cache_control=CACHE_CONTROL_REVALIDATE):
+    """
+    Decorates a GET route so its responses carry ETag/Last-Modified/Cache-Control
+    headers and unchanged data is answered with 304 Not Modified.
+    Args:
+        scopes: function of the request args returning the data_version scopes
+                the response depends on (None to serve that request unconditionally)
+        version: alternatively, function of the request args returning a
+                 (version marker, last modified datetime or None) pair
+        cache_control: Cache-Control header value for the route's responses
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if version is not None:
+                versions, last_modified = version(request.args)
+            else:
+                entry_scopes = scopes(request.args)
+                if entry_scopes is None:
+                    return view(*args, **kwargs)
+                versions, last_modified = data_version.current(*entry_scopes)
+                replica.check_versions(entry_scopes, versions)
+            etag = _etag(versions, last_modified)
+            if _not_modified(etag, last_modified):
+                return _set_headers(make_response("", 304), etag, last_modified, cache_control)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            return _set_headers(response, etag, last_modified, cache_control)
+        return wrapper
+    return decorator
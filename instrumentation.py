@@ -0,0 +1,333 @@
+"""
+This module provides per-route request instrumentation for the broadcastr API.
+
+For every request it records latency, the number of SQL statements executed,
+the number of database connections opened, and the number of Last.fm API
+calls made.  Metrics are kept in process (one set per gunicorn worker) and
+are exposed in Prometheus text format at /metrics and as JSON at
+/api/debug/metrics.
+"""
+import contextlib
+import threading
+import time
+
+from flask import Blueprint, Response, g, jsonify, request
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+metrics_bp = Blueprint('metrics', __name__)
+
+_lock = threading.Lock()
+_endpoints = {}
+_totals = {"sql_statements": 0, "sql_seconds": 0.0, "db_connections": 0, "last_fm_calls": 0}
+_current = threading.local()
+_startup = {}
+
+
+def _new_endpoint_stats():
+    return {
+        "count": 0,
+        "latency_sum": 0.0,
+        "latency_max": 0.0,
+        "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+        "sql_statements": 0,
+        "sql_seconds": 0.0,
+        "sql_statements_max": 0,
+        "db_connections": 0,
+        "last_fm_calls": 0,
+        "statuses": {},
+    }
+
+
+def _request_counters():
+    """
+    Returns the counters of the request being handled on this thread, or None
+    when called outside of an instrumented request (e.g. from a script).
+    """
+    return getattr(_current, "counters", None)
+
+
+#################################################
+#   Hooks called by sql_query.py and db_query.py #
+#################################################
+
+def record_db_connection():
+    """
+    Records that a database connection was opened.
+    """
+    with _lock:
+        _totals["db_connections"] += 1
+    counters = _request_counters()
+    if counters is not None:
+        counters["db_connections"] += 1
+
+
+def record_sql_statement(elapsed):
+    """
+    Records that a SQL statement was executed.
+    Args:
+        elapsed: time in seconds the statement took to execute
+    """
+    with _lock:
+        _totals["sql_statements"] += 1
+        _totals["sql_seconds"] += elapsed
+    counters = _request_counters()
+    if counters is not None:
+        counters["sql_statements"] += 1
+        counters["sql_seconds"] += elapsed
+
+
+def record_last_fm_call():
+    """
+    Records that a call was made to the Last.fm API.
+    """
+    with _lock:
+        _totals["last_fm_calls"] += 1
+    counters = _request_counters()
+    if counters is not None:
+        counters["last_fm_calls"] += 1
+
+
+@contextlib.contextmanager
+def counting():
+    """
+    Counts the SQL statements, database connections and Last.fm calls made on
+    this thread within the block, e.g. by a background job.  Inside a request
+    they still count towards the request too.
+    Yields:
+        dict of the counts so far
+    """
+    outer = _request_counters()
+    counters = {"sql_statements": 0, "sql_seconds": 0.0, "db_connections": 0, "last_fm_calls": 0}
+    _current.counters = counters
+    try:
+        yield counters
+    finally:
+        _current.counters = outer
+        if outer is not None:
+            for key, value in counters.items():
+                outer[key] += value
+
+
+def record_startup_phase(phase, elapsed):
+    """
+    Records how long a startup phase (module import, app setup, first config
+    load, ...) took in this process.
+    Args:
+        phase: name of the phase
+        elapsed: time in seconds the phase took
+    """
+    with _lock:
+        _startup[phase] = elapsed
+
+
+def reset_after_fork():
+    """
+    Clears the request metrics counted in the parent process (e.g. while
+    warming caches), keeping its startup phases; called in a new gunicorn
+    worker (see gunicorn.conf.py).
+    """
+    global _lock
+    _lock = threading.Lock()
+    _endpoints.clear()
+    for key in _totals:
+        _totals[key] = 0.0 if key == "sql_seconds" else 0
+
+
+#################################################
+#   Flask request hooks                          #
+#################################################
+
+def _start_request():
+    g.instrumentation_start = time.perf_counter()
+    _current.counters = {"sql_statements": 0, "sql_seconds": 0.0,
+                         "db_connections": 0, "last_fm_calls": 0}
+
+
+def _record_status(response):
+    g.instrumentation_status = response.status_code
+    return response
+
+
+def _finish_request(_exception=None):
+    counters = _request_counters()
+    start = g.pop("instrumentation_start", None)
+    _current.counters = None
+    if counters is None or start is None:
+        return
+
+    elapsed = time.perf_counter() - start
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    status = str(g.pop("instrumentation_status", 500))
+
+    bucket = len(LATENCY_BUCKETS)
+    for i, upper_bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= upper_bound:
+            bucket = i
+            break
+
+    with _lock:
+        stats = _endpoints.setdefault(endpoint, _new_endpoint_stats())
+        stats["count"] += 1
+        stats["latency_sum"] += elapsed
+        stats["latency_max"] = max(stats["latency_max"], elapsed)
+        stats["latency_buckets"][bucket] += 1
+        stats["sql_statements"] += counters["sql_statements"]
+        stats["sql_seconds"] += counters["sql_seconds"]
+        stats["sql_statements_max"] = max(stats["sql_statements_max"], counters["sql_statements"])
+        stats["db_connections"] += counters["db_connections"]
+        stats["last_fm_calls"] += counters["last_fm_calls"]
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+
+
+def init_app(app):
+    """
+    Installs the instrumentation hooks and metrics routes on a Flask app.
+    """
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+    app.register_blueprint(metrics_bp, url_prefix='/')
+
+
+#################################################
+#   Reporting                                    #
+#################################################
+
+def _percentile(buckets, count, fraction):
+    """
+    Estimates a latency percentile from histogram buckets (upper bound of the
+    bucket containing the percentile; None if it falls in the overflow bucket).
+    """
+    if count == 0:
+        return 0.0
+    target = fraction * count
+    cumulative = 0
+    for i, bucket_count in enumerate(buckets):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def snapshot():
+    """
+    Returns a JSON-serializable copy of the collected metrics.
+    """
+    with _lock:
+        endpoints = {}
+        for endpoint, stats in sorted(_endpoints.items()):
+            count = stats["count"]
+            endpoints[endpoint] = {
+                "requests":             count,
+                "statuses":             dict(stats["statuses"]),
+                "latency_avg":          stats["latency_sum"] / count,
+                "latency_max":          stats["latency_max"],
+                "latency_p50":          _percentile(stats["latency_buckets"], count, 0.50),
+                "latency_p95":          _percentile(stats["latency_buckets"], count, 0.95),
+                "latency_p99":          _percentile(stats["latency_buckets"], count, 0.99),
+                "sql_statements":       stats["sql_statements"],
+                "sql_statements_avg":   stats["sql_statements"] / count,
+                "sql_statements_max":   stats["sql_statements_max"],
+                "sql_seconds":          stats["sql_seconds"],
+                "db_connections":       stats["db_connections"],
+                "db_connections_avg":   stats["db_connections"] / count,
+                "last_fm_calls":        stats["last_fm_calls"],
+                "last_fm_calls_avg":    stats["last_fm_calls"] / count,
+            }
+        return {"endpoints": endpoints, "totals": dict(_totals), "startup": dict(_startup)}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text():
+    """
+    Renders the collected metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        items = sorted(_endpoints.items())
+        totals = dict(_totals)
+        startup = sorted(_startup.items())
+
+    lines = [
+        "# HELP broadcastr_request_duration_seconds Request latency by endpoint.",
+        "# TYPE broadcastr_request_duration_seconds histogram",
+    ]
+    for endpoint, stats in items:
+        label = f'endpoint="{_label(endpoint)}"'
+        cumulative = 0
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            cumulative += stats["latency_buckets"][i]
+            lines.append(f'broadcastr_request_duration_seconds_bucket{{{label},le="{upper_bound}"}} {cumulative}')
+        lines.append(f'broadcastr_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+        lines.append(f'broadcastr_request_duration_seconds_sum{{{label}}} {stats["latency_sum"]}')
+        lines.append(f'broadcastr_request_duration_seconds_count{{{label}}} {stats["count"]}')
+
+    lines += [
+        "# HELP broadcastr_requests_total Requests by endpoint and status code.",
+        "# TYPE broadcastr_requests_total counter",
+    ]
+    for endpoint, stats in items:
+        for status, count in sorted(stats["statuses"].items()):
+            lines.append(f'broadcastr_requests_total{{endpoint="{_label(endpoint)}",status="{status}"}} {count}')
+
+    per_request_counters = (
+        ("sql_statements", "broadcastr_request_sql_statements_total", "SQL statements executed by endpoint."),
+        ("sql_seconds", "broadcastr_request_sql_seconds_total", "Time spent executing SQL by endpoint."),
+        ("db_connections", "broadcastr_request_db_connections_total", "Database connections opened by endpoint."),
+        ("last_fm_calls", "broadcastr_request_last_fm_calls_total", "Last.fm API calls made by endpoint."),
+    )
+    for key, name, description in per_request_counters:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+        for endpoint, stats in items:
+            lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {stats[key]}')
+
+    process_counters = (
+        ("sql_statements", "broadcastr_sql_statements_total", "SQL statements executed by this process."),
+        ("db_connections", "broadcastr_db_connections_total", "Database connections opened by this process."),
+        ("last_fm_calls", "broadcastr_last_fm_calls_total", "Last.fm API calls made by this process."),
+    )
+    for key, name, description in process_counters:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} counter", f"{name} {totals[key]}"]
+
+    lines += [
+        "# HELP broadcastr_startup_seconds Time taken by each startup phase of this process.",
+        "# TYPE broadcastr_startup_seconds gauge",
+    ]
+    for phase, elapsed in startup:
+        lines.append(f'broadcastr_startup_seconds{{phase="{_label(phase)}"}} {elapsed}')
+
+    return "\n".join(lines) + "\n"
+
+
+@metrics_bp.route("/metrics")
+def metrics():
+    """
+    Exposes request metrics in Prometheus text format.
+    Example:
+        GET /metrics
+    """
+    return Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
+@metrics_bp.route("/api/debug/metrics")
+def api_debug_metrics():
+    """
+    Exposes request metrics as JSON.
+    Example:
+        GET /api/debug/metrics
+    Returns JSON:
+      {
+        "endpoints": {
+          "/api/get-broadcasts": { "requests": int, "latency_avg": float,
+            "latency_p95": float, "sql_statements_avg": float, … },
+          …
+        },
+        "totals": { "sql_statements": int, "db_connections": int, … },
+        "startup": { "import": float, "app_setup": float, "config_load": float }
+      }
+    """
+    return jsonify(snapshot())
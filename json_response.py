@@ -0,0 +1,182 @@
+"""
+This module provides a fast JSON response path for list endpoints.
+
+Instead of copying every sqlite3.Row into a hand-built dict and calling
+jsonify, routes hand their cursor to rows_response(), which maps result
+columns to JSON keys once per query (the SQL column aliases, optionally
+renamed), builds plain dicts from tuple rows and encodes them with orjson
+when it is installed (falling back to the standard json module).  Results
+larger than constants.JSON_STREAM_BATCH_ROWS are streamed to the client in
+batches rather than built in memory as one document.
+
+Clients can trim payloads with fields= (only the listed keys are returned for
+each row) and, on endpoints that support it, shape=normalized (data repeated
+on many rows, such as profile picture URLs, is listed once in a side table).
+"""
+import json
+
+from flask import Response, stream_with_context
+
+import constants
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+
+
+def dumps(payload):
+    """
+    Encodes a JSON-serializable value.
+    Returns:
+        bytes containing compact UTF-8 JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(payload, status=200):
+    """
+    Builds a JSON response, like jsonify but using the fast encoder.
+    """
+    return Response(dumps(payload), status=status, mimetype=JSON_MIMETYPE)
+
+
+def column_keys(description, columns=None):
+    """
+    Works out the JSON key for each column of a query result.
+    Args:
+        description: cursor.description of the executed query
+        columns: optional dict of column name to JSON key, for columns whose
+                 SQL alias is not the key the client expects
+    Returns:
+        tuple of keys in column order
+    """
+    columns = columns or {}
+    return tuple(columns.get(column[0], column[0]) for column in description)
+
+
+def requested_fields(args):
+    """
+    Parses the optional fields= request parameter (comma separated JSON keys).
+    Returns:
+        set of keys to include in each row, or None to include every key
+    """
+    fields = {field.strip() for field in args.get("fields", "").split(",") if field.strip()}
+    return fields or None
+
+
+def normalized_requested(args):
+    """
+    Returns whether the client asked for the normalized response shape
+    (shape=normalized), in which repeated per-user data is listed once in a
+    side table instead of on every row.
+    """
+    return args.get("shape", "") == "normalized"
+
+
+def _row_builder(keys, fields, side_table):
+    """
+    Returns a function turning a tuple row into its JSON dict, and a function
+    recording the row's side table entries.
+    """
+    moved = set()
+    side_columns = []
+    if side_table is not None:
+        for id_column, column_map in side_table[1].items():
+            moved.update(column_map)
+            side_columns.append((keys.index(id_column),
+                                 [(keys.index(column), side_key) for column, side_key in column_map.items()]))
+
+    kept = [i for i, row_key in enumerate(keys) if row_key not in moved and (fields is None or row_key in fields)]
+    if len(kept) == len(keys):
+        def build(row):
+            return dict(zip(keys, row))
+    else:
+        kept_keys = [keys[i] for i in kept]
+
+        def build(row):
+            return dict(zip(kept_keys, [row[i] for i in kept]))
+
+    def record_side(row, table):
+        for id_index, column_map in side_columns:
+            row_id = row[id_index]
+            if row_id is not None and row_id not in table:
+                table[row_id] = {side_key: row[i] for i, side_key in column_map}
+
+    return build, record_side
+
+
+def rows_response(key, cursor, connection=None, columns=None, extra=None, fields=None, side_table=None):
+    """
+    Builds a JSON response of the form {key: [row, ...], **extra} from an
+    executed query, closing the cursor and connection once all rows are read.
+    Args:
+        key: name of the list in the response object
+        cursor: cursor of an executed SELECT
+        connection: connection to close after the rows are read (optional)
+        columns: optional dict of column name to JSON key
+        extra: optional dict of further (small) members of the response object
+        fields: optional set of JSON keys to include in each row (see requested_fields)
+        side_table: optional (name, {id key: {key: side key}}) moving the given
+                    keys out of every row into response[name][row[id key]],
+                    e.g. ("users", {"user": {"user_pfp_sm": "pfp_sm"}})
+    Returns:
+        flask Response, streamed if the result has more than
+        constants.JSON_STREAM_BATCH_ROWS rows
+    """
+    keys = column_keys(cursor.description, columns)
+    build, record_side = _row_builder(keys, fields, side_table)
+    side_rows = {}
+    cursor.row_factory = None
+    batch_size = constants.JSON_STREAM_BATCH_ROWS
+    first_batch = cursor.fetchmany(batch_size)
+
+    def close():
+        cursor.close()
+        if connection is not None:
+            connection.close()
+
+    def encode(rows):
+        # The comma separated members of a JSON array (no brackets)
+        if side_table is not None:
+            for row in rows:
+                record_side(row, side_rows)
+        return dumps([build(row) for row in rows])[1:-1]
+
+    def trailer():
+        members = dict(extra or {})
+        if side_table is not None:
+            members[side_table[0]] = side_rows
+        return members
+
+    if len(first_batch) < batch_size:
+        close()
+        if side_table is not None:
+            for row in first_batch:
+                record_side(row, side_rows)
+        payload = {key: [build(row) for row in first_batch]}
+        payload.update(trailer())
+        return json_response(payload)
+
+    def generate():
+        try:
+            yield b"{" + dumps(key) + b":["
+            yield encode(first_batch)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield b"," + encode(batch)
+            yield b"]"
+            members = trailer()
+            if members:
+                yield b"," + dumps(members)[1:-1]
+            yield b"}"
+        finally:
+            close()
+
+    return Response(stream_with_context(generate()), mimetype=JSON_MIMETYPE)
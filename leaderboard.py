@@ -0,0 +1,397 @@
+"""
+This module maintains precomputed swag, like, and broadcast leaderboards.
+
+Leaderboards are kept in memory as sorted aggregates so that top-N and
+rank-of-user lookups do not have to GROUP BY/COUNT over Like and Broadcast
+on every view.  They are built lazily from the database on first use and are
+then maintained incrementally by the write paths in sql_query.py; those
+updates are idempotent (likes are tracked by LikeID), so an update that
+races a rebuild is neither lost nor counted twice.
+
+Each gunicorn worker holds its own copy, so the boards also record the
+data_version.SCOPE_LEADERBOARD version they reflect: this process's own
+bumps advance it, and a read that finds the scope bumped by another process
+rebuilds the boards from the database first.  Boards older than
+constants.LEADERBOARD_MAX_AGE_SECONDS are rebuilt as well, to pick up writes
+made outside those paths.
+"""
+import bisect
+import threading
+import time
+
+import constants
+import data_version
+import related_type_enum
+import sql_query
+
+BOARD_SWAG = "swag"
+BOARD_LIKES_RECEIVED = "likes"
+BOARD_BROADCASTS = "broadcasts"
+
+BOARDS = (BOARD_SWAG, BOARD_LIKES_RECEIVED, BOARD_BROADCASTS)
+
+
+class SortedBoard:
+    """
+    A sorted aggregate of scores keyed by member id.  Entries are ordered by
+    score descending (ties broken by newest member id first) and kept in
+    sorted buckets of up to 2 * _BUCKET_SIZE entries, so an update moves the
+    entries of one bucket rather than of the whole board, rank lookups are a
+    binary search plus a sum of bucket sizes, and top-N reads the first buckets.
+    """
+
+    _BUCKET_SIZE = 256
+
+    def __init__(self):
+        self._scores = {}
+        self._buckets = []
+        self._maxes = []
+
+    def __len__(self):
+        return len(self._scores)
+
+    def score(self, member):
+        """
+        Returns the member's current score (0 if not on the board).
+        """
+        return self._scores.get(member, 0)
+
+    def set(self, member, score):
+        """
+        Sets a member's score, inserting the member if needed.
+        """
+        self.remove(member)
+        self._scores[member] = score
+        self._insert((-score, -member))
+
+    def add(self, member, delta):
+        """
+        Adds delta to a member's score, inserting the member if needed.
+        """
+        self.set(member, self.score(member) + delta)
+
+    def remove(self, member):
+        """
+        Removes a member from the board if present.
+        """
+        if member not in self._scores:
+            return
+        entry = (-self._scores.pop(member), -member)
+        index = bisect.bisect_left(self._maxes, entry)
+        bucket = self._buckets[index]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if bucket:
+            self._maxes[index] = bucket[-1]
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+
+    def _insert(self, entry):
+        if not self._buckets:
+            self._buckets.append([entry])
+            self._maxes.append(entry)
+            return
+        index = min(bisect.bisect_left(self._maxes, entry), len(self._buckets) - 1)
+        bucket = self._buckets[index]
+        bisect.insort(bucket, entry)
+        self._maxes[index] = bucket[-1]
+        if len(bucket) > 2 * self._BUCKET_SIZE:
+            self._buckets[index:index + 1] = [bucket[:self._BUCKET_SIZE], bucket[self._BUCKET_SIZE:]]
+            self._maxes[index:index + 1] = [bucket[self._BUCKET_SIZE - 1], bucket[-1]]
+
+    def top(self, limit):
+        """
+        Returns up to limit (member, score) pairs ordered by score descending.
+        """
+        entries = []
+        for bucket in self._buckets:
+            if len(entries) >= limit:
+                break
+            entries.extend(bucket[:limit - len(entries)])
+        return [(-member, -score) for score, member in entries]
+
+    def rank(self, member):
+        """
+        Returns the 1-based competition rank of a member (members with equal
+        scores share a rank), or 0 if the member is not on the board.
+        """
+        if member not in self._scores:
+            return 0
+        key = (-self._scores[member],)
+        index = bisect.bisect_left(self._maxes, key)
+        return sum(len(bucket) for bucket in self._buckets[:index]) + \
+            bisect.bisect_left(self._buckets[index], key) + 1
+
+
+_lock = threading.RLock()
+_boards = {}
+_user_broadcast_boards = {}
+_broadcast_owners = {}
+_broadcast_like_ids = {}
+_built_at = 0.0
+_built_version = None
+
+
+def rebuild():
+    """
+    Rebuilds every leaderboard from the database.  Used for the initial
+    build, reconciliation across workers, and recovery.  The database is read
+    while holding the boards' lock, so incremental updates made meanwhile are
+    applied to the new boards rather than to the ones being replaced.
+    Returns:
+        dict of board name to number of members
+    """
+    with _lock:
+        return _rebuild()
+
+
+def _rebuild():
+    global _built_at, _built_version
+
+    boards = {name: SortedBoard() for name in BOARDS}
+    user_broadcast_boards = {}
+    broadcast_owners = {}
+
+    # Read before the rows, so the boards reflect at least every write bumped up to it
+    (version,), _ = data_version.current(data_version.SCOPE_LEADERBOARD)
+
+    # The boards are updated in place by writes, so never rebuilt from the read replica
+    connection = sql_query.get_db_connection(primary=True)
+    cursor = connection.cursor()
+
+    cursor.execute(
+        """
+        SELECT UserID, Swag
+        FROM User
+        WHERE UserID <> ?
+        """,
+        (constants.SYSTEM_ACCOUNT_ID,))
+    for row in cursor.fetchall():
+        boards[BOARD_SWAG].set(row["UserID"], row["Swag"])
+
+    cursor.execute(
+        """
+        SELECT BroadcastID, UserID, RelatedTypeID
+        FROM Broadcast
+        WHERE Deleted = 0
+            AND UserID <> ?
+        """,
+        (constants.SYSTEM_ACCOUNT_ID,))
+    broadcast_counts = {}
+    for row in cursor.fetchall():
+        broadcast_owners[row["BroadcastID"]] = (row["UserID"], row["RelatedTypeID"])
+        broadcast_counts[row["UserID"]] = broadcast_counts.get(row["UserID"], 0) + 1
+
+    cursor.execute(
+        """
+        SELECT LikeID, RelatedID
+        FROM Like
+        WHERE RelatedTypeID = ?
+        """,
+        (related_type_enum.RelatedType.BROADCAST.value,))
+    like_ids = {}
+    for row in cursor.fetchall():
+        like_ids.setdefault(int(row["RelatedID"]), set()).add(row["LikeID"])
+
+    cursor.close()
+    connection.close()
+
+    likes_received = {}
+    broadcast_like_ids = {}
+    for broadcast_id, (user_id, related_type_id) in broadcast_owners.items():
+        broadcast_like_ids[broadcast_id] = like_ids.get(broadcast_id, set())
+        likes = len(broadcast_like_ids[broadcast_id])
+        likes_received[user_id] = likes_received.get(user_id, 0) + likes
+        if related_type_id == related_type_enum.RelatedType.TRACK.value:
+            user_broadcast_boards.setdefault(user_id, SortedBoard()).set(broadcast_id, likes)
+
+    for user_id, count in broadcast_counts.items():
+        boards[BOARD_BROADCASTS].set(user_id, count)
+    for user_id, likes in likes_received.items():
+        boards[BOARD_LIKES_RECEIVED].set(user_id, likes)
+
+    _boards.clear()
+    _boards.update(boards)
+    _user_broadcast_boards.clear()
+    _user_broadcast_boards.update(user_broadcast_boards)
+    _broadcast_owners.clear()
+    _broadcast_owners.update(broadcast_owners)
+    _broadcast_like_ids.clear()
+    _broadcast_like_ids.update(broadcast_like_ids)
+    _built_at = time.monotonic()
+    _built_version = version
+
+    return {name: len(board) for name, board in boards.items()}
+
+
+def _ensure_built():
+    """
+    Builds the leaderboards if they have not been built yet, another process
+    changed them, or they are older than the maximum age.
+    """
+    if _built_at == 0.0 or time.monotonic() - _built_at > constants.LEADERBOARD_MAX_AGE_SECONDS:
+        _rebuild()
+        return
+    (version,), _ = data_version.current(data_version.SCOPE_LEADERBOARD)
+    if version != _built_version:
+        _rebuild()
+
+
+def _on_bump(versions):
+    """
+    Advances the version the boards reflect when this process's bump of the
+    leaderboard scope was the only one since (its update was applied first).
+    """
+    global _built_version
+    version = versions.get(data_version.SCOPE_LEADERBOARD)
+    with _lock:
+        if version is not None and _built_version is not None and version == _built_version + 1:
+            _built_version = version
+
+
+data_version.on_bump(_on_bump)
+
+
+def _is_built():
+    return _built_at != 0.0
+
+
+def top(board_name, limit):
+    """
+    Returns the top members of a global leaderboard.
+    Args:
+        board_name: one of BOARDS
+        limit: maximum number of entries to return
+    Returns:
+        list of (user id, score) pairs ordered by score descending
+    """
+    with _lock:
+        _ensure_built()
+        return _boards[board_name].top(limit)
+
+
+def rank(board_name, user_id):
+    """
+    Returns a user's position on a global leaderboard.
+    Args:
+        board_name: one of BOARDS
+        user_id: numeric database id of the user
+    Returns:
+        tuple of (1-based rank or 0 if unranked, score, board size)
+    """
+    with _lock:
+        _ensure_built()
+        board = _boards[board_name]
+        return board.rank(user_id), board.score(user_id), len(board)
+
+
+def top_user_broadcasts(user_id, limit):
+    """
+    Returns a user's most liked track broadcasts.
+    Args:
+        user_id: numeric database id of the user
+        limit: maximum number of entries to return
+    Returns:
+        list of (broadcast id, likes) pairs ordered by likes, then newest first
+    """
+    with _lock:
+        _ensure_built()
+        board = _user_broadcast_boards.get(user_id)
+        return board.top(limit) if board else []
+
+
+#################################################
+#   Incremental maintenance, called from the     #
+#   write paths in sql_query.py.  These are      #
+#   no-ops until the boards have been built.     #
+#################################################
+
+def record_swag(user_id, swag):
+    """
+    Records a user's new swag balance.
+    """
+    with _lock:
+        if _is_built() and user_id != constants.SYSTEM_ACCOUNT_ID:
+            _boards[BOARD_SWAG].set(user_id, swag)
+
+
+def record_broadcast(broadcast_id, user_id, related_type_id):
+    """
+    Records a newly stored broadcast.
+    """
+    with _lock:
+        if not _is_built() or user_id == constants.SYSTEM_ACCOUNT_ID or broadcast_id in _broadcast_owners:
+            return
+        _broadcast_owners[broadcast_id] = (user_id, related_type_id)
+        _broadcast_like_ids[broadcast_id] = set()
+        _boards[BOARD_BROADCASTS].add(user_id, 1)
+        if related_type_id == related_type_enum.RelatedType.TRACK.value:
+            _user_broadcast_boards.setdefault(user_id, SortedBoard()).set(broadcast_id, 0)
+
+
+def record_broadcast_deleted(broadcast_id):
+    """
+    Records that a broadcast was marked as deleted, removing it and its likes
+    from its broadcastr's totals.
+    """
+    with _lock:
+        if not _is_built() or broadcast_id not in _broadcast_owners:
+            return
+        user_id, _ = _broadcast_owners.pop(broadcast_id)
+        _boards[BOARD_BROADCASTS].add(user_id, -1)
+        _boards[BOARD_LIKES_RECEIVED].add(user_id, -len(_broadcast_like_ids.pop(broadcast_id, ())))
+        user_board = _user_broadcast_boards.get(user_id)
+        if user_board is not None:
+            user_board.remove(broadcast_id)
+
+
+def record_like(related_type_id, related_id, like_ids, added):
+    """
+    Records likes being added or removed; likes already recorded (or already
+    removed) are ignored.
+    Args:
+        related_type_id: type id that the likes relate to
+        related_id: record id that the likes relate to
+        like_ids: LikeIDs of the likes
+        added: True if the likes were added, False if they were removed
+    """
+    if int(related_type_id) != related_type_enum.RelatedType.BROADCAST.value:
+        return
+    with _lock:
+        owner = _broadcast_owners.get(int(related_id)) if _is_built() else None
+        if owner is None:
+            return
+        user_id, broadcast_related_type_id = owner
+        recorded = _broadcast_like_ids.setdefault(int(related_id), set())
+        if added:
+            changed = set(like_ids) - recorded
+            recorded.update(changed)
+            delta = len(changed)
+        else:
+            changed = recorded.intersection(like_ids)
+            recorded.difference_update(changed)
+            delta = -len(changed)
+        if not delta:
+            return
+        _boards[BOARD_LIKES_RECEIVED].add(user_id, delta)
+        if broadcast_related_type_id == related_type_enum.RelatedType.TRACK.value:
+            _user_broadcast_boards.setdefault(user_id, SortedBoard()).add(int(related_id), delta)
+
+
+def record_user_deleted(user_id):
+    """
+    Removes a deleted user from every board.
+    """
+    with _lock:
+        if not _is_built():
+            return
+        for board in _boards.values():
+            board.remove(user_id)
+        _user_broadcast_boards.pop(user_id, None)
+
+
+if __name__ == "__main__":
+    # Full rebuild for recovery/verification: python leaderboard.py
+    print(f"Rebuilt leaderboards: {rebuild()}")
+    for name in BOARDS:
+        print(f"{name}: {top(name, 10)}")
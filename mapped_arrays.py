@@ -0,0 +1,86 @@
+"""
+This module writes files of named NumPy arrays and maps them read-only, so
+every process reading a file shares one copy through the page cache (see
+top_artist_index.py and similarity.py).
+
+A file starts with a magic string and a JSON header holding the writer's
+metadata and each array's dtype, offset and length, followed by the arrays,
+each aligned to 64 bytes.  Files are written under a temporary name and
+renamed over the previous one, so processes that mapped it keep reading it
+until they map the new one (see MappedArrays.replaced()).
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:     # callers check for NumPy before writing or mapping files
+    numpy = None
+
+_MAGIC = b"BCARRAY1"
+_ALIGNMENT = 64
+_HEADER_ROOM = 4096
+
+
+def write(path, arrays, metadata):
+    """
+    Writes arrays to a file, replacing it.
+    Args:
+        path: The file to write
+        arrays: dict of name to NumPy array
+        metadata: json-serializable dict stored with the arrays
+    """
+    arrays = {name: numpy.ascontiguousarray(array) for name, array in arrays.items()}
+    position = _HEADER_ROOM
+    layout = {}
+    for name, array in arrays.items():
+        layout[name] = (array.dtype.str, position, len(array))
+        position += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    header = json.dumps({"metadata": metadata, "arrays": layout}).encode()
+    if len(_MAGIC) + 8 + len(header) > _HEADER_ROOM:
+        raise ValueError(f"header of {path} is too large")
+
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "wb") as array_file:
+        array_file.write(_MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in arrays.items():
+            array_file.seek(layout[name][1])
+            array_file.write(array.tobytes())
+        array_file.truncate(position)
+    os.replace(temporary, path)
+
+
+class MappedArrays:
+    """
+    A file of arrays mapped read-only.  The arrays (in .arrays, by name) are
+    views of the mapping, which stays open while any of them is referenced.
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If it is not a file of arrays
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as array_file:
+            self.stat = os.fstat(array_file.fileno())
+            mapping = mmap.mmap(array_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapping[:len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"{path} is not a file of arrays")
+        header_length, = struct.unpack_from("<Q", mapping, len(_MAGIC))
+        header = json.loads(mapping[len(_MAGIC) + 8:len(_MAGIC) + 8 + header_length])
+        self.path = path
+        self.metadata = header["metadata"]
+        self.arrays = {name: numpy.frombuffer(mapping, dtype=dtype, count=length, offset=offset)
+                       for name, (dtype, offset, length) in header["arrays"].items()}
+
+    def replaced(self):
+        """
+        Returns whether the file was replaced (or removed) since it was mapped.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_mtime_ns) != (self.stat.st_ino, self.stat.st_mtime_ns)
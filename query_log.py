@@ -0,0 +1,177 @@
+"""
+This module provides a slow-query log for statements executed through sql_query.
+
+Every statement executed on a sql_query connection is timed and aggregated by
+its normalized SQL (literals replaced with ?, whitespace collapsed).  Statements
+slower than constants.SLOW_QUERY_THRESHOLD_MS are logged with their bound
+parameter shape, and their EXPLAIN QUERY PLAN is captured so full table scans
+can be spotted.  A rolling top-N by total time is served at
+/api/debug/slow-queries.
+"""
+import re
+import sqlite3
+import threading
+
+from flask import Blueprint, jsonify, request
+
+import constants
+
+query_log_bp = Blueprint('query-log', __name__)
+
+_lock = threading.Lock()
+_statements = {}
+
+_COMMENT_RE = re.compile(r"/\*.*?\*/|--[^\n]*", re.DOTALL)
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Normalizes a SQL statement so that statements differing only in literal
+    values (including ids interpolated with f-strings) aggregate together.
+    Args:
+        sql: The SQL statement text
+    Returns:
+        normalized SQL text
+    """
+    sql = _COMMENT_RE.sub(" ", sql)
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(?...)", sql)
+    return _WHITESPACE_RE.sub(" ", sql).strip()
+
+
+def parameter_shape(parameters):
+    """
+    Describes the shape of a statement's bound parameters without their values.
+    Args:
+        parameters: sequence or mapping of bound parameters
+    Returns:
+        str such as "(str, int)" or "{name: str}"
+    """
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{name}: {type(value).__name__}"
+                               for name, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+
+def _explain(connection, sql, parameters):
+    """
+    Captures the query plan of a statement.  Uses the base sqlite3 execute so
+    the EXPLAIN itself is not timed or logged.
+    """
+    if not isinstance(connection, sqlite3.Connection):
+        return connection.explain(sql, parameters)
+    try:
+        rows = sqlite3.Connection.execute(connection, "EXPLAIN QUERY PLAN " + sql, parameters)
+        return [row[3] for row in rows.fetchall()]
+    except sqlite3.Error as error:
+        return [f"EXPLAIN QUERY PLAN failed: {error}"]
+
+
+def record(connection, sql, parameters, elapsed):
+    """
+    Records a successfully executed statement.
+    Args:
+        connection: The connection the statement was executed on
+        sql: The SQL statement text
+        parameters: The statement's bound parameters
+        elapsed: time in seconds the statement took to execute
+    """
+    normalized = normalize_sql(sql)
+    slow = elapsed * 1000 >= constants.SLOW_QUERY_THRESHOLD_MS
+
+    with _lock:
+        stats = _statements.get(normalized)
+        if stats is None:
+            if len(_statements) >= constants.SLOW_QUERY_MAX_STATEMENTS:
+                # Evict the statement with the least total time to bound memory
+                del _statements[min(_statements, key=lambda key: _statements[key]["total_seconds"])]
+            stats = _statements[normalized] = {
+                "count": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "slow_count": 0,
+                "parameter_shape": parameter_shape(parameters),
+                "query_plan": None,
+            }
+        stats["count"] += 1
+        stats["total_seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        if slow:
+            stats["slow_count"] += 1
+        capture_plan = slow and stats["query_plan"] is None
+
+    if not slow:
+        return
+
+    print(f"Slow query ({elapsed * 1000:.1f} ms, params {parameter_shape(parameters)}): {normalized}")
+    if capture_plan:
+        plan = _explain(connection, sql, parameters)
+        for step in plan:
+            print(f"    plan: {step}")
+        with _lock:
+            if normalized in _statements:
+                _statements[normalized]["query_plan"] = plan
+
+
+def top(limit):
+    """
+    Returns the statements with the most total execution time.
+    Args:
+        limit: maximum number of statements to return
+    Returns:
+        list of dicts describing each normalized statement
+    """
+    with _lock:
+        ranked = sorted(_statements.items(), key=lambda item: item[1]["total_seconds"], reverse=True)
+        return [
+            {
+                "sql":              normalized,
+                "count":            stats["count"],
+                "total_ms":         stats["total_seconds"] * 1000,
+                "avg_ms":           stats["total_seconds"] * 1000 / stats["count"],
+                "max_ms":           stats["max_seconds"] * 1000,
+                "slow_count":       stats["slow_count"],
+                "parameter_shape":  stats["parameter_shape"],
+                "query_plan":       stats["query_plan"],
+            }
+            for normalized, stats in ranked[:limit]
+        ]
+
+
+def reset():
+    """
+    Clears all recorded statements.
+    """
+    with _lock:
+        _statements.clear()
+
+
+@query_log_bp.route("/api/debug/slow-queries")
+def api_debug_slow_queries():
+    """
+    Retrieves the statements with the most total execution time.
+    Example:
+        GET /api/debug/slow-queries?limit=n
+    Returns JSON:
+      {
+        "thresholdMs": int,
+        "queries": [
+          { "sql": str, "count": int, "total_ms": float, "avg_ms": float,
+            "max_ms": float, "slow_count": int, "parameter_shape": str,
+            "query_plan": [str] or null },
+          …
+        ]
+      }
+    """
+    limit = request.args.get("limit", "")
+    limit = constants.SLOW_QUERY_TOP_N if not limit.isnumeric() else int(limit)
+
+    return jsonify({
+        "thresholdMs": constants.SLOW_QUERY_THRESHOLD_MS,
+        "queries": top(limit)
+    })
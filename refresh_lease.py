@@ -0,0 +1,219 @@
+"""
+This module lets only one refresh of a user's Last.fm data run at a time,
+across threads and processes.
+
+A refresh first takes the user's lease: a row of the RefreshLease table naming
+its owner, which expires after constants.REFRESH_LEASE_SECONDS so that a
+refresh whose process died does not block the user for good (an expired lease
+is taken over by the next refresh).  While it runs (inside holding()), the
+refresh renews the lease between its Last.fm calls (see keep()), so a slow
+refresh keeps it, and checks that it still holds it before writing; one whose
+lease was taken over stops with LeaseLost.  A refresh that finds the lease
+held waits for it to be released and then shares the finished refresh's
+result instead of refreshing again (see refresh_scheduler.refresh).  Each such wait is
+recorded in the RefreshLeaseWait table with how it ended, so lease contention
+can be reported.  These tables are created on first use.
+"""
+import contextlib
+import contextvars
+import time
+
+import constants
+import sql_query
+
+# How a wait for a lease ended: with the result of the refresh holding it, with
+# the lease released without a result and then taken, or with an expired lease
+# taken over
+WAIT_SHARED = "shared"
+WAIT_ACQUIRED = "acquired"
+WAIT_EXPIRED = "expired"
+
+_tables_ready = False
+
+# The lease held by the refresh running in this context, as a list of user id,
+# owner and when it was last renewed (see holding())
+_held = contextvars.ContextVar("refresh_lease_held", default=None)
+
+
+class LeaseLost(Exception):
+    """
+    Raised in a refresh whose lease expired and was taken over by another refresh.
+    """
+
+
+def _ensure_tables(connection):
+    global _tables_ready
+    if _tables_ready:
+        return
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS RefreshLease (
+            UserID INTEGER NOT NULL PRIMARY KEY,
+            Owner TEXT NOT NULL,
+            ExpiresAt REAL NOT NULL
+        )
+        """)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS RefreshLeaseWait (
+            WaitID INTEGER PRIMARY KEY AUTOINCREMENT,
+            UserID INTEGER NOT NULL,
+            Source TEXT NOT NULL,
+            EndedAt INTEGER NOT NULL,
+            Seconds REAL NOT NULL,
+            Outcome TEXT NOT NULL
+        )
+        """)
+    _tables_ready = True
+
+
+def acquire(user_id, owner):
+    """
+    Takes a user's lease, unless another owner holds it and it has not expired.
+    Args:
+        user_id: The numeric user id
+        owner: A name unique to this refresh
+    Returns:
+        (whether the lease was taken, whether an expired lease was taken over)
+    """
+    now = time.time()
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        previous = connection.execute(
+            "SELECT Owner, ExpiresAt FROM RefreshLease WHERE UserID = ?", (user_id,)).fetchone()
+        connection.execute(
+            """
+            INSERT INTO RefreshLease (UserID, Owner, ExpiresAt) VALUES (?, ?, ?)
+            ON CONFLICT(UserID) DO UPDATE SET Owner = excluded.Owner, ExpiresAt = excluded.ExpiresAt
+            WHERE RefreshLease.ExpiresAt < ?
+            """,
+            (user_id, owner, now + constants.REFRESH_LEASE_SECONDS, now))
+        row = connection.execute("SELECT Owner FROM RefreshLease WHERE UserID = ?", (user_id,)).fetchone()
+    finally:
+        connection.close()
+    acquired = row is not None and row["Owner"] == owner
+    return acquired, acquired and previous is not None and previous["ExpiresAt"] < now
+
+
+def renew(user_id, owner):
+    """
+    Extends a user's lease by constants.REFRESH_LEASE_SECONDS, if this owner still holds it.
+    Returns:
+        whether the owner still holds the lease
+    """
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        renewed = connection.execute(
+            "UPDATE RefreshLease SET ExpiresAt = ? WHERE UserID = ? AND Owner = ?",
+            (time.time() + constants.REFRESH_LEASE_SECONDS, user_id, owner)).rowcount
+    finally:
+        connection.close()
+    return renewed > 0
+
+
+@contextlib.contextmanager
+def holding(user_id, owner):
+    """
+    Marks a user's lease, just acquired, as held by the refresh running in
+    this context, so keep() renews it.
+    """
+    token = _held.set([user_id, owner, time.time()])
+    try:
+        yield
+    finally:
+        _held.reset(token)
+
+
+def keep(check=False):
+    """
+    Renews the lease held by the refresh running in this context (if any)
+    once a third of it has passed since it was last renewed; called between
+    Last.fm calls.
+    Args:
+        check: renew it now, to make sure it is still held before writing
+    Raises:
+        LeaseLost: if the lease was taken over by another refresh
+    """
+    lease = _held.get()
+    if lease is None:
+        return
+    user_id, owner, renewed_at = lease
+    now = time.time()
+    if not check and now - renewed_at < constants.REFRESH_LEASE_SECONDS / 3:
+        return
+    if not renew(user_id, owner):
+        raise LeaseLost(f"Refresh lease of user {user_id} was taken over")
+    lease[2] = now
+
+
+def held(user_id):
+    """
+    Determines whether a user's lease is held (and has not expired).
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        row = connection.execute(
+            "SELECT 1 FROM RefreshLease WHERE UserID = ? AND ExpiresAt >= ?", (user_id, time.time())).fetchone()
+    finally:
+        connection.close()
+    return row is not None
+
+
+def release(user_id, owner):
+    """
+    Releases a user's lease, if this owner still holds it.
+    """
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        connection.execute("DELETE FROM RefreshLease WHERE UserID = ? AND Owner = ?", (user_id, owner))
+    finally:
+        connection.close()
+
+
+def record_wait(user_id, source, seconds, outcome):
+    """
+    Records a refresh's wait for a user's lease.
+    Args:
+        user_id: The numeric user id
+        source: What the waiting refresh was made for (see refresh_scheduler.py)
+        seconds: How long it waited
+        outcome: WAIT_SHARED, WAIT_ACQUIRED or WAIT_EXPIRED
+    """
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        connection.execute(
+            "INSERT INTO RefreshLeaseWait (UserID, Source, EndedAt, Seconds, Outcome) VALUES (?, ?, ?, ?, ?)",
+            (user_id, source, int(time.time()), seconds, outcome))
+        connection.execute("DELETE FROM RefreshLeaseWait WHERE EndedAt < ?",
+                           (int(time.time()) - constants.REFRESH_LOG_MAX_AGE_SECONDS,))
+    finally:
+        connection.close()
+
+
+def contention(since):
+    """
+    Gets the leases held now and the waits for leases since a time.
+    Args:
+        since: unix time
+    Returns:
+        (number of leases held, number of those expired, list of (seconds, outcome)
+         of the waits by seconds)
+    """
+    now = time.time()
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        held_now, expired = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(CASE WHEN ExpiresAt < ? THEN 1 ELSE 0 END), 0) FROM RefreshLease",
+            (now,)).fetchone()
+        waits = connection.execute(
+            "SELECT Seconds, Outcome FROM RefreshLeaseWait WHERE EndedAt > ? ORDER BY Seconds",
+            (since,)).fetchall()
+    finally:
+        connection.close()
+    return held_now, expired, [(seconds, outcome) for seconds, outcome in waits]
@@ -0,0 +1,491 @@
+"""
+This module refreshes users' Last.fm data continuously in the background, most
+important users first, within a global budget of Last.fm calls.
+
+Every constants.REFRESH_SCHEDULER_PLAN_SECONDS the scheduler plans: users
+whose data was last checked (see refresh_state.py) at least
+constants.REFRESH_SCHEDULER_MIN_AGE_SECONDS ago, or never, are queued with a
+priority of their staleness scaled up by how recently they logged in, their
+number of followers and whether they are in the top of any leaderboard, so
+active users are refreshed first and everyone is refreshed eventually.  The
+queue is kept in the RefreshQueue table (with when each user was first
+queued), and every refresh, whether made by the scheduler or on login, is
+logged in the RefreshLog table with the Last.fm calls it made, as are the
+background batches of artist_tags.py (with UserID 0).  Scheduled refreshes
+are only started, and artist tag batches only fetch as many artists as fit,
+while the logged calls of the last constants.REFRESH_BUDGET_WINDOW_SECONDS
+are under constants.REFRESH_BUDGET_LAST_FM_CALLS, so the budget holds across
+restarts.  Login and signup refreshes are exempt: they are logged and count
+towards the budget, but never wait for it, since a user is waiting on them;
+the scheduler and tag batches make up for them by waiting longer.  These
+tables are created on first use.
+
+The scheduler runs on a background thread in every gunicorn worker (unless the
+REFRESH_SCHEDULER config value is "0"), but only the thread holding the lock
+file refreshes; the others take over if its worker exits.  It can also be run
+on its own: python refresh_scheduler.py.  Queue depth, refresh lag (from when
+a user was queued to when they were refreshed) percentiles, throughput and
+lease contention (refreshes of a user are coalesced, see refresh_lease.py)
+are exposed as JSON at /api/debug/refresh-scheduler.
+"""
+import datetime
+import fcntl
+import heapq
+import math
+import threading
+import time
+import uuid
+
+from flask import Blueprint, jsonify
+
+import app_config
+import constants
+import db_query
+import instrumentation
+import leaderboard
+import refresh_lease
+import refresh_state
+import sql_query
+
+SOURCE_SCHEDULER = "scheduler"
+SOURCE_LOGIN = "login"
+SOURCE_SIGNUP = "signup"
+SOURCE_ARTIST_TAGS = "artist-tags"
+
+refresh_scheduler_bp = Blueprint('refresh_scheduler', __name__)
+
+_tables_ready = False
+_stop = threading.Event()
+_thread = None
+
+
+def _ensure_tables(connection):
+    global _tables_ready
+    if _tables_ready:
+        return
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS RefreshQueue (
+            UserID INTEGER NOT NULL PRIMARY KEY,
+            QueuedAt INTEGER NOT NULL,
+            Priority REAL NOT NULL
+        )
+        """)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS RefreshLog (
+            RefreshID INTEGER PRIMARY KEY AUTOINCREMENT,
+            UserID INTEGER NOT NULL,
+            Source TEXT NOT NULL,
+            QueuedAt INTEGER NOT NULL,
+            FinishedAt REAL NOT NULL,
+            Seconds REAL NOT NULL,
+            LastFmCalls INTEGER NOT NULL,
+            Succeeded INTEGER NOT NULL
+        )
+        """)
+    _tables_ready = True
+
+
+def _days_since(timestamp, now):
+    """
+    Returns the number of days since a stored CURRENT_TIMESTAMP value, or None
+    if it is empty.
+    """
+    try:
+        then = datetime.datetime.strptime(str(timestamp), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    return max(0.0, (now - then.replace(tzinfo=datetime.timezone.utc).timestamp()) / 86400)
+
+
+def priority(checked_at, last_login_days, followers, on_leaderboard, now):
+    """
+    Scores a user for refreshing: their staleness in hours (capped), scaled up
+    by how recently they logged in, their followers and leaderboard presence.
+    Args:
+        checked_at: unix time their data was last checked, or None if never
+        last_login_days: days since their last login, or None if never
+        followers: their number of followers
+        on_leaderboard: whether they are in the top of any leaderboard
+        now: the current unix time
+    """
+    staleness = constants.REFRESH_SCHEDULER_MAX_STALENESS_HOURS if checked_at is None \
+        else min((now - checked_at) / 3600, constants.REFRESH_SCHEDULER_MAX_STALENESS_HOURS)
+    login = 0.0 if last_login_days is None \
+        else 0.5 ** (last_login_days / constants.REFRESH_PRIORITY_LOGIN_HALF_LIFE_DAYS)
+    return staleness * (1
+                        + constants.REFRESH_PRIORITY_LOGIN_WEIGHT * login
+                        + constants.REFRESH_PRIORITY_FOLLOWERS_WEIGHT * math.log1p(followers)
+                        + constants.REFRESH_PRIORITY_LEADERBOARD_WEIGHT * on_leaderboard)
+
+
+def plan():
+    """
+    Replaces the queue with the users due for a refresh and their priorities,
+    keeping when each user still due was first queued.
+    Returns:
+        the queue as a heap of (-priority, user id, profile name, unix time queued)
+    """
+    now = time.time()
+    due_before = now - constants.REFRESH_SCHEDULER_MIN_AGE_SECONDS
+    checked = refresh_state.last_checked()
+    on_leaderboard = {user_id for board in leaderboard.BOARDS
+                      for user_id, _ in leaderboard.top(board, constants.REFRESH_PRIORITY_LEADERBOARD_SIZE)}
+
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        users = connection.execute(
+            "SELECT UserID, LastFmProfileName, LastLogin FROM User WHERE UserID <> ?",
+            (constants.SYSTEM_ACCOUNT_ID,)).fetchall()
+        followers = dict(connection.execute(
+            "SELECT FolloweeID, COUNT(*) FROM Following GROUP BY FolloweeID").fetchall())
+        queued = dict(connection.execute("SELECT UserID, QueuedAt FROM RefreshQueue").fetchall())
+
+        queue = []
+        for user in users:
+            user_id = user["UserID"]
+            checked_at = checked.get(user_id)
+            if checked_at is not None and checked_at >= due_before:
+                continue
+            score = priority(checked_at, _days_since(user["LastLogin"], now), followers.get(user_id, 0),
+                             user_id in on_leaderboard, now)
+            queue.append((-score, user_id, user["LastFmProfileName"], queued.get(user_id, int(now))))
+
+        connection.execute("BEGIN")
+        try:
+            connection.execute("DELETE FROM RefreshQueue")
+            connection.executemany(
+                "INSERT INTO RefreshQueue (UserID, QueuedAt, Priority) VALUES (?, ?, ?)",
+                [(user_id, queued_at, -score) for score, user_id, _, queued_at in queue])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+
+    heapq.heapify(queue)
+    return queue
+
+
+def _record(user_id, source, queued_at, started, last_fm_calls, succeeded):
+    """
+    Logs a refresh and takes the user off the queue, in one transaction.
+    """
+    finished = time.time()
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        connection.execute("BEGIN")
+        connection.execute(
+            "INSERT INTO RefreshLog (UserID, Source, QueuedAt, FinishedAt, Seconds, LastFmCalls, Succeeded) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, source, queued_at, finished, finished - started, last_fm_calls, int(succeeded)))
+        connection.execute("DELETE FROM RefreshQueue WHERE UserID = ?", (user_id,))
+        connection.execute("DELETE FROM RefreshLog WHERE FinishedAt < ?",
+                           (finished - constants.REFRESH_LOG_MAX_AGE_SECONDS,))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def _result_since(user_id, since):
+    """
+    Returns the result of the last refresh of a user finished since a time
+    (exactly: FinishedAt is stored with sub-second precision), or None.
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        row = connection.execute(
+            "SELECT Succeeded, LastFmCalls FROM RefreshLog WHERE UserID = ? AND FinishedAt >= ? "
+            "ORDER BY RefreshID DESC LIMIT 1",
+            (user_id, since)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    return {"succeeded": bool(row["Succeeded"]), "shared": True, "last_fm_calls": row["LastFmCalls"]}
+
+
+def refresh(user_id, username, source, queued_at=None):
+    """
+    Refreshes a user's Last.fm data (db_query.refresh_user_data), logging the
+    refresh and the Last.fm calls it made against the budget.  Only one refresh
+    of a user runs at a time, in any process: one started while another holds
+    the user's lease (see refresh_lease.py) waits for it and returns its result.
+    Args:
+        user_id: The numeric user id
+        username: The user's last.fm profile name
+        source: SOURCE_SCHEDULER, SOURCE_LOGIN or SOURCE_SIGNUP
+        queued_at: unix time the user was queued (now if not queued)
+    Returns:
+        dict of succeeded, shared (whether the result is another refresh's)
+        and last_fm_calls
+    """
+    owner = uuid.uuid4().hex
+    waited_from = time.time()
+    waited = False
+    while True:
+        acquired, took_over = refresh_lease.acquire(user_id, owner)
+        if acquired:
+            break
+        waited = True
+        time.sleep(constants.REFRESH_LEASE_POLL_SECONDS)
+        if not refresh_lease.held(user_id):
+            result = _result_since(user_id, waited_from)
+            if result is not None:
+                refresh_lease.record_wait(user_id, source, time.time() - waited_from, refresh_lease.WAIT_SHARED)
+                return result
+    if waited or took_over:
+        refresh_lease.record_wait(user_id, source, time.time() - waited_from,
+                                  refresh_lease.WAIT_EXPIRED if took_over else refresh_lease.WAIT_ACQUIRED)
+
+    started = time.time()
+    queued_at = queued_at or int(started)
+    try:
+        with instrumentation.counting() as counters, refresh_lease.holding(user_id, owner):
+            try:
+                db_query.refresh_user_data(username)
+                # A refresh whose lease was taken over does not report success
+                refresh_lease.keep(check=True)
+            except Exception:
+                _record(user_id, source, queued_at, started, counters["last_fm_calls"], False)
+                raise
+        _record(user_id, source, queued_at, started, counters["last_fm_calls"], True)
+    finally:
+        refresh_lease.release(user_id, owner)
+    return {"succeeded": True, "shared": False, "last_fm_calls": counters["last_fm_calls"]}
+
+
+def log_calls(source, started, last_fm_calls):
+    """
+    Logs Last.fm calls made outside a user's refresh (e.g. a batch of artist
+    tag fetches) so they count towards the budget.
+    Args:
+        source: What the calls were made for (e.g. SOURCE_ARTIST_TAGS)
+        started: unix time the calls started
+        last_fm_calls: The number of calls made
+    """
+    _record(0, source, int(started), started, last_fm_calls, True)
+
+
+def _budget_rows(now):
+    """
+    Returns (finished at, Last.fm calls) of the refreshes logged in the budget window.
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        return connection.execute(
+            "SELECT FinishedAt, LastFmCalls FROM RefreshLog WHERE FinishedAt > ? ORDER BY FinishedAt",
+            (now - constants.REFRESH_BUDGET_WINDOW_SECONDS,)).fetchall()
+    finally:
+        connection.close()
+
+
+def budget_remaining():
+    """
+    Returns how many Last.fm calls are left in the budget window (0 if none).
+    """
+    return max(0, constants.REFRESH_BUDGET_LAST_FM_CALLS
+               - sum(calls for _, calls in _budget_rows(time.time())))
+
+
+def budget_wait():
+    """
+    Returns how many seconds to wait before the logged Last.fm calls of the
+    budget window are under the budget again (0 if they are).
+    """
+    now = time.time()
+    rows = _budget_rows(now)
+
+    excess = sum(calls for _, calls in rows) - constants.REFRESH_BUDGET_LAST_FM_CALLS + 1
+    for finished_at, calls in rows:
+        if excess <= 0:
+            break
+        excess -= calls
+        if excess <= 0:
+            return max(1.0, finished_at + constants.REFRESH_BUDGET_WINDOW_SECONDS - now)
+    return 0.0
+
+
+def run(stop):
+    """
+    Refreshes queued users, highest priority first and within the Last.fm
+    budget, replanning the queue periodically, until stop is set.
+    Args:
+        stop: a threading.Event
+    """
+    queue = []
+    planned = None
+    while not stop.is_set():
+        if planned is None or time.monotonic() - planned >= constants.REFRESH_SCHEDULER_PLAN_SECONDS:
+            queue = plan()
+            planned = time.monotonic()
+        if not queue:
+            stop.wait(constants.REFRESH_SCHEDULER_PLAN_SECONDS)
+            continue
+        wait = budget_wait()
+        if wait > 0:
+            stop.wait(wait)
+            continue
+        _, user_id, username, queued_at = heapq.heappop(queue)
+        try:
+            refresh(user_id, username, SOURCE_SCHEDULER, queued_at)
+        except Exception as error:  # pylint: disable=broad-except
+            print(f"Scheduled refresh of {username} failed: {error!r}")
+
+
+def _run_with_lock():
+    """
+    Runs the scheduler while holding the lock file, waiting for the lock while
+    another process holds it.
+    """
+    while not _stop.is_set():
+        with open(constants.REFRESH_SCHEDULER_LOCK_PATH, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                try:
+                    run(_stop)
+                except Exception as error:  # pylint: disable=broad-except
+                    print(f"Refresh scheduler stopped: {error!r}")
+        _stop.wait(constants.REFRESH_SCHEDULER_PLAN_SECONDS)
+
+
+def start():
+    """
+    Starts the scheduler thread of this process, unless the REFRESH_SCHEDULER
+    config value is "0"; called in a new gunicorn worker (see gunicorn.conf.py).
+    """
+    global _thread
+    if app_config.get("REFRESH_SCHEDULER", "1") != "1" or _thread is not None:
+        return
+    _thread = threading.Thread(target=_run_with_lock, name="broadcastr-refresh-scheduler", daemon=True)
+    _thread.start()
+
+
+def stop():
+    """
+    Stops the scheduler thread of this process after its current refresh.
+    """
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+    _thread = None
+    _stop.clear()
+
+
+def reset_after_fork():
+    """
+    Resets the scheduler state inherited from the master process; called in a
+    new gunicorn worker (see gunicorn.conf.py).
+    """
+    global _stop, _thread
+    _stop = threading.Event()
+    _thread = None
+
+
+#################################################
+#   Reporting                                    #
+#################################################
+
+def _percentile(values, fraction):
+    """
+    Returns a percentile of sorted values (nearest rank), or None if there are none.
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def stats():
+    """
+    Returns a JSON-serializable summary of the queue and of the refreshes
+    logged in the last constants.REFRESH_STATS_WINDOW_SECONDS.
+    """
+    now = int(time.time())
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        depth, oldest = connection.execute("SELECT COUNT(*), MIN(QueuedAt) FROM RefreshQueue").fetchone()
+        rows = connection.execute(
+            "SELECT Source, QueuedAt, FinishedAt, LastFmCalls, Succeeded FROM RefreshLog WHERE FinishedAt > ?",
+            (now - max(constants.REFRESH_STATS_WINDOW_SECONDS, constants.REFRESH_BUDGET_WINDOW_SECONDS),)).fetchall()
+    finally:
+        connection.close()
+    leases, expired, waits = refresh_lease.contention(now - constants.REFRESH_STATS_WINDOW_SECONDS)
+
+    recent = [row for row in rows if row["FinishedAt"] > now - constants.REFRESH_STATS_WINDOW_SECONDS]
+    waited = [seconds for seconds, _ in waits]
+    lags = sorted(row["FinishedAt"] - row["QueuedAt"] for row in recent if row["Source"] == SOURCE_SCHEDULER)
+    minutes = constants.REFRESH_STATS_WINDOW_SECONDS / 60
+    return {
+        "queue_depth":          depth,
+        "oldest_queued_seconds": now - oldest if oldest is not None else None,
+        "window_seconds":       constants.REFRESH_STATS_WINDOW_SECONDS,
+        "refreshes":            {source: sum(1 for row in recent if row["Source"] == source)
+                                 for source in (SOURCE_SCHEDULER, SOURCE_LOGIN, SOURCE_SIGNUP, SOURCE_ARTIST_TAGS)},
+        "failed":               sum(1 for row in recent if not row["Succeeded"]),
+        "refreshes_per_minute": len(recent) / minutes,
+        "last_fm_calls_per_minute": sum(row["LastFmCalls"] for row in recent) / minutes,
+        "lag_p50":              _percentile(lags, 0.50),
+        "lag_p95":              _percentile(lags, 0.95),
+        "lag_p99":              _percentile(lags, 0.99),
+        "lag_max":              lags[-1] if lags else None,
+        "budget": {
+            "last_fm_calls":    constants.REFRESH_BUDGET_LAST_FM_CALLS,
+            "window_seconds":   constants.REFRESH_BUDGET_WINDOW_SECONDS,
+            "used":             sum(row["LastFmCalls"] for row in rows
+                                    if row["FinishedAt"] > now - constants.REFRESH_BUDGET_WINDOW_SECONDS),
+        },
+        "leases": {
+            "held":             leases - expired,
+            "expired":          expired,
+            "waits":            {outcome: sum(1 for _, ended in waits if ended == outcome)
+                                 for outcome in (refresh_lease.WAIT_SHARED, refresh_lease.WAIT_ACQUIRED,
+                                                 refresh_lease.WAIT_EXPIRED)},
+            "wait_p50":         _percentile(waited, 0.50),
+            "wait_p95":         _percentile(waited, 0.95),
+            "wait_max":         waited[-1] if waited else None,
+        },
+    }
+
+
+@refresh_scheduler_bp.route("/api/debug/refresh-scheduler")
+def api_debug_refresh_scheduler():
+    """
+    Exposes the background refresh scheduler's queue and throughput as JSON.
+    Example:
+        GET /api/debug/refresh-scheduler
+    Returns JSON:
+      {
+        "queue_depth": int, "oldest_queued_seconds": int,
+        "refreshes": { "scheduler": int, "login": int, "signup": int, "artist-tags": int }, "failed": int,
+        "refreshes_per_minute": float, "last_fm_calls_per_minute": float,
+        "lag_p50": int, "lag_p95": int, "lag_p99": int, "lag_max": int,
+        "budget": { "last_fm_calls": int, "window_seconds": int, "used": int },
+        "leases": { "held": int, "expired": int,
+                    "waits": { "shared": int, "acquired": int, "expired": int },
+                    "wait_p50": float, "wait_p95": float, "wait_max": float },
+        …
+      }
+      (lags are seconds from queueing to refresh; rates and lease waits cover
+      window_seconds; see refresh_lease.py for the wait outcomes)
+    """
+    return jsonify(stats())
+
+
+if __name__ == "__main__":
+    # Run the scheduler in the foreground: python refresh_scheduler.py
+    _stop.clear()
+    _run_with_lock()
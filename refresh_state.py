@@ -0,0 +1,157 @@
+"""
+This module records, per user, what the last refresh of their Last.fm data
+saw, so that refreshes can skip work that would change nothing.
+
+The UserRefreshState table holds one row per user: when their data was last
+checked (CheckedAt, the time of the last refresh's user.getinfo call), when
+their top data was last refreshed in full (RefreshedAt), and their Last.fm
+playcount at that refresh.  A user whose playcount has not moved has not
+scrobbled, so their top data is only refreshed again once it is
+constants.REFRESH_IDLE_MAX_DAYS old (windowed periods still slide), and
+checking them costs that single user.getinfo call.
+
+The TopDataHash table holds a hash of the rows last stored for each user,
+kind ("artist", "album" or "track") and period, so a refresh can tell which
+periods changed without reading the stored rows back.  Both tables are
+created on first use.
+"""
+import hashlib
+import json
+import time
+
+import constants
+import sql_query
+
+_tables_ready = False
+
+
+def _ensure_tables(connection):
+    global _tables_ready
+    if _tables_ready:
+        return
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS UserRefreshState (
+            UserID INTEGER NOT NULL PRIMARY KEY,
+            CheckedAt INTEGER NOT NULL,
+            RefreshedAt INTEGER NOT NULL,
+            Playcount INTEGER
+        )
+        """)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS TopDataHash (
+            UserID INTEGER NOT NULL,
+            Kind TEXT NOT NULL,
+            PeriodID INTEGER NOT NULL,
+            Hash TEXT NOT NULL,
+            PRIMARY KEY (UserID, Kind, PeriodID)
+        ) WITHOUT ROWID
+        """)
+    _tables_ready = True
+
+
+def content_hash(entries):
+    """
+    Returns a hash of top data rows, as compared by refreshes.
+    Args:
+        entries: list of (name, artist name, playcount), sorted
+    """
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+def due(user_id):
+    """
+    Determines whether a user's data is due for a refresh: it never was, or
+    was last checked more than constants.REFRESH_DAYS days ago.
+    Returns:
+        Boolean indicating whether or not the refresh is due.
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        row = connection.execute(
+            "SELECT CheckedAt FROM UserRefreshState WHERE UserID = ?", (user_id,)).fetchone()
+    finally:
+        connection.close()
+    return row is None or row["CheckedAt"] < time.time() - float(constants.REFRESH_DAYS) * 86400
+
+
+def last_checked():
+    """
+    Gets when every user's data was last checked.
+    Returns:
+        dict of unix time by user id (users never refreshed are missing)
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        return dict(connection.execute("SELECT UserID, CheckedAt FROM UserRefreshState").fetchall())
+    finally:
+        connection.close()
+
+
+def load(user_id):
+    """
+    Gets what a user's last refresh saw.
+    Returns:
+        (playcount (None if never refreshed or unknown), unix time of the last
+         full refresh (None if never), dict of hash by (kind, period id))
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        row = connection.execute(
+            "SELECT RefreshedAt, Playcount FROM UserRefreshState WHERE UserID = ?", (user_id,)).fetchone()
+        hashes = connection.execute(
+            "SELECT Kind, PeriodID, Hash FROM TopDataHash WHERE UserID = ?", (user_id,)).fetchall()
+    finally:
+        connection.close()
+    if row is None:
+        return None, None, {}
+    return row["Playcount"], row["RefreshedAt"], {(kind, periodid): value for kind, periodid, value in hashes}
+
+
+def record_check(user_id):
+    """
+    Records that a user's data was checked, without a full refresh.
+    """
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        connection.execute("UPDATE UserRefreshState SET CheckedAt = ? WHERE UserID = ?",
+                           (int(time.time()), user_id))
+    finally:
+        connection.close()
+
+
+def record_refresh(user_id, playcount, hashes):
+    """
+    Records a full refresh of a user's data, in one transaction.
+    Args:
+        user_id: The numeric user id
+        playcount: The user's Last.fm playcount (None if unknown)
+        hashes: dict of hash by (kind, period id) of the rows now stored
+    """
+    now = int(time.time())
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        connection.execute("BEGIN")
+        connection.execute(
+            """
+            INSERT INTO UserRefreshState (UserID, CheckedAt, RefreshedAt, Playcount) VALUES (?, ?, ?, ?)
+            ON CONFLICT(UserID) DO UPDATE SET
+                CheckedAt = excluded.CheckedAt, RefreshedAt = excluded.RefreshedAt, Playcount = excluded.Playcount
+            """,
+            (user_id, now, now, playcount))
+        connection.execute("DELETE FROM TopDataHash WHERE UserID = ?", (user_id,))
+        connection.executemany(
+            "INSERT INTO TopDataHash (UserID, Kind, PeriodID, Hash) VALUES (?, ?, ?, ?)",
+            [(user_id, kind, periodid, value) for (kind, periodid), value in hashes.items()])
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
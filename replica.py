@@ -0,0 +1,281 @@
+"""
+This module provides a read-only replica of the SQLite database for GET requests.
+
+Enabled by setting the READ_REPLICA_DB environment variable to the path of the
+replica file (SQLite backend only).  The replica is a snapshot of the primary
+database copied with the SQLite backup API; it is refreshed in the background
+once it is older than half of the maximum lag (READ_REPLICA_MAX_LAG_SECONDS,
+defaulting to constants.READ_REPLICA_MAX_LAG_SECONDS), by whichever process
+notices first.  The primary is switched to WAL journaling so taking a snapshot
+does not block writers.
+
+GET requests read from the replica, except on READ_YOUR_WRITES_PATHS (routes a
+user reads right after writing, such as their conversations) and whenever the
+replica is older than the maximum lag.  Routes tagged with data_version scopes
+(response_cache.cached, http_cache.conditional) also read from the primary
+when a tag was bumped after the snapshot was taken, so a write is visible to
+the next read in any worker.  Writes always go to the primary.  The lag is
+reported in an X-Replica-Lag header on responses read from the replica and
+at /api/debug/replica.
+"""
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+from flask import Blueprint, jsonify, request
+
+import constants
+import sql_query
+import storage
+
+# GET routes whose readers expect to see their own writes immediately
+READ_YOUR_WRITES_PATHS = (
+    "/api/user/conversations",
+    "/api/user/direct-messages",
+    "/api/get-song-swaps",
+    "/api/find-song-swap-match",
+)
+
+replica_bp = Blueprint('replica', __name__)
+
+_lock = threading.Lock()
+_current = threading.local()
+_refreshing = False
+_versions = (None, {})      # (snapshot time, {scope: version}) of the replica's DataVersion rows
+_stats = {"replica_requests": 0, "primary_requests": 0, "stale_fallbacks": 0, "version_fallbacks": 0,
+          "snapshots": 0, "last_snapshot_seconds": 0.0, "snapshot_errors": 0}
+
+
+def replica_path():
+    """
+    Returns the path of the replica database, or "" when the replica is disabled.
+    """
+    if storage.backend() != storage.BACKEND_SQLITE:
+        return ""
+    return os.getenv("READ_REPLICA_DB", "")
+
+
+def max_lag():
+    """
+    Returns the maximum age, in seconds, of a snapshot that reads may be served from.
+    """
+    return float(os.getenv("READ_REPLICA_MAX_LAG_SECONDS", str(constants.READ_REPLICA_MAX_LAG_SECONDS)))
+
+
+def snapshot_time():
+    """
+    Returns the time (epoch seconds) the current snapshot was taken, or None if there is none.
+    """
+    try:
+        return os.stat(replica_path()).st_mtime
+    except OSError:
+        return None
+
+
+def lag():
+    """
+    Returns the age of the current snapshot in seconds, or None if there is none.
+    """
+    taken = snapshot_time()
+    return None if taken is None else max(0.0, time.time() - taken)
+
+
+#################################################
+#   Snapshots                                    #
+#################################################
+
+def refresh(force=False):
+    """
+    Takes a new snapshot of the primary database, unless another process is
+    taking one or (without force) the current one is younger than half the
+    maximum lag.  The snapshot is written to a temporary file and renamed over
+    the replica, so connections already open keep reading the previous one.
+    Returns:
+        True if a snapshot was taken
+    """
+    path = replica_path()
+    if not path:
+        return False
+    with open(path + ".lock", "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        age = lag()
+        if not force and age is not None and age < max_lag() / 2:
+            return False
+
+        started = time.time()
+        temporary = f"{path}.{os.getpid()}.tmp"
+        source = sqlite3.connect(sql_query.BROADCASTR_DB)
+        target = sqlite3.connect(temporary)
+        try:
+            source.execute("PRAGMA journal_mode=WAL")
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        os.utime(temporary, (started, started))
+        os.replace(temporary, path)
+
+    with _lock:
+        _stats["snapshots"] += 1
+        _stats["last_snapshot_seconds"] = time.time() - started
+    return True
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        refresh()
+    except (OSError, sqlite3.Error) as error:
+        print(f"Read replica snapshot failed: {error!r}")
+        with _lock:
+            _stats["snapshot_errors"] += 1
+    finally:
+        _refreshing = False
+
+
+def _maybe_refresh(age):
+    """
+    Starts a background snapshot if the replica is missing or past half the maximum lag.
+    """
+    global _refreshing
+    if age is not None and age < max_lag() / 2:
+        return
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    threading.Thread(target=_refresh_in_background, name="broadcastr-replica", daemon=True).start()
+
+
+def _replica_versions():
+    """
+    Returns the DataVersion rows of the current snapshot, loaded once per snapshot.
+    """
+    global _versions
+    taken = snapshot_time()
+    loaded_for, versions = _versions
+    if taken != loaded_for:
+        connection = sqlite3.connect(_read_only_uri(replica_path()), uri=True)
+        try:
+            versions = dict(connection.execute("SELECT Scope, Version FROM DataVersion"))
+        except sqlite3.OperationalError:    # no scope bumped yet when the snapshot was taken
+            versions = {}
+        finally:
+            connection.close()
+        _versions = (taken, versions)
+    return versions
+
+
+def _read_only_uri(path):
+    return f"file:{quote(os.path.abspath(path))}?mode=ro"
+
+
+#################################################
+#   Routing                                      #
+#################################################
+
+def read_database():
+    """
+    Returns the database (a sqlite3.connect argument, and whether it is a uri)
+    that reads on this thread should use: the replica during a GET request
+    routed to it, else the primary.
+    """
+    state = getattr(_current, "state", None)
+    if state is None or not state["replica"]:
+        return sql_query.BROADCASTR_DB, False
+
+    age = lag()
+    _maybe_refresh(age)
+    if age is None or age > max_lag():
+        state["replica"] = False
+        with _lock:
+            _stats["stale_fallbacks"] += 1
+        return sql_query.BROADCASTR_DB, False
+
+    state["lag"] = age
+    return _read_only_uri(replica_path()), True
+
+
+def check_versions(scopes, versions):
+    """
+    Sends the rest of the request to the primary if any of the given
+    data_version scopes is newer there than in the replica.
+    Args:
+        scopes: data_version scopes the response depends on
+        versions: their current versions (on the primary)
+    """
+    state = getattr(_current, "state", None)
+    if state is None or not state["replica"] or snapshot_time() is None:
+        return
+    replica_versions = _replica_versions()
+    if any(replica_versions.get(scope, 0) != version for scope, version in zip(scopes, versions)):
+        state["replica"] = False
+        with _lock:
+            _stats["version_fallbacks"] += 1
+
+
+def _start_request():
+    routed = request.method == "GET" and request.path not in READ_YOUR_WRITES_PATHS and bool(replica_path())
+    _current.state = {"replica": routed, "lag": None}
+
+
+def _record_lag(response):
+    state = getattr(_current, "state", None)
+    if state is not None and state["lag"] is not None:
+        response.headers["X-Replica-Lag"] = f"{state['lag']:.3f}"
+    return response
+
+
+def _finish_request(_exception=None):
+    state = getattr(_current, "state", None)
+    _current.state = None
+    if state is None or not replica_path():
+        return
+    with _lock:
+        _stats["replica_requests" if state["lag"] is not None else "primary_requests"] += 1
+
+
+def init_app(app):
+    """
+    Installs the request routing hooks and the replica status route on a Flask app.
+    """
+    app.before_request(_start_request)
+    app.after_request(_record_lag)
+    app.teardown_request(_finish_request)
+    app.register_blueprint(replica_bp, url_prefix='/')
+
+
+def reset_after_fork():
+    """
+    Resets the refresh state inherited from the master process; called in a
+    new gunicorn worker (see gunicorn.conf.py).
+    """
+    global _lock, _refreshing, _versions
+    _lock = threading.Lock()
+    _refreshing = False
+    _versions = (None, {})
+    for key in _stats:
+        _stats[key] = 0.0 if key == "last_snapshot_seconds" else 0
+
+
+@replica_bp.route("/api/debug/replica")
+def api_debug_replica():
+    """
+    Reports the read replica's status.
+    Example:
+        GET /api/debug/replica
+    Returns:
+        200 Success: whether the replica is enabled, its lag and maximum lag in
+                     seconds, and how many GET requests this process served from
+                     the replica and the primary (and why)
+    """
+    with _lock:
+        stats = dict(_stats)
+    return jsonify(dict(stats, enabled=bool(replica_path()), lag_seconds=lag() if replica_path() else None,
+                        max_lag_seconds=max_lag()))
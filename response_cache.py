@@ -0,0 +1,276 @@
+"""
+This module provides a read-through cache for hot GET endpoints.
+
+A route decorated with cached() names the data_version scopes (tags) its
+response depends on.  Responses are cached under the route, its normalized
+query arguments and the current versions of those tags, so a write that bumps
+a tag (in any worker) makes every response tagged with it unreachable; bumps
+made in this process also evict them immediately.
+
+There are two tiers: an in-process LRU, and an optional SQLite-backed tier
+shared by all gunicorn workers on a host (enabled with the
+RESPONSE_CACHE_SHARED config value or environment variable).  Hit rates per
+route are reported at /api/debug/response-cache.
+"""
+import functools
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, Response, jsonify, make_response, request
+
+import app_config
+import constants
+import data_version
+import replica
+
+response_cache_bp = Blueprint('response-cache', __name__)
+
+_lock = threading.Lock()
+_entries = OrderedDict()     # cache key -> (tags, expires at, status, mimetype, body)
+_entry_bytes = 0
+_stats = {}
+_shared_local = threading.local()
+_shared_writes = 0
+
+
+def _route_stats(route):
+    return _stats.setdefault(route, {"memory_hits": 0, "shared_hits": 0, "misses": 0, "uncacheable": 0})
+
+
+def _cache_key(route, tags, versions):
+    digest = hashlib.sha1(route.encode())
+    for key, value in sorted(request.args.items(multi=True)):
+        digest.update(f"\0{key}={value}".encode())
+    digest.update(f"\0{tags}\0{versions}".encode())
+    return digest.hexdigest()
+
+
+#################################################
+#   In-process LRU tier                          #
+#################################################
+
+def _memory_get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            _memory_remove(key)
+            return None
+        _entries.move_to_end(key)
+        return entry
+
+
+def _memory_remove(key):
+    global _entry_bytes
+    entry = _entries.pop(key, None)
+    if entry is not None:
+        _entry_bytes -= len(entry[4])
+
+
+def _memory_put(key, entry):
+    global _entry_bytes
+    with _lock:
+        _memory_remove(key)
+        _entries[key] = entry
+        _entry_bytes += len(entry[4])
+        while _entries and (len(_entries) > constants.RESPONSE_CACHE_MAX_ENTRIES
+                            or _entry_bytes > constants.RESPONSE_CACHE_MAX_BYTES):
+            _memory_remove(next(iter(_entries)))
+
+
+#################################################
+#   Shared SQLite tier                           #
+#################################################
+
+def _shared_enabled():
+    return app_config.get("RESPONSE_CACHE_SHARED", "0") == "1"
+
+
+def _shared_connection():
+    """
+    Returns this thread's connection to the shared cache database.
+    """
+    connection = getattr(_shared_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(constants.RESPONSE_CACHE_DB, timeout=1, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ResponseCache (
+                CacheKey TEXT NOT NULL PRIMARY KEY,
+                Tags TEXT NOT NULL,
+                ExpiresAt REAL NOT NULL,
+                Status INTEGER NOT NULL,
+                Mimetype TEXT NOT NULL,
+                Body BLOB NOT NULL
+            )
+            """)
+        _shared_local.connection = connection
+    return connection
+
+
+def _shared_get(key):
+    try:
+        row = _shared_connection().execute(
+            "SELECT Tags, ExpiresAt, Status, Mimetype, Body FROM ResponseCache "
+            "WHERE CacheKey = ? AND ExpiresAt > ?",
+            (key, time.time())).fetchone()
+    except sqlite3.Error as error:
+        print(f"Shared response cache read failed: {error}")
+        return None
+    if row is None:
+        return None
+    return (tuple(row[0].strip(",").split(",")), row[1], row[2], row[3], bytes(row[4]))
+
+
+def _shared_put(key, entry):
+    global _shared_writes
+    tags, expires_at, status, mimetype, body = entry
+    try:
+        connection = _shared_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO ResponseCache (CacheKey, Tags, ExpiresAt, Status, Mimetype, Body) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, "," + ",".join(tags) + ",", expires_at, status, mimetype, body))
+        _shared_writes += 1
+        if _shared_writes % constants.RESPONSE_CACHE_SHARED_PURGE_EVERY == 0:
+            connection.execute("DELETE FROM ResponseCache WHERE ExpiresAt <= ?", (time.time(),))
+    except sqlite3.Error as error:
+        print(f"Shared response cache write failed: {error}")
+
+
+#################################################
+#   Invalidation                                 #
+#################################################
+
+def invalidate(scopes):
+    """
+    Evicts cached responses tagged with any of the given scopes.  Called by
+    data_version whenever this process bumps scopes; responses cached by other
+    workers are already unreachable because their keys include the versions.
+    """
+    scopes = set(scopes)
+    with _lock:
+        for key in [key for key, entry in _entries.items() if scopes.intersection(entry[0])]:
+            _memory_remove(key)
+    if _shared_enabled():
+        try:
+            connection = _shared_connection()
+            for scope in scopes:
+                connection.execute("DELETE FROM ResponseCache WHERE Tags LIKE ?", (f"%,{scope},%",))
+        except sqlite3.Error as error:
+            print(f"Shared response cache invalidation failed: {error}")
+
+
+data_version.on_bump(invalidate)
+
+
+def reset_after_fork():
+    """
+    Drops the parent process's shared cache connection (SQLite connections
+    must not be used across a fork) and statistics; called in a new gunicorn
+    worker (see gunicorn.conf.py).
+    """
+    global _lock, _shared_local
+    _lock = threading.Lock()
+    _shared_local = threading.local()
+    _stats.clear()
+
+
+def clear():
+    """
+    Empties both cache tiers and resets the statistics.
+    """
+    global _entry_bytes
+    with _lock:
+        _entries.clear()
+        _entry_bytes = 0
+        _stats.clear()
+    if _shared_enabled():
+        _shared_connection().execute("DELETE FROM ResponseCache")
+
+
+#################################################
+#   Decorator                                    #
+#################################################
+
+def cached(tags, ttl=None):
+    """
+    Decorates a GET route so its successful responses are served from the cache.
+    Args:
+        tags: function of the request args returning the data_version scopes
+              the response depends on
+        ttl: seconds an entry may be served for even if no tag is bumped
+             (defaults to constants.RESPONSE_CACHE_TTL_SECONDS)
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            route = request.url_rule.rule if request.url_rule is not None else request.path
+            entry_tags = tuple(tags(request.args))
+            versions, _ = data_version.current(*entry_tags)
+            replica.check_versions(entry_tags, versions)
+            key = _cache_key(route, entry_tags, versions)
+
+            entry = _memory_get(key)
+            tier = "memory_hits"
+            if entry is None and _shared_enabled():
+                entry = _shared_get(key)
+                tier = "shared_hits"
+                if entry is not None:
+                    _memory_put(key, entry)
+            if entry is not None:
+                with _lock:
+                    _route_stats(route)[tier] += 1
+                return Response(entry[4], status=entry[2], mimetype=entry[3])
+
+            response = make_response(view(*args, **kwargs))
+            cacheable = response.status_code == 200 and not response.is_streamed
+            with _lock:
+                _route_stats(route)["misses" if cacheable else "uncacheable"] += 1
+            if cacheable:
+                entry = (entry_tags, time.time() + (ttl or constants.RESPONSE_CACHE_TTL_SECONDS),
+                         response.status_code, response.mimetype, response.get_data())
+                _memory_put(key, entry)
+                if _shared_enabled():
+                    _shared_put(key, entry)
+            return response
+        return wrapper
+    return decorator
+
+
+def stats():
+    """
+    Returns hit rates per route and the size of the in-process tier.
+    """
+    with _lock:
+        routes = {}
+        for route, counts in sorted(_stats.items()):
+            lookups = counts["memory_hits"] + counts["shared_hits"] + counts["misses"]
+            routes[route] = dict(counts, hit_rate=(counts["memory_hits"] + counts["shared_hits"]) / lookups
+                                 if lookups else 0.0)
+        return {"routes": routes, "entries": len(_entries), "bytes": _entry_bytes,
+                "shared": _shared_enabled()}
+
+
+@response_cache_bp.route("/api/debug/response-cache")
+def api_debug_response_cache():
+    """
+    Reports response cache hit rates per route.
+    Example:
+        GET /api/debug/response-cache
+    Returns JSON:
+      {
+        "routes": {
+          "/api/get-broadcasts": { "memory_hits": int, "shared_hits": int,
+            "misses": int, "uncacheable": int, "hit_rate": float },
+          …
+        },
+        "entries": int, "bytes": int, "shared": bool
+      }
+    """
+    return jsonify(stats())
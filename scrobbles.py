@@ -0,0 +1,339 @@
+"""
+This module stores users' scrobbles (individual plays fetched from Last.fm's
+user.getrecenttracks, see db_query.ingest_scrobbles) and aggregates them over
+rolling windows of days.
+
+Scrobbles are appended to the Scrobble table, one compact row per play keyed
+by (UserID, PlayedAt, TrackID) so a play fetched twice is stored once.  Each
+append also rebuilds the per-day playcount buckets of the days it touched
+(ScrobbleArtistDay and ScrobbleTrackDay, one row per user, UTC day and artist
+or track), which every aggregate is computed from: a window is a range of
+days, so summing the buckets answers any period (the PeriodWindow view gives
+each Period its length in days) or any number of days.  window_sums() sums
+many windows in one pass over a user's buckets, which is how rollup()
+materializes the TopArtist/TopTrack rows of every period at once.
+
+The ScrobbleWatermark table records, per user, the newest and oldest play
+stored and whether the history reaches back to the user's first scrobble; a
+window can only be computed once the history covers it (see covers()).  All
+of these tables, and the view, are created on first use.
+"""
+import time
+
+import constants
+import sql_query
+
+SECONDS_PER_DAY = 86400
+
+# Per-day bucket table and id column of each kind of item aggregated
+_BUCKETS = {
+    "artist": ("ScrobbleArtistDay", "ArtistID"),
+    "track": ("ScrobbleTrackDay", "TrackID"),
+}
+
+_TOP_SQL = {
+    "artist": """
+        SELECT Artist.ArtistID AS id, Artist.ArtistName AS name, SUM(Bucket.Playcount) AS scrobbles
+        FROM ScrobbleArtistDay AS Bucket
+        JOIN Artist ON Bucket.ArtistID = Artist.ArtistID
+        {window_join}
+        WHERE Bucket.UserID = ? AND {window}
+        GROUP BY Artist.ArtistID, Artist.ArtistName
+        ORDER BY scrobbles DESC, id
+        LIMIT ?
+        """,
+    "track": """
+        SELECT Track.TrackID AS id, Track.TrackName AS track, Artist.ArtistName AS artist,
+               SUM(Bucket.Playcount) AS playcount, Track.LastFmTrackUrl AS lastfmtrackurl
+        FROM ScrobbleTrackDay AS Bucket
+        JOIN Track ON Bucket.TrackID = Track.TrackID
+        JOIN Artist ON Track.ArtistID = Artist.ArtistID
+        {window_join}
+        WHERE Bucket.UserID = ? AND {window}
+        GROUP BY Track.TrackID, Track.TrackName, Artist.ArtistName, Track.LastFmTrackUrl
+        ORDER BY playcount DESC, id
+        LIMIT ?
+        """,
+}
+
+_tables_ready = False
+
+
+def _ensure_tables(connection):
+    global _tables_ready
+    if _tables_ready:
+        return
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS Scrobble (
+            UserID INTEGER NOT NULL,
+            PlayedAt INTEGER NOT NULL,
+            TrackID INTEGER NOT NULL,
+            ArtistID INTEGER NOT NULL,
+            PRIMARY KEY (UserID, PlayedAt, TrackID)
+        ) WITHOUT ROWID
+        """)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ScrobbleWatermark (
+            UserID INTEGER NOT NULL PRIMARY KEY,
+            NewestPlayedAt INTEGER NOT NULL,
+            OldestPlayedAt INTEGER NOT NULL,
+            HistoryComplete INTEGER NOT NULL,
+            LastIngested TEXT NOT NULL
+        )
+        """)
+    for table, column in _BUCKETS.values():
+        connection.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                UserID INTEGER NOT NULL,
+                Day INTEGER NOT NULL,
+                {column} INTEGER NOT NULL,
+                Playcount INTEGER NOT NULL,
+                PRIMARY KEY (UserID, Day, {column})
+            ) WITHOUT ROWID
+            """)
+    days = " ".join(f"WHEN '{period}' THEN {length}" for period, length in constants.PERIOD_DAYS.items())
+    connection.execute(
+        f"""
+        CREATE VIEW IF NOT EXISTS PeriodWindow AS
+        SELECT PeriodID, PeriodName, CASE PeriodName {days} END AS Days
+        FROM Period
+        """)
+    _tables_ready = True
+
+
+def period_days(period):
+    """
+    Returns the length in days of a period's window, or None for "overall".
+    """
+    return None if period == "overall" else constants.PERIOD_DAYS[period]
+
+
+def _first_day(days, now=None):
+    """
+    Returns the first day (days since the epoch, UTC) of a window of days
+    ending today, or 0 for a window of all days (None).
+    """
+    if days is None:
+        return 0
+    return int(now or time.time()) // SECONDS_PER_DAY - days + 1
+
+
+def watermark(user_id):
+    """
+    Gets how far a user's stored scrobble history reaches.
+    Returns:
+        (newest unix time stored, oldest unix time stored, whether the history is complete),
+        or (None, None, False) if no scrobbles were ingested for the user
+    """
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        _ensure_tables(connection)
+        row = connection.execute(
+            "SELECT NewestPlayedAt, OldestPlayedAt, HistoryComplete FROM ScrobbleWatermark WHERE UserID = ?",
+            (user_id,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None, None, False
+    return row["NewestPlayedAt"], row["OldestPlayedAt"], bool(row["HistoryComplete"])
+
+
+def covers(history, days, now=None):
+    """
+    Returns whether a stored history (as returned by watermark()) holds every
+    play of a window of days ending today (None for all days).
+    """
+    _, oldest, complete = history
+    return complete or (oldest is not None and days is not None
+                        and oldest <= _first_day(days, now) * SECONDS_PER_DAY)
+
+
+def append(user_id, plays, history):
+    """
+    Appends plays to a user's scrobbles, storing their tracks and artists if
+    new (in bulk, see sql_query.resolve_top_data_ids), rebuilds the buckets of
+    the days they fall on and moves the watermark, in one transaction.
+    Args:
+        user_id: The numeric user id
+        plays: list of (unix time played, track), each track a dict of name,
+               artist, mbid, artistmbid and url
+        history: the user's new (newest, oldest, complete) watermark
+    """
+    newest, oldest, complete = history
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        # IMMEDIATE takes the write lock up front, waiting for other writers,
+        # so the transaction never fails upgrading a read lock
+        connection.execute("BEGIN IMMEDIATE")
+        ids = sql_query.resolve_top_data_ids(connection, {("track", None): [track for _, track in plays]})
+        connection.executemany(
+            "INSERT OR IGNORE INTO Scrobble (UserID, PlayedAt, TrackID, ArtistID) VALUES (?, ?, ?, ?)",
+            [(user_id, played_at, ids["track"][(track["name"], track["artist"])],
+              ids["artist"][(track["artist"], track["artist"])]) for played_at, track in plays])
+        if plays:
+            first_day = min(played_at for played_at, _ in plays) // SECONDS_PER_DAY
+            last_day = max(played_at for played_at, _ in plays) // SECONDS_PER_DAY
+            for table, column in _BUCKETS.values():
+                connection.execute(f"DELETE FROM {table} WHERE UserID = ? AND Day BETWEEN ? AND ?",
+                                   (user_id, first_day, last_day))
+                connection.execute(
+                    f"""
+                    INSERT INTO {table} (UserID, Day, {column}, Playcount)
+                    SELECT UserID, PlayedAt / {SECONDS_PER_DAY}, {column}, COUNT(*)
+                    FROM Scrobble
+                    WHERE UserID = ? AND PlayedAt >= ? AND PlayedAt < ?
+                    GROUP BY UserID, PlayedAt / {SECONDS_PER_DAY}, {column}
+                    """,
+                    (user_id, first_day * SECONDS_PER_DAY, (last_day + 1) * SECONDS_PER_DAY))
+        connection.execute(
+            """
+            INSERT INTO ScrobbleWatermark (UserID, NewestPlayedAt, OldestPlayedAt, HistoryComplete, LastIngested)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(UserID) DO UPDATE
+                SET NewestPlayedAt = excluded.NewestPlayedAt, OldestPlayedAt = excluded.OldestPlayedAt,
+                    HistoryComplete = excluded.HistoryComplete, LastIngested = excluded.LastIngested
+            """,
+            (user_id, newest, oldest, int(complete)))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def window_sums(connection, user_id, kind, windows, now=None):
+    """
+    Sums a user's playcounts of every artist or track over several windows in
+    one pass over their buckets.
+    Args:
+        connection: The database connection to read with
+        user_id: The numeric user id
+        kind: "artist" or "track"
+        windows: list of window lengths in days (None for all days)
+    Returns:
+        dict of artist or track id to the list of its playcounts in each window
+    """
+    table, column = _BUCKETS[kind]
+    sums = ", ".join(f"SUM(CASE WHEN Day >= ? THEN Playcount ELSE 0 END) AS Window{i}"
+                     for i in range(len(windows)))
+    rows = connection.execute(
+        f"SELECT {column} AS ItemID, {sums} FROM {table} WHERE UserID = ? GROUP BY {column}",
+        [_first_day(days, now) for days in windows] + [user_id]).fetchall()
+    return {row["ItemID"]: [row[f"Window{i}"] for i in range(len(windows))] for row in rows}
+
+
+def rollup(user_id, periods, now=None):
+    """
+    Materializes a user's TopArtist and TopTrack rows for the given periods
+    from their buckets, keeping the same number of rows the Last.fm snapshots do.
+    Args:
+        user_id: The numeric user id
+        periods: period names the stored history covers (see covers())
+    """
+    period_ids = [sql_query.query_period_id(period) for period in periods]
+    windows = [period_days(period) for period in periods]
+    connection = sql_query.get_db_connection_isolation_none()
+    try:
+        _ensure_tables(connection)
+        # IMMEDIATE, as in append(): the sums are read before the rows are written
+        connection.execute("BEGIN IMMEDIATE")
+        for kind, table, limit in (("artist", "TopArtist", constants.SCROBBLE_TOP_ARTISTS),
+                                   ("track", "TopTrack", constants.SCROBBLE_TOP_TRACKS)):
+            column = _BUCKETS[kind][1]
+            sums = window_sums(connection, user_id, kind, windows, now)
+            rows = []
+            for i, period_id in enumerate(period_ids):
+                counts = sorted(((-playcounts[i], item_id) for item_id, playcounts in sums.items() if playcounts[i]))
+                rows += [(user_id, item_id, period_id, -playcount) for playcount, item_id in counts[:limit]]
+            connection.executemany(
+                f"DELETE FROM {table} WHERE UserID = ? AND PeriodID = ?",
+                [(user_id, period_id) for period_id in period_ids])
+            connection.executemany(
+                f"INSERT INTO {table} (UserID, {column}, PeriodID, Playcount, LastUpdated) "
+                "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)", rows)
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def top(user_id, kind, limit, period=None, days=None):
+    """
+    Computes a user's top artists or tracks over a period, or over the last
+    number of days, on demand from their buckets.
+    Args:
+        user_id: The numeric user id
+        kind: "artist" (rows of id, name, scrobbles) or "track" (rows of id,
+              track, artist, playcount, lastfmtrackurl)
+        limit: The maximum number of rows
+        period: A period name, or None to use days
+        days: The number of days ending today the window spans
+    Returns:
+        list of rows, or None if the stored history does not cover the window
+    """
+    if not covers(watermark(user_id), period_days(period) if period else days):
+        return None
+
+    today = int(time.time()) // SECONDS_PER_DAY
+    if period:
+        sql = _TOP_SQL[kind].format(
+            window_join="JOIN PeriodWindow ON PeriodWindow.PeriodName = ?",
+            window="(PeriodWindow.Days IS NULL OR Bucket.Day > ? - PeriodWindow.Days)")
+        parameters = (period, user_id, today, limit)
+    else:
+        sql = _TOP_SQL[kind].format(window_join="", window="Bucket.Day >= ?")
+        parameters = (user_id, _first_day(days), limit)
+
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        return connection.execute(sql, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+def playcount(username, period, artist_name, track_name=None):
+    """
+    Counts a user's plays of an artist (or of one of its tracks) in a period
+    from their buckets.
+    Args:
+        username: The user's last.fm profile name
+        period: The period name
+        artist_name: The artist's name
+        track_name: The track's name, to count plays of that track only
+    Returns:
+        int playcount, or None if the stored history does not cover the period
+    """
+    user_id = sql_query.query_user_id(username)
+    if not user_id or not covers(watermark(user_id), period_days(period)):
+        return None
+
+    if track_name is None:
+        sql = """
+            SELECT SUM(Bucket.Playcount) AS Playcount
+            FROM ScrobbleArtistDay AS Bucket
+            JOIN Artist ON Bucket.ArtistID = Artist.ArtistID
+            WHERE Bucket.UserID = ? AND Bucket.Day >= ? AND Artist.ArtistName = ?
+            """
+        parameters = (user_id, _first_day(period_days(period)), artist_name)
+    else:
+        sql = """
+            SELECT SUM(Bucket.Playcount) AS Playcount
+            FROM ScrobbleTrackDay AS Bucket
+            JOIN Track ON Bucket.TrackID = Track.TrackID
+            JOIN Artist ON Track.ArtistID = Artist.ArtistID
+            WHERE Bucket.UserID = ? AND Bucket.Day >= ? AND Artist.ArtistName = ? AND Track.TrackName = ?
+            """
+        parameters = (user_id, _first_day(period_days(period)), artist_name, track_name)
+
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        return connection.execute(sql, parameters).fetchone()["Playcount"] or 0
+    finally:
+        connection.close()
@@ -0,0 +1,255 @@
+"""
+This module precomputes "fans of X also listen to Y" (related artists) and
+"users like you" (similar users) from the overall TopArtist and TopTrack rows.
+
+Both are cosine similarities between sparse vectors:
+  - artists are compared by their listeners (a user listing the artist among
+    their top artists), so the dot product of two artists is the number of
+    listeners they share (their co-occurrence count)
+  - users are compared by their top artists and tracks, weighted by
+    log(1 + playcount) so a few heavily played artists do not dominate
+
+Computing either on demand would compare a row with every other row, so an
+offline job (python similarity.py, run periodically e.g. from cron) computes
+each row's constants.SIMILARITY_TOP_K most similar rows through an inverted
+index (only rows sharing a feature are ever touched) and writes them as CSR
+arrays: row id r's neighbours are indices[indptr[r]:indptr[r + 1]], by score
+descending.  The files (see mapped_arrays.py) are memory-mapped read-only by
+every worker and mapped again when the job replaces them.
+
+Readers get None while there is no file for the database in use (or without
+NumPy), and the API then answers 503.
+"""
+import threading
+import time
+
+import constants
+import mapped_arrays
+import sql_query
+
+try:
+    import numpy
+except ImportError:     # similarity is unavailable without NumPy
+    numpy = None
+
+RELATED_ARTISTS_PATH = constants.RELATED_ARTISTS_PATH
+SIMILAR_USERS_PATH = constants.SIMILAR_USERS_PATH
+
+_lock = threading.Lock()
+_mapped = {}
+
+
+def enabled():
+    """
+    Returns whether similarity can be built and served (NumPy is installed).
+    """
+    return numpy is not None
+
+
+#################################################
+#   Building                                     #
+#################################################
+
+def _read_rows(table, id_column):
+    """
+    Reads a top data table's overall rows (of existing users) into
+    (user ids, item ids, playcounts) arrays.
+    """
+    sql = f"SELECT {table}.UserID, {table}.{id_column}, {table}.Playcount FROM {table} " \
+          f"INNER JOIN User ON {table}.UserID = User.UserID " \
+          f"INNER JOIN Period ON {table}.PeriodID = Period.PeriodID WHERE Period.PeriodName = ?"
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        rows = connection.execute(sql, (constants.SIMILARITY_PERIOD,)).fetchall()
+    finally:
+        connection.close()
+    values = numpy.array([tuple(row) for row in rows], dtype="int64").reshape(-1, 3)
+    return values[:, 0], values[:, 1], values[:, 2]
+
+
+def _csr(rows, columns, weights, row_count):
+    """
+    Builds CSR arrays (indptr, indices, weights) of a sparse matrix from coordinates.
+    """
+    order = numpy.lexsort((columns, rows))
+    indptr = numpy.searchsorted(rows[order], numpy.arange(row_count + 1))
+    return indptr, columns[order], weights[order]
+
+
+def _gather(indptr, indices, weights, rows, row_weights):
+    """
+    Concatenates the given rows of a CSR matrix, scaling each by its row weight.
+    Returns:
+        (column ids, weights) of every entry of those rows
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return indices[:0], weights[:0]
+    # Position of each gathered entry: its row's start plus its rank within the row
+    positions = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(total)
+    return indices[positions], weights[positions] * numpy.repeat(row_weights, lengths)
+
+
+def _top_k(row_ids, item_ids, weights, row_count, k, min_shared):
+    """
+    Computes each row's k most cosine-similar rows of a sparse row x item matrix.
+    Args:
+        row_ids, item_ids, weights: the matrix's non-zero entries
+        row_count: the number of rows (row ids are below it)
+        k: the most neighbours kept per row
+        min_shared: the fewest items a neighbour must share with the row
+    Returns:
+        dict of CSR arrays: indptr, indices (neighbour row ids), scores, and
+        shared (the number of items each neighbour shares with the row)
+    """
+    item_count = int(item_ids.max()) + 1 if len(item_ids) else 0
+    rows = _csr(row_ids, item_ids, weights, row_count)
+    items = _csr(item_ids, row_ids, weights, item_count)
+    norms = numpy.sqrt(numpy.bincount(row_ids, weights=weights * weights, minlength=row_count))
+
+    indptr = numpy.zeros(row_count + 1, dtype="int64")
+    neighbours, scores, shared = [], [], []
+    for row_id in range(row_count):
+        row_items = rows[1][rows[0][row_id]:rows[0][row_id + 1]]
+        if len(row_items) == 0:
+            continue
+        row_weights = rows[2][rows[0][row_id]:rows[0][row_id + 1]]
+        candidates, products = _gather(*items, row_items, row_weights)
+        dots = numpy.bincount(candidates, weights=products, minlength=row_count)
+        counts = numpy.bincount(candidates, minlength=row_count)
+        counts[row_id] = 0
+        matches = numpy.flatnonzero(counts >= min_shared)
+        if len(matches) > k:
+            cosines = dots[matches] / (norms[row_id] * norms[matches])
+            matches = matches[numpy.argpartition(-cosines, k - 1)[:k]]
+        cosines = dots[matches] / (norms[row_id] * norms[matches])
+        order = numpy.lexsort((matches, -cosines))
+        neighbours.append(matches[order])
+        scores.append(cosines[order])
+        shared.append(counts[matches[order]])
+        indptr[row_id + 1] = len(matches)
+
+    def joined(parts, dtype):
+        return numpy.concatenate(parts).astype(dtype) if parts else numpy.zeros(0, dtype=dtype)
+
+    return {"indptr": numpy.cumsum(indptr), "indices": joined(neighbours, "int32"),
+            "scores": joined(scores, "float32"), "shared": joined(shared, "int32")}
+
+
+def build():
+    """
+    Computes related artists and similar users and writes both files.
+    Returns:
+        dict of phase name to seconds taken (see tools/bench_similarity.py)
+    """
+    timings = {}
+    start = time.perf_counter()
+
+    def phase(name):
+        nonlocal start
+        now = time.perf_counter()
+        timings[name] = now - start
+        start = now
+
+    artist_users, artists, artist_playcounts = _read_rows("TopArtist", "ArtistID")
+    track_users, tracks, track_playcounts = _read_rows("TopTrack", "TrackID")
+    phase("read")
+
+    metadata = {"built": time.time(), "source": sql_query.database_identity(),
+                "period": constants.SIMILARITY_PERIOD}
+    artist_count = int(artists.max()) + 1 if len(artists) else 0
+    user_count = int(max(artist_users.max(initial=-1), track_users.max(initial=-1))) + 1
+
+    # Artists x listeners, unweighted
+    related = _top_k(artists, artist_users, numpy.ones(len(artists)), artist_count,
+                     constants.SIMILARITY_TOP_K, constants.RELATED_ARTISTS_MIN_SHARED_LISTENERS)
+    phase("related_artists")
+    mapped_arrays.write(RELATED_ARTISTS_PATH, related, metadata)
+    phase("write_related_artists")
+
+    # Users x (artists, then tracks with ids offset past the artists)
+    similar = _top_k(numpy.concatenate((artist_users, track_users)),
+                     numpy.concatenate((artists, tracks + artist_count)),
+                     numpy.log1p(numpy.concatenate((artist_playcounts, track_playcounts)).astype("float64")),
+                     user_count, constants.SIMILARITY_TOP_K, 1)
+    phase("similar_users")
+    mapped_arrays.write(SIMILAR_USERS_PATH, similar, metadata)
+    phase("write_similar_users")
+    return timings
+
+
+#################################################
+#   Reading                                      #
+#################################################
+
+def _load(path):
+    """
+    Returns a file's mapping (mapping it again if it was replaced), or None if
+    there is none for the database in use.
+    """
+    if not enabled():
+        return None
+    current = _mapped.get(path)
+    if current is None or current.replaced():
+        with _lock:
+            current = _mapped.get(path)
+            if current is None or current.replaced():
+                try:
+                    current = _mapped[path] = mapped_arrays.MappedArrays(path)
+                except (OSError, ValueError):
+                    _mapped.pop(path, None)
+                    return None
+    if current.metadata.get("source") != sql_query.database_identity():
+        return None
+    return current
+
+
+def _neighbours(path, row_id, limit):
+    current = _load(path)
+    if current is None:
+        return None
+    indptr = current.arrays["indptr"]
+    if row_id < 0 or row_id + 1 >= len(indptr):
+        return []
+    start = int(indptr[row_id])
+    end = min(int(indptr[row_id + 1]), start + limit)
+    return list(zip(current.arrays["indices"][start:end].tolist(),
+                    current.arrays["scores"][start:end].tolist(),
+                    current.arrays["shared"][start:end].tolist()))
+
+
+def related_artists(artist_id, limit):
+    """
+    Returns up to limit (artist id, score, shared listeners) tuples of the
+    artists most related to an artist, or None if they have not been built.
+    """
+    return _neighbours(RELATED_ARTISTS_PATH, artist_id, limit)
+
+
+def similar_users(user_id, limit):
+    """
+    Returns up to limit (user id, score, shared artists and tracks) tuples of
+    the users most similar to a user, or None if they have not been built.
+    """
+    return _neighbours(SIMILAR_USERS_PATH, user_id, limit)
+
+
+def version():
+    """
+    Returns when the files in use were built, for ETags (None if not built).
+    """
+    built = []
+    for path in (RELATED_ARTISTS_PATH, SIMILAR_USERS_PATH):
+        current = _load(path)
+        built.append(current.metadata["built"] if current is not None else None)
+    return tuple(built)
+
+
+if __name__ == "__main__":
+    # Offline job: python similarity.py
+    if not enabled():
+        raise SystemExit("NumPy is required to build similarity")
+    for name, seconds in build().items():
+        print(f"{name}: {seconds:.2f}s")
@@ -3,10 +3,20 @@ This module provides functions for creating, reading, updating, and deleting (CR
 data in the broadCastr SQLite database.
 """
 
-import json
+import contextlib
+import os
 import sqlite3
+import threading
+import time
 
 import constants
+import data_version
+import instrumentation
+import leaderboard
+import query_log
+import replica
+import storage
+import top_artist_index
 
 # BROADCASTR_DB = "./localdisk/data/broadcastr.db" # Local / Development Version
 # BROADCASTR_DB = "/renderdisk/data/broadcastr.db" # Production Version
@@ -16,24 +26,137 @@ BROADCASTR_DB = "./data/broadcastr.db" # Git Version... obviously having the DB
 # this version for now so the hosted/free version of the app is still functional.
 
 
-def get_db_connection():
+class TimedCursor(sqlite3.Cursor):
 	"""
-	Gets the connection to the broadcastr database.
+	Cursor that reports every executed statement to the request instrumentation
+	and the slow-query log.
+	"""
+	def execute(self, sql, parameters=()):
+		start = time.perf_counter()
+		try:
+			result = super().execute(sql, parameters)
+		finally:
+			elapsed = time.perf_counter() - start
+			instrumentation.record_sql_statement(elapsed)
+		query_log.record(self.connection, sql, parameters, elapsed)
+		return result
+
+	def executemany(self, sql, seq_of_parameters):
+		start = time.perf_counter()
+		try:
+			result = super().executemany(sql, seq_of_parameters)
+		finally:
+			elapsed = time.perf_counter() - start
+			instrumentation.record_sql_statement(elapsed)
+		query_log.record(self.connection, sql, (), elapsed)
+		return result
+
+class TimedConnection(sqlite3.Connection):
+	"""
+	Connection whose cursors (including the implicit cursor used by
+	Connection.execute) are TimedCursors.
+	"""
+	def cursor(self, factory=TimedCursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		return self.cursor().execute(sql, parameters)
+
+	def executemany(self, sql, seq_of_parameters):
+		return self.cursor().executemany(sql, seq_of_parameters)
+
+class ScopedConnection:
+	"""
+	Handle to the connection shared by every read in a connection_scope().
+	Closing it is a no-op; the scope closes the connection when it ends.
+	"""
+	def __init__(self, connection):
+		self._connection = connection
+
+	def close(self):
+		pass
+
+	def __getattr__(self, name):
+		return getattr(self._connection, name)
+
+_scope = threading.local()
+
+_reference_lock = threading.Lock()
+_reference = None
+
+@contextlib.contextmanager
+def connection_scope():
+	"""
+	Shares one read connection, and memoized id lookups (query_id), across
+	every get_db_connection() call made on this thread until the scope ends.
+	Used to run several read-only queries (e.g. the batch API) without
+	reopening the database or resolving the same ids again.
+	"""
+	if getattr(_scope, "connection", None) is not None:
+		yield
+		return
+
+	connection = get_db_connection()
+	_scope.connection = ScopedConnection(connection)
+	_scope.ids = {}
+	try:
+		yield
+	finally:
+		_scope.connection = None
+		_scope.ids = None
+		connection.close()
+
+def get_db_connection(primary=False):
+	"""
+	Gets the connection to the broadcastr database (the shared connection
+	when called inside a connection_scope()).  During a GET request routed
+	to the read replica (see replica.py) this is a read-only connection to it.
+	Args:
+		primary: always connect to the primary database
 	Returns:
 		connection to the broadcastr database
 	"""
-	conn = sqlite3.connect(BROADCASTR_DB)
+	scoped = getattr(_scope, "connection", None)
+	if scoped is not None:
+		return scoped
+
+	if storage.backend() == storage.BACKEND_POSTGRES:
+		conn = storage.connect_postgres()
+		instrumentation.record_db_connection()
+		return conn
+
+	database, uri = (BROADCASTR_DB, False) if primary else replica.read_database()
+	conn = sqlite3.connect(database, uri=uri, factory=TimedConnection)
 	conn.row_factory = sqlite3.Row
+	instrumentation.record_db_connection()
 	return conn
 
+def database_identity():
+	"""
+	Identifies the database in use, for data derived from it and stored
+	outside it (e.g. the top artist index).
+	Returns:
+		the PostgreSQL url, or the absolute path of the SQLite database
+	"""
+	if storage.backend() == storage.BACKEND_POSTGRES:
+		return storage.database_url()
+	return os.path.abspath(BROADCASTR_DB)
+
 def get_db_connection_isolation_none():
 	"""
 	Gets the connection to the broadcastr database w/ isolation level = none.
 	Returns:
 		connection to the broadcastr database
 	"""
-	conn = sqlite3.connect(BROADCASTR_DB, isolation_level=None)
+	if storage.backend() == storage.BACKEND_POSTGRES:
+		# PostgreSQL connections are always in autocommit mode
+		conn = storage.connect_postgres()
+		instrumentation.record_db_connection()
+		return conn
+
+	conn = sqlite3.connect(BROADCASTR_DB, isolation_level=None, factory=TimedConnection)
 	conn.row_factory = sqlite3.Row
+	instrumentation.record_db_connection()
 	return conn
 
 def query_config(config_key):
@@ -86,40 +209,53 @@ def query_config(config_key):
 
 # 	return json.dumps(data)
 
+def _reference_data():
+	"""
+	Gets the reference data (Period and RelatedType rows, seeded by db_make.py),
+	which is read from the database once per process.
+	Returns:
+		dict of "periods" (name -> id), "related_type_ids" (description -> id)
+		and "related_types" (list of RelatedType rows as dicts)
+	"""
+	global _reference
+	if _reference is not None:
+		return _reference
+
+	with _reference_lock:
+		if _reference is None:
+			connection = get_db_connection()
+			try:
+				periods = {row["PeriodName"]: row["PeriodID"]
+						   for row in connection.execute("SELECT PeriodID, PeriodName FROM Period")}
+				related_types = [dict(row) for row in connection.execute(
+					"""
+					SELECT RelatedTypeID, Description, DbTable, DbIdField, DbNameField
+					FROM RelatedType
+					ORDER BY RelatedTypeID
+					""")]
+			finally:
+				connection.close()
+			_reference = {
+				"periods": periods,
+				"related_type_ids": {row["Description"]: row["RelatedTypeID"] for row in related_types},
+				"related_types": related_types,
+			}
+	return _reference
+
+def warm_reference_data():
+	"""
+	Loads the cached reference data now rather than on first use, e.g. in a
+	preloading server process before it forks workers.
+	"""
+	_reference_data()
+
 def query_related_type_tables():
 	"""
 	Queries the database for all related type database table records.
 	Returns:
 		json results related type database tables
 	"""
-	connection = get_db_connection()
-	cursor = connection.cursor()
-
-	cursor.execute(
-		"""
-		SELECT RelatedTypeID, Description, DbTable, DbIdField, DbNameField
-		FROM RelatedType
-		ORDER BY RelatedTypeID
-		"""
-	)
-
-	rows = cursor.fetchall()
-	cursor.close()
-	connection.close()
-
-	# Convert list of tuples to list of dicts
-	result = [{
-		"RelatedTypeID": row[0],
-		"Description": row[1],
-		"DbTable": row[2],
-		"DbIdField": row[3],
-		"DbNameField": row[4]
-		}
-		for row in rows
-	]
-
-	# return json.dumps(result)
-	return result
+	return [dict(row) for row in _reference_data()["related_types"]]
 
 def query_matched_user_for_song_swap(exclude_user_id):
 	"""
@@ -244,6 +380,30 @@ def query_user_name(user_id):
 	"""
 	return query_id("LastFmProfileName", "User", [["UserID", user_id]])
 
+def query_user_names(user_ids):
+	"""
+	Queries the database for the user names of several user ids at once.
+	Args:
+		user_ids: The users' database ids
+	Returns:
+		dict of user id to last.fm profile name (users not found are left out)
+	"""
+	user_ids = list(dict.fromkeys(user_ids))
+	names = {}
+	if not user_ids:
+		return names
+	connection = get_db_connection()
+	try:
+		# In chunks, to stay under SQLite's limit on bound parameters
+		for start in range(0, len(user_ids), 500):
+			chunk = user_ids[start:start + 500]
+			placeholders = ", ".join("?" for _ in chunk)
+			names.update(connection.execute(
+				f"SELECT UserID, LastFmProfileName FROM User WHERE UserID IN ({placeholders})", chunk).fetchall())
+	finally:
+		connection.close()
+	return names
+
 def query_swag(user_id):
 	"""
 	Queries the database for current swag of a user.
@@ -317,6 +477,16 @@ def query_artist_id(artistname):
 	# Simply doing a name lookup for now, but MBID might be better with name as a fallback
 	return query_id("ArtistID", "Artist", [["ArtistName", artistname]])
 
+def query_artist_name(artist_id):
+	"""
+	Queries the database for the name of an artist id.
+	Args:
+		artist_id: The artist's database id
+	Returns:
+		The artist's name
+	"""
+	return query_id("ArtistName", "Artist", [["ArtistID", artist_id]])
+
 def query_album_id(albumname, artistid):
 	"""
 	Queries the database for the numeric id of an album.
@@ -347,6 +517,9 @@ def query_related_type_id(relatedtype):
 	Returns:
 		numeric related type id
 	"""
+	related_type_id = _reference_data()["related_type_ids"].get(relatedtype)
+	if related_type_id is not None:
+		return related_type_id
 	return query_id("RelatedTypeID", "RelatedType", [["Description", relatedtype]])
 
 def query_track_id(trackname, artistid):
@@ -381,6 +554,9 @@ def query_period_id(period):
 	Returns:
 		numeric period id
 	"""
+	period_id = _reference_data()["periods"].get(period)
+	if period_id is not None:
+		return period_id
 	return query_id("PeriodID", "Period", [["PeriodName", period]])
 
 def query_like_id(user_id, related_type_id, related_id):
@@ -408,6 +584,12 @@ def query_id(idfield, table, lookup_pairs):
 	Returns:
 		numeric record id
 	"""
+	scoped_ids = getattr(_scope, "ids", None)
+	if scoped_ids is not None:
+		lookup_key = (idfield, table, tuple(tuple(pair) for pair in lookup_pairs))
+		if lookup_key in scoped_ids:
+			return scoped_ids[lookup_key]
+
 	connection = get_db_connection()
 	cursor = connection.cursor()
 
@@ -438,116 +620,64 @@ def query_id(idfield, table, lookup_pairs):
 	cursor.close()
 	connection.close()
 
-	return resultid
-
-def query_top_artists(username, period):
-	"""
-	Queries the database for a user's top artist data for a specified period.
-	Args:
-		username: The last.fm profile name of the user data to query
-		period: The period to query data for
-	Returns:
-		json results for user's top artist data
-	"""
-	connection = get_db_connection()
-	cursor = connection.cursor()
+	if scoped_ids is not None:
+		scoped_ids[lookup_key] = resultid
 
-	# Get the user's database id
-	userid = query_user_id(username)
-
-	# Get the period id (should eventually be passed in by id rather than name?)
-	periodid = query_period_id(period)
+	return resultid
 
-	cursor.execute(
-		"SELECT User.LastFmProfileName, Artist.ArtistName, Period.PeriodName, " \
-		"       TopArtist.Playcount, TopArtist.LastUpdated " \
+# Typed columns of a user's top data (see query_top_data), by kind
+_TOP_DATA_SQL = {
+	"artist":
+		"SELECT Artist.ArtistName AS artist, TopArtist.Playcount AS playcount, " \
+		"       TopArtist.LastUpdated AS lastupdated " \
 		"FROM TopArtist " \
-		"INNER JOIN User ON TopArtist.UserID = User.UserID " \
 		"INNER JOIN Artist ON TopArtist.ArtistID = Artist.ArtistID " \
-		"INNER JOIN Period ON TopArtist.PeriodID = Period.PeriodID " \
-		"WHERE TopArtist.UserID = ? " \
-		"   AND TopArtist.PeriodID = ? " \
-		"ORDER BY TopArtist.Playcount DESC", (userid, periodid))
-	data = cursor.fetchall()
-
-	cursor.close()
-	connection.close()
-
-	return json.dumps(data)
-
-def query_top_albums(username, period):
-	"""
-	Queries the database for a user's top album data for a specified period.
-	Args:
-		username: The last.fm profile name of the user data to query
-		period: The period to query data for
-	Returns:
-		json results for user's top album data
-	"""
-	connection = get_db_connection()
-	cursor = connection.cursor()
-
-	# Get the user's database id
-	userid = query_user_id(username)
-
-	# Get the period id (should eventually be passed in by id rather than name?)
-	periodid = query_period_id(period)
-
-	cursor.execute(
-		"SELECT User.LastFmProfileName, Album.AlbumName, Artist.ArtistName, " \
-		"       Period.PeriodName, TopAlbum.Playcount, TopAlbum.LastUpdated " \
+		"WHERE TopArtist.UserID = ? AND TopArtist.PeriodID = ? " \
+		"ORDER BY TopArtist.Playcount DESC, Artist.ArtistName " \
+		"LIMIT ? OFFSET ?",
+	"album":
+		"SELECT Album.AlbumName AS album, Artist.ArtistName AS artist, TopAlbum.Playcount AS playcount, " \
+		"       TopAlbum.LastUpdated AS lastupdated " \
 		"FROM TopAlbum " \
-		"INNER JOIN User ON TopAlbum.UserID = User.UserID " \
 		"INNER JOIN Album ON TopAlbum.AlbumID = Album.AlbumID " \
 		"INNER JOIN Artist ON Album.ArtistID = Artist.ArtistID " \
-		"INNER JOIN Period ON TopAlbum.PeriodID = Period.PeriodID " \
-		"WHERE TopAlbum.UserID = ? " \
-		"   AND TopAlbum.PeriodID = ? " \
-		"ORDER BY TopAlbum.Playcount DESC", (userid, periodid))
-
-	data = cursor.fetchall()
-
-	cursor.close()
-	connection.close()
-
-	return json.dumps(data)
+		"WHERE TopAlbum.UserID = ? AND TopAlbum.PeriodID = ? " \
+		"ORDER BY TopAlbum.Playcount DESC, Album.AlbumName " \
+		"LIMIT ? OFFSET ?",
+	"track":
+		"SELECT Track.TrackName AS track, Artist.ArtistName AS artist, Track.LastFmTrackUrl AS url, " \
+		"       TopTrack.Playcount AS playcount, TopTrack.LastUpdated AS lastupdated " \
+		"FROM TopTrack " \
+		"INNER JOIN Track ON TopTrack.TrackID = Track.TrackID " \
+		"INNER JOIN Artist ON Track.ArtistID = Artist.ArtistID " \
+		"WHERE TopTrack.UserID = ? AND TopTrack.PeriodID = ? " \
+		"ORDER BY TopTrack.Playcount DESC, Track.TrackName " \
+		"LIMIT ? OFFSET ?",
+}
 
-def query_top_tracks(username, period):
+def query_top_data(kind, username, period, limit, offset=0):
 	"""
-	Queries the database for a user's top track data for a specified period.
+	Queries the database for a page of a user's top artist, album or track
+	data for a specified period, by playcount descending.
 	Args:
+		kind: "artist", "album" or "track"
 		username: The last.fm profile name of the user data to query
 		period: The period to query data for
+		limit: The maximum number of rows
+		offset: The number of rows to skip
 	Returns:
-		json results for user's top track data
+		(connection, cursor) of the executed query, to be read and closed by
+		the caller (see json_response.rows_response)
 	"""
-	connection = get_db_connection()
-	cursor = connection.cursor()
-
 	# Get the user's database id
 	userid = query_user_id(username)
 
 	# Get the period id (should eventually be passed in by id rather than name?)
 	periodid = query_period_id(period)
 
-	cursor.execute(
-		"SELECT User.LastFmProfileName, Track.TrackName, Artist.ArtistName, " \
-		"       Period.PeriodName, TopTrack.Playcount, TopTrack.LastUpdated " \
-		"FROM TopTrack " \
-		"INNER JOIN User ON TopTrack.UserID = User.UserID " \
-		"INNER JOIN Track ON TopTrack.TrackID = Track.TrackID " \
-		"INNER JOIN Artist ON Track.ArtistID = Artist.ArtistID " \
-		"INNER JOIN Period ON TopTrack.PeriodID = Period.PeriodID " \
-		"WHERE TopTrack.UserID = ? " \
-		"   AND TopTrack.PeriodID = ? " \
-		"ORDER BY TopTrack.Playcount DESC", (userid, periodid))
-
-	data = cursor.fetchall()
-
-	cursor.close()
-	connection.close()
-
-	return json.dumps(data)
+	connection = get_db_connection()
+	cursor = connection.execute(_TOP_DATA_SQL[kind], (userid, periodid, limit, offset))
+	return connection, cursor
 
 def query_listens_for_artist(username, artistname, periodname):
 	"""
@@ -675,10 +805,14 @@ def store_broadcast(broadcast_id, user_id, title, body, related_type_id, related
 			VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
 			""",
 			(user_id, title, body, related_type_id, related_id))
+		leaderboard.record_broadcast(cursor.lastrowid, user_id, related_type_id)
 
 	cursor.close()
 	connection.close()
 
+	if broadcast_id == 0:
+		data_version.bump(data_version.SCOPE_BROADCASTS, data_version.SCOPE_LEADERBOARD)
+
 	return cursor.lastrowid
 
 def store_like(user_id, related_type_id, related_id):
@@ -704,6 +838,9 @@ def store_like(user_id, related_type_id, related_id):
 	cursor.close()
 	connection.close()
 
+	leaderboard.record_like(related_type_id, related_id, [cursor.lastrowid], True)
+	data_version.bump(data_version.SCOPE_BROADCASTS, data_version.SCOPE_LEADERBOARD)
+
 	return cursor.lastrowid
 
 def store_track(trackid, trackname, artistid, mbid, trackurl):
@@ -832,6 +969,164 @@ def store_top_track(userid, trackid, periodid, playcount):
 
 	return cursor.lastrowid
 
+# Table and item id column of each kind of top data
+_TOP_TABLES = {
+	"artist": ("TopArtist", "ArtistID"),
+	"album": ("TopAlbum", "AlbumID"),
+	"track": ("TopTrack", "TrackID"),
+}
+
+def _named_ids(connection, sql, names):
+	"""
+	Runs a lookup of (name, artist id, id) rows by name for every name given,
+	keeping the lowest id of duplicate names.
+	Returns:
+		dict of (name, artist id) to numeric id
+	"""
+	if not names:
+		return {}
+	placeholders = ", ".join("?" for _ in names)
+	rows = connection.execute(sql.format(placeholders), list(names)).fetchall()
+	return {(row[0], row[1]): row[2] for row in reversed(rows)}
+
+def resolve_top_data_ids(connection, snapshots):
+	"""
+	Gets the ids of every artist, album and track in top data snapshots with
+	one lookup per table, storing the ones not in the database yet.  Artists
+	are inserted with INSERT OR IGNORE and read back, so an artist another
+	refresh stored first is reused.
+	Args:
+		connection: The connection (in a BEGIN IMMEDIATE transaction, so no
+					other refresh stores albums or tracks meanwhile) to read
+					and write with
+		snapshots: top data rows, as given to store_top_data (scrobbles.append
+				   passes its plays' tracks the same way)
+	Returns:
+		dict of kind ("artist", "album" or "track") to a dict of (name, artist
+		name) to numeric id (the name is the artist name for artists)
+	"""
+	artists, albums, tracks = {}, {}, {}
+	for (kind, _), rows in snapshots.items():
+		for row in rows:
+			artists.setdefault(row["artist"], row["artistmbid"])
+			if kind == "album":
+				albums.setdefault((row["name"], row["artist"]), row)
+			elif kind == "track":
+				tracks.setdefault((row["name"], row["artist"]), row)
+
+	def artist_ids_of(names):
+		if not names:
+			return {}
+		placeholders = ", ".join("?" for _ in names)
+		return dict(connection.execute(
+			f"SELECT ArtistName, ArtistID FROM Artist WHERE ArtistName IN ({placeholders})",
+			list(names)).fetchall())
+
+	artist_ids = artist_ids_of(artists)
+	# By name, so concurrent refreshes (on PostgreSQL) insert shared artists in the same order and cannot deadlock
+	missing = sorted((artistname, mbid) for artistname, mbid in artists.items() if artistname not in artist_ids)
+	for artistname, _ in missing:
+		print(f"storing new artist: {artistname}")
+	if missing:
+		connection.executemany("INSERT OR IGNORE INTO Artist (ArtistName, LastFmMbid) VALUES (?, ?)", missing)
+		artist_ids.update(artist_ids_of([artistname for artistname, _ in missing]))
+
+	album_ids = _named_ids(
+		connection, "SELECT AlbumName, ArtistID, AlbumID FROM Album WHERE AlbumName IN ({}) ORDER BY AlbumID",
+		{name for name, _ in albums})
+	track_ids = _named_ids(
+		connection, "SELECT TrackName, ArtistID, TrackID FROM Track WHERE TrackName IN ({}) ORDER BY TrackID",
+		{name for name, _ in tracks})
+	ids = {"artist": {(name, name): artist_id for name, artist_id in artist_ids.items()}, "album": {}, "track": {}}
+	for (name, artistname), row in albums.items():
+		album_id = album_ids.get((name, artist_ids[artistname]))
+		if album_id is None:
+			print(f"storing new album: {name}")
+			album_id = connection.execute(
+				"INSERT INTO Album (AlbumName, ArtistID, MBID) VALUES (?, ?, ?)",
+				(name, artist_ids[artistname], row["mbid"])).lastrowid
+		ids["album"][(name, artistname)] = album_id
+	for (name, artistname), row in tracks.items():
+		track_id = track_ids.get((name, artist_ids[artistname]))
+		if track_id is None:
+			print(f"storing new track {name}, {row['mbid']}")
+			track_id = connection.execute(
+				"INSERT INTO Track (TrackName, ArtistID, MBID, LastFmTrackUrl) VALUES (?, ?, ?, ?)",
+				(name, artist_ids[artistname], row["mbid"], row["url"])).lastrowid
+		ids["track"][(name, artistname)] = track_id
+	return ids
+
+def store_top_data(userid, snapshots):
+	"""
+	Replaces a user's top artist, album and/or track data for one or more
+	periods in a single transaction, resolving the artists, albums and tracks
+	in bulk (see resolve_top_data_ids).
+	Args:
+		userid: The numeric user id
+		snapshots: dict of (kind, numeric period id) to the list of rows to
+				   store, each a dict of name, artist, playcount, mbid and
+				   artistmbid (and url for tracks); for artists name is the artist
+	"""
+	connection = get_db_connection_isolation_none()
+	try:
+		# IMMEDIATE: the ids are read before the rows are written, and SQLite
+		# cannot upgrade a read lock while another refresh is writing
+		connection.execute("BEGIN IMMEDIATE")
+		ids = resolve_top_data_ids(connection, snapshots)
+		for (kind, periodid), rows in snapshots.items():
+			table, column = _TOP_TABLES[kind]
+			connection.execute(f"DELETE FROM {table} WHERE UserID = ? AND PeriodID = ?", (userid, periodid))
+			connection.executemany(
+				f"INSERT INTO {table} (UserID, {column}, PeriodID, Playcount, LastUpdated) " \
+				"VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+				[(userid, ids[kind][(row["name"], row["artist"])], periodid, row["playcount"]) for row in rows])
+		connection.execute("COMMIT")
+	except BaseException:
+		connection.execute("ROLLBACK")
+		raise
+	finally:
+		connection.close()
+
+# A user's stored top data as (period id, name, artist name, playcount) rows, by kind
+_TOP_SNAPSHOT_SQL = {
+	"artist":
+		"SELECT TopArtist.PeriodID, Artist.ArtistName, Artist.ArtistName, TopArtist.Playcount " \
+		"FROM TopArtist " \
+		"INNER JOIN Artist ON TopArtist.ArtistID = Artist.ArtistID " \
+		"WHERE TopArtist.UserID = ?",
+	"album":
+		"SELECT TopAlbum.PeriodID, Album.AlbumName, Artist.ArtistName, TopAlbum.Playcount " \
+		"FROM TopAlbum " \
+		"INNER JOIN Album ON TopAlbum.AlbumID = Album.AlbumID " \
+		"INNER JOIN Artist ON Album.ArtistID = Artist.ArtistID " \
+		"WHERE TopAlbum.UserID = ?",
+	"track":
+		"SELECT TopTrack.PeriodID, Track.TrackName, Artist.ArtistName, TopTrack.Playcount " \
+		"FROM TopTrack " \
+		"INNER JOIN Track ON TopTrack.TrackID = Track.TrackID " \
+		"INNER JOIN Artist ON Track.ArtistID = Artist.ArtistID " \
+		"WHERE TopTrack.UserID = ?",
+}
+
+def query_top_snapshots(userid, kinds=("artist", "album", "track")):
+	"""
+	Queries the database for a user's stored top data, for change detection.
+	Args:
+		userid: The numeric user id
+		kinds: The kinds of top data to query
+	Returns:
+		dict of (kind, numeric period id) to sorted list of (name, artist name, playcount)
+	"""
+	snapshots = {}
+	connection = get_db_connection(primary=True)
+	try:
+		for kind in kinds:
+			for periodid, name, artistname, playcount in connection.execute(_TOP_SNAPSHOT_SQL[kind], (userid,)).fetchall():
+				snapshots.setdefault((kind, periodid), []).append((name, artistname, playcount))
+	finally:
+		connection.close()
+	return {key: sorted(entries) for key, entries in snapshots.items()}
+
 def store_user(user, first_name, last_name, email, salt, hashed_password, bootstrapped):
 	print(f"storing new user: {user}")
 	connection = get_db_connection_isolation_none()
@@ -850,6 +1145,8 @@ def store_user(user, first_name, last_name, email, salt, hashed_password, bootst
 	connection.close()
 
 	print(f"New user stored with id: {cursor.lastrowid}")
+	leaderboard.record_swag(cursor.lastrowid, constants.SWAG_STARTING_BALANCE)
+	data_version.bump(data_version.SCOPE_LEADERBOARD, data_version.user_scope(user))
 	return cursor.lastrowid
 
 def add_swag(user_id, swag):
@@ -876,63 +1173,21 @@ def add_swag(user_id, swag):
 	cursor.close()
 	connection.close()
 
-	return new_swag
-
-def user_refresh_due(user_id):
-	"""
-	Queries the database to determine if a user's top data
-	is due for a refresh.
-	Returns:
-		Boolean indicating whether or not the refresh is due.
-	"""
-	connection = get_db_connection()
-	cursor = connection.cursor()
-
-	cursor.execute(
-		f"""
-		SELECT MaxLastUpdated
-		FROM (
-			SELECT MAX(LastUpdatedData.LastUpdated) AS MaxLastUpdated
-			FROM (
-				SELECT TopArtist.LastUpdated
-				FROM User
-				LEFT JOIN TopArtist ON User.UserID = TopArtist.UserID
-				WHERE User.UserID = ?
-				UNION
-				SELECT TopAlbum.LastUpdated
-				FROM User
-				LEFT JOIN TopAlbum ON User.UserID = TopAlbum.UserID
-				WHERE User.UserID = ?
-				UNION
-				SELECT TopTrack.LastUpdated
-				FROM User
-				LEFT JOIN TopTrack ON User.UserID = TopTrack.UserID
-				WHERE User.UserID = ?
-			) AS LastUpdatedData
-		) AS MaxLastUpdatedData
-		WHERE MaxLastUpdated > DATE(CURRENT_TIMESTAMP, '-{constants.REFRESH_DAYS} days')
-		""",
-		(user_id, user_id, user_id)
-	)
-
-	row = cursor.fetchone()
-
-	if row:
-		print("user data does not need to be refreshed")
-		return_val = False
+	leaderboard.record_swag(user_id, new_swag)
+	username = query_user_name(user_id)
+	if username:
+		data_version.bump(data_version.SCOPE_LEADERBOARD, data_version.user_scope(username))
 	else:
-		print("user data needs to be refreshed")
-		return_val = True
+		data_version.bump(data_version.SCOPE_LEADERBOARD)
 
-	cursor.close()
-	connection.close()
-
-	return return_val
+	return new_swag
 
 def delete_user(username):
 	"""
 	Deletes the user with the given Last.fm profile name.
 	"""
+	user_id = query_user_id(username)
+
 	connection = get_db_connection_isolation_none()
 	cursor = connection.cursor()
 
@@ -947,6 +1202,12 @@ def delete_user(username):
 	cursor.close()
 	connection.close()
 
+	leaderboard.record_user_deleted(user_id)
+	top_artist_index.record_user(user_id)
+	data_version.bump(data_version.SCOPE_BROADCASTS, data_version.SCOPE_LEADERBOARD,
+					  data_version.SCOPE_TOP_ARTISTS, data_version.user_scope(username),
+					  data_version.SCOPE_FOLLOWING, data_version.user_top_scope(username))
+
 	print(f"Deleted {deleted_count} user(s) with username: {username}")
 
 def delete_top_artists(userid, periodid):
@@ -1007,20 +1268,35 @@ def delete_like(user_id, related_type_id, related_id):
 	connection = get_db_connection_isolation_none()
 	cursor = connection.cursor()
 
-	cursor.execute(
-		"""
-		DELETE
-		FROM Like
-		WHERE UserID = ?
-			AND RelatedTypeID = ?
-			AND RelatedID = ?
-		""",
-		(user_id, related_type_id, related_id))
-
-	cursor.close()
-	connection.close()
-
-	return cursor.rowcount
+	# The deleted LikeIDs are read first, so the leaderboards can ignore likes they never saw
+	try:
+		cursor.execute("BEGIN")
+		cursor.execute(
+			"""
+			SELECT LikeID
+			FROM Like
+			WHERE UserID = ?
+				AND RelatedTypeID = ?
+				AND RelatedID = ?
+			""",
+			(user_id, related_type_id, related_id))
+		like_ids = [row["LikeID"] for row in cursor.fetchall()]
+		if like_ids:
+			placeholders = ", ".join("?" for _ in like_ids)
+			cursor.execute(f"DELETE FROM Like WHERE LikeID IN ({placeholders})", like_ids)
+		cursor.execute("COMMIT")
+	except BaseException:
+		cursor.execute("ROLLBACK")
+		raise
+	finally:
+		cursor.close()
+		connection.close()
+
+	if like_ids:
+		leaderboard.record_like(related_type_id, related_id, like_ids, False)
+		data_version.bump(data_version.SCOPE_BROADCASTS, data_version.SCOPE_LEADERBOARD)
+
+	return len(like_ids)
 
 #################################################
 #                                                #
@@ -1057,7 +1333,7 @@ def delete_like(user_id, related_type_id, related_id):
 # for user in rando_users:
 # 	continue
 # 	print("USER")
-# 	print(query_top_artists(user, "overall"))
+# 	print(query_top_data("artist", user, "overall", 50))
 # 	print("")
 
 # # init_user("zugzug104", "Asher", "Hensley", "asher104@stanford.edu")
@@ -0,0 +1,617 @@
+"""
+This module provides the storage backends of the broadcastr database.
+
+The backend is chosen with the DATABASE_URL environment variable: unset, the
+SQLite file at sql_query.BROADCASTR_DB is used; a postgresql:// url selects
+PostgreSQL, reached through a pool of psycopg2 connections.  Every connection
+sql_query hands out (and so every query in sql_query and the blueprints)
+comes from sql_query.get_db_connection(), so the SQL is written once, in the
+SQLite dialect.  PostgreSQL connections translate each statement on first
+use: ? placeholders, names (which SQLite matches in any case, so the
+PostgreSQL schema uses lower case names; reserved words such as the User and
+Like tables are quoted), CURRENT_TIMESTAMP and DATE(CURRENT_TIMESTAMP, '-N days') as the
+same UTC text SQLite produces, case-insensitive LIKE, INSERT OR IGNORE, BEGIN IMMEDIATE,
+SQLite column types in CREATE TABLE, CREATE VIEW IF NOT EXISTS, and INSERT
+ids (cursor.lastrowid).  CREATE statements are serialized across processes
+with an advisory lock, so tables created on first use can be created by
+several at once.  Rows behave like sqlite3.Row.  RANDOM() needs no
+translation.
+
+copy_sqlite_to_postgres() creates the PostgreSQL schema from a SQLite
+database and copies its rows (see tools/storage_parity.py).
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import constants
+import instrumentation
+import query_log
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:  # psycopg2 is only needed for the PostgreSQL backend
+    psycopg2 = None
+
+BACKEND_SQLITE = "sqlite"
+BACKEND_POSTGRES = "postgres"
+
+_lock = threading.Lock()
+_pool = None
+_pool_slots = None
+_identity_columns = {}
+_translations = {}
+
+# Columns whose SQLite values do not fit the declared SQLite type
+_POSTGRES_COLUMN_TYPES = {
+    ("User", "Password"): "BYTEA",   # bcrypt hashes and salts are stored as blobs
+    ("User", "Salt"): "BYTEA",
+    ("Like", "RelatedTypeID"): "BIGINT",
+}
+
+_TOKEN_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|[A-Za-z_][A-Za-z0-9_]*|\s+|.", re.DOTALL)
+_DATE_MODIFIER_RE = re.compile(r"DATE\(\s*CURRENT_TIMESTAMP\s*,\s*'([^']*)'\s*\)", re.IGNORECASE)
+_INSERT_RE = re.compile(r"^\s*INSERT\s+(OR\s+(IGNORE|REPLACE)\s+)?INTO\s+(\"?\w+\"?)", re.IGNORECASE)
+_BEGIN_RE = re.compile(r"^\s*BEGIN\s+(DEFERRED|IMMEDIATE|EXCLUSIVE)\b", re.IGNORECASE)
+_CREATE_RE = re.compile(r"^\s*CREATE\s", re.IGNORECASE)
+_CREATE_TABLE_RE = re.compile(r"^\s*CREATE\s+TABLE", re.IGNORECASE)
+_CREATE_VIEW_RE = re.compile(r"^\s*CREATE\s+VIEW\s+IF\s+NOT\s+EXISTS\b", re.IGNORECASE)
+_INTEGER_KEY_RE = re.compile(r"\bINTEGER\s+PRIMARY\s+KEY(\s+AUTOINCREMENT)?", re.IGNORECASE)
+_UTC_NOW = "(CURRENT_TIMESTAMP AT TIME ZONE 'UTC')"
+
+# Advisory lock key serializing CREATE statements: tables and views created on
+# first use may be created by several processes at once, and PostgreSQL's
+# IF NOT EXISTS (and OR REPLACE) do not guard against concurrent creation
+_SCHEMA_LOCK_KEY = 0x62726f61
+
+# PostgreSQL reserved words (which must be quoted when used as names)
+_RESERVED_WORDS = frozenset("""
+    ALL ANALYSE ANALYZE AND ANY ARRAY AS ASC ASYMMETRIC AUTHORIZATION BINARY BOTH CASE CAST CHECK
+    COLLATE COLLATION COLUMN CONCURRENTLY CONSTRAINT CREATE CROSS CURRENT_CATALOG CURRENT_DATE
+    CURRENT_ROLE CURRENT_SCHEMA CURRENT_TIME CURRENT_TIMESTAMP CURRENT_USER DEFAULT DEFERRABLE DESC
+    DISTINCT DO ELSE END EXCEPT FALSE FETCH FOR FOREIGN FREEZE FROM FULL GRANT GROUP HAVING ILIKE IN
+    INITIALLY INNER INTERSECT INTO IS ISNULL JOIN LATERAL LEADING LEFT LIKE LIMIT LOCALTIME
+    LOCALTIMESTAMP NATURAL NOT NOTNULL NULL OFFSET ON ONLY OR ORDER OUTER OVERLAPS PLACING PRIMARY
+    REFERENCES RETURNING RIGHT SELECT SESSION_USER SIMILAR SOME SYMMETRIC SYSTEM_USER TABLE
+    TABLESAMPLE THEN TO TRAILING TRUE UNION UNIQUE USER USING VARIADIC VERBOSE WHEN WHERE WINDOW WITH
+""".split())
+
+
+def database_url():
+    """
+    Returns the configured database url ("" for the default SQLite database).
+    """
+    return os.getenv("DATABASE_URL", "")
+
+
+def backend():
+    """
+    Returns the name of the storage backend in use (BACKEND_SQLITE or BACKEND_POSTGRES).
+    """
+    if database_url().startswith(("postgres://", "postgresql://")):
+        return BACKEND_POSTGRES
+    return BACKEND_SQLITE
+
+
+#################################################
+#   SQLite to PostgreSQL translation             #
+#################################################
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def translate_sql(sql):
+    """
+    Translates a statement written for SQLite into PostgreSQL.
+    Args:
+        sql: The SQLite statement
+    Returns:
+        (PostgreSQL statement, the table inserted into or None,
+         dict of lower case result column name to its spelling in the statement)
+    """
+    sql = _DATE_MODIFIER_RE.sub(
+        lambda match: f"TO_CHAR({_UTC_NOW} + INTERVAL '{match.group(1)}', 'YYYY-MM-DD')", sql)
+    # PostgreSQL takes row locks as a transaction writes, so SQLite's lock modes are dropped
+    sql = _BEGIN_RE.sub("BEGIN", sql)
+
+    insert = _INSERT_RE.match(sql)
+    if insert and insert.group(2) and insert.group(2).upper() == "REPLACE":
+        raise ValueError("INSERT OR REPLACE has no PostgreSQL translation; "
+                         "use INSERT ... ON CONFLICT (...) DO UPDATE")
+    if insert and insert.group(1):
+        sql = sql[:insert.start(1)] + sql[insert.end(1):]
+    if _CREATE_TABLE_RE.match(sql):
+        sql = _INTEGER_KEY_RE.sub("BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY", sql)
+        sql = re.sub(r"\bBLOB\b", "BYTEA", sql, flags=re.IGNORECASE)
+        sql = re.sub(r"\bREAL\b", "DOUBLE PRECISION", sql, flags=re.IGNORECASE)
+        sql = re.sub(r"\)\s*WITHOUT\s+ROWID\s*$", ")", sql.rstrip(), flags=re.IGNORECASE)
+    sql = _CREATE_VIEW_RE.sub("CREATE OR REPLACE VIEW", sql)
+
+    tokens = _TOKEN_RE.findall(sql)
+    words = [i for i, token in enumerate(tokens) if token[0].isalpha() or token[0] == "_"]
+    aliases = [tokens[words[n + 1]] for n in range(len(words) - 1) if tokens[words[n]].upper() == "AS"]
+    names = {alias.lower(): alias for alias in aliases}
+    for i in words:
+        names.setdefault(tokens[i].lower(), tokens[i])
+
+    translated = []
+    for i, token in enumerate(tokens):
+        first = token[0]
+        if first == "'":
+            translated.append(token.replace("%", "%%"))
+        elif first == '"':
+            translated.append(token.lower())
+        elif first == "?":
+            previous = next((t for t in reversed(tokens[:i]) if not t.isspace()), "")
+            # SQLite reads a negative LIMIT as no limit
+            translated.append("NULLIF(GREATEST(%s, -1), -1)" if previous.upper() == "LIMIT" else "%s")
+        elif first == "%":
+            translated.append("%%")
+        elif first.isalpha() or first == "_":
+            upper = token.upper()
+            # Names are left unquoted, so PostgreSQL folds them to lower case as
+            # SQLite ignores their case.  Names that are PostgreSQL reserved
+            # words (the User and Like tables) are quoted; keywords are upper case.
+            if upper in _RESERVED_WORDS and token != upper and (token != token.lower() or token in aliases):
+                translated.append(_quote(token.lower()))
+            elif upper == "CURRENT_TIMESTAMP":
+                translated.append(f"TO_CHAR({_UTC_NOW}, 'YYYY-MM-DD HH24:MI:SS')")
+            elif upper == "LIKE":
+                translated.append("ILIKE")
+            else:
+                translated.append(token)
+        else:
+            translated.append(token)
+
+    statement = "".join(translated).rstrip().rstrip(";")
+    if insert and insert.group(1):
+        statement += " ON CONFLICT DO NOTHING"
+    table = insert.group(3).strip('"').lower() if insert else None
+    return statement, table, names
+
+
+def _translate(sql):
+    """
+    Returns the cached translation of a statement.
+    """
+    translation = _translations.get(sql)
+    if translation is None:
+        if len(_translations) >= constants.PG_STATEMENT_CACHE_SIZE:
+            _translations.clear()
+        translation = _translations[sql] = translate_sql(sql)
+    return translation
+
+
+#################################################
+#   PostgreSQL connections                       #
+#################################################
+
+class Row:
+    """
+    Result row accessible by column index or (case-insensitive) name, like sqlite3.Row.
+    """
+    __slots__ = ("_values", "_columns")
+
+    def __init__(self, values, columns):
+        self._values = values
+        self._columns = columns
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._columns.index[key.lower()]]
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return isinstance(other, Row) and self._values == other._values
+
+    def keys(self):
+        return list(self._columns.names)
+
+
+class _Columns:
+    """
+    Column names of a result set and their positions (first wins), shared by its rows.
+    """
+    __slots__ = ("names", "index")
+
+    def __init__(self, description):
+        self.names = [column[0] for column in description]
+        self.index = {}
+        for position, name in enumerate(self.names):
+            self.index.setdefault(name.lower(), position)
+
+
+class PostgresCursor:
+    """
+    Cursor translating SQLite statements for PostgreSQL, reporting each
+    statement to the request instrumentation and the slow-query log.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.row_factory = connection.row_factory
+        self.lastrowid = None
+        self.description = None
+        self._cursor = connection.raw.cursor()
+        self._columns = None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def _described(self, names):
+        """
+        Sets the result's description, naming columns as the statement spells them.
+        """
+        self._columns = None
+        self.description = None if self._cursor.description is None else tuple(
+            (names.get(column[0], column[0]),) + tuple(column[1:]) for column in self._cursor.description)
+
+    def execute(self, sql, parameters=()):
+        self.description = None
+        self.lastrowid = None
+        if sql.lstrip()[:6].upper() == "PRAGMA":
+            return self
+        statement, table, names = _translate(sql)
+        id_column = _identity_column(self.connection.raw, table) if table else None
+        if id_column:
+            statement += f" RETURNING {_quote(id_column)}"
+
+        start = time.perf_counter()
+        try:
+            if _CREATE_RE.match(sql):
+                self._execute_schema_change(statement, parameters)
+            else:
+                self._cursor.execute(statement, tuple(parameters))
+        finally:
+            elapsed = time.perf_counter() - start
+            instrumentation.record_sql_statement(elapsed)
+        query_log.record(self.connection, sql, parameters, elapsed)
+        if id_column:
+            row = self._cursor.fetchone()
+            self.lastrowid = row[0] if row else None
+        else:
+            self._described(names)
+        return self
+
+    def _execute_schema_change(self, statement, parameters):
+        """
+        Executes a CREATE statement holding the schema lock, for the rest of
+        the transaction if one is open, else for the statement.
+        """
+        with self.connection.raw.cursor() as lock:
+            if self.connection.raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                lock.execute("SELECT pg_advisory_xact_lock(%s)", (_SCHEMA_LOCK_KEY,))
+                self._cursor.execute(statement, tuple(parameters))
+                return
+            lock.execute("SELECT pg_advisory_lock(%s)", (_SCHEMA_LOCK_KEY,))
+            try:
+                self._cursor.execute(statement, tuple(parameters))
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s)", (_SCHEMA_LOCK_KEY,))
+
+    def executemany(self, sql, seq_of_parameters):
+        self.description = None
+        statement, _, _ = _translate(sql)
+        rows = [tuple(row) for row in seq_of_parameters]
+        start = time.perf_counter()
+        try:
+            psycopg2.extras.execute_batch(self._cursor, statement, rows)
+        finally:
+            elapsed = time.perf_counter() - start
+            instrumentation.record_sql_statement(elapsed)
+        # Logged (and explained, if slow) with the first row's parameters
+        query_log.record(self.connection, sql, rows[0] if rows else (), elapsed)
+        return self
+
+    def _row(self, values):
+        if self.row_factory is None:
+            return values
+        if self._columns is None:
+            self._columns = _Columns(self.description)
+        return Row(values, self._columns)
+
+    def fetchone(self):
+        if self.description is None:
+            return None
+        row = self._cursor.fetchone()
+        return None if row is None else self._row(row)
+
+    def fetchmany(self, size=1):
+        if self.description is None:
+            return []
+        return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self):
+        if self.description is None:
+            return []
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+
+class PostgresConnection:
+    """
+    Pooled PostgreSQL connection with the parts of the sqlite3.Connection
+    interface used by the backend.  Connections are in autocommit mode (like
+    SQLite connections with isolation_level=None); explicit BEGIN/COMMIT
+    statements group writes into a transaction.  close() returns the
+    connection to the pool.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.row_factory = Row
+
+    def cursor(self):
+        return PostgresCursor(self)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if self.raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.raw.cursor().execute("COMMIT")
+
+    def rollback(self):
+        if self.raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.raw.cursor().execute("ROLLBACK")
+
+    def explain(self, sql, parameters):
+        """
+        Returns the query plan of a statement, for the slow-query log.
+        """
+        statement, _, _ = _translate(sql)
+        # In a transaction, a failed EXPLAIN must not abort the statements around it
+        in_transaction = self.raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            with self.raw.cursor() as cursor:
+                if in_transaction:
+                    cursor.execute("SAVEPOINT query_log_explain")
+                try:
+                    cursor.execute("EXPLAIN " + statement, tuple(parameters))
+                    return [row[0] for row in cursor.fetchall()]
+                except psycopg2.Error:
+                    if in_transaction:
+                        cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+                    raise
+                finally:
+                    if in_transaction:
+                        cursor.execute("RELEASE SAVEPOINT query_log_explain")
+        except (psycopg2.Error, IndexError, TypeError) as error:
+            # IndexError/TypeError: the parameters do not match the placeholders
+            return [f"EXPLAIN failed: {error!r}"]
+
+    def close(self):
+        if self.raw is None:
+            return
+        raw, self.raw = self.raw, None
+        pool, slots = _pool, _pool_slots
+        if pool is None:
+            raw.close()
+            return
+        try:
+            if raw.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+                raw.cursor().execute("ROLLBACK")
+            pool.putconn(raw, close=bool(raw.closed))
+        finally:
+            slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # Like sqlite3: commits (or rolls back) an open transaction, leaving the connection open
+        if self.raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def _identity_column(raw, table):
+    """
+    Returns the identity (auto-assigned id) column of a table, or None.
+    """
+    if table not in _identity_columns:
+        with raw.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT attname FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attidentity <> '' AND NOT attisdropped
+                """,
+                (_quote(table),))
+            row = cursor.fetchone()
+        _identity_columns[table] = row[0] if row else None
+    return _identity_columns[table]
+
+
+def _open_pool():
+    """
+    Creates the connection pool.  Must be called with _lock held.
+    """
+    global _pool, _pool_slots
+    if psycopg2 is None:
+        raise RuntimeError("DATABASE_URL selects PostgreSQL but psycopg2 is not installed")
+
+    # Numeric results (e.g. SUM) as int/float and bytea as bytes, as sqlite3 returns them
+    psycopg2.extensions.register_type(psycopg2.extensions.new_type(
+        psycopg2.extensions.DECIMAL.values, "BROADCASTR_NUMERIC",
+        lambda value, cursor: None if value is None else (int(value) if value.lstrip("-").isdigit() else float(value))))
+    psycopg2.extensions.register_type(psycopg2.extensions.new_type(
+        psycopg2.BINARY.values, "BROADCASTR_BYTEA",
+        lambda value, cursor: None if value is None else bytes(psycopg2.BINARY(value, cursor))))
+
+    pool = psycopg2.pool.ThreadedConnectionPool(
+        constants.PG_POOL_MIN_CONNECTIONS, constants.PG_POOL_MAX_CONNECTIONS, database_url())
+    _pool_slots = threading.BoundedSemaphore(constants.PG_POOL_MAX_CONNECTIONS)
+    _pool = pool
+
+
+def connect_postgres():
+    """
+    Checks a connection out of the PostgreSQL pool, waiting up to
+    constants.PG_POOL_TIMEOUT_SECONDS for one to be returned if all are in use.
+    Returns:
+        PostgresConnection
+    """
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _open_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=constants.PG_POOL_TIMEOUT_SECONDS):
+        raise RuntimeError("Timed out waiting for a PostgreSQL connection")
+    try:
+        raw = _pool.getconn()
+        raw.autocommit = True
+    except Exception:
+        slots.release()
+        raise
+    return PostgresConnection(raw)
+
+
+def reset_after_fork():
+    """
+    Forgets the parent process's connection pool (its sockets must not be
+    used by two processes); called in a new gunicorn worker (see gunicorn.conf.py).
+    """
+    global _lock, _pool, _pool_slots
+    _lock = threading.Lock()
+    _pool = None
+    _pool_slots = None
+
+
+#################################################
+#   Schema and data copy                         #
+#################################################
+
+def _pg_name(name):
+    return _quote(name.lower())
+
+
+def _postgres_type(table, column, sqlite_type):
+    override = _POSTGRES_COLUMN_TYPES.get((table, column))
+    if override:
+        return override
+    sqlite_type = sqlite_type.upper()
+    if "INT" in sqlite_type:
+        return "BIGINT"
+    if "REAL" in sqlite_type or "FLOA" in sqlite_type or "DOUB" in sqlite_type:
+        return "DOUBLE PRECISION"
+    if "BLOB" in sqlite_type:
+        return "BYTEA"
+    return "TEXT"
+
+
+def _postgres_default(default):
+    if default is None:
+        return ""
+    if default.upper() == "CURRENT_TIMESTAMP":
+        return f" DEFAULT TO_CHAR({_UTC_NOW}, 'YYYY-MM-DD HH24:MI:SS')"
+    return f" DEFAULT {default}"
+
+
+def copy_sqlite_to_postgres(sqlite_path, url=None, batch_size=5000):
+    """
+    Creates the tables and indexes of a SQLite database in PostgreSQL
+    (replacing any existing tables of the same names) and copies their rows.
+    Names are lower cased; INTEGER primary keys become identity columns
+    continuing from the SQLite sequence.
+    Foreign keys are not created, as SQLite does not enforce them here.
+    Empty strings stored in numeric columns are copied as NULL.
+    Args:
+        sqlite_path: path of the SQLite database to copy
+        url: PostgreSQL url (defaults to DATABASE_URL)
+        batch_size: rows inserted per batch
+    Returns:
+        dict of table name to number of rows copied
+    """
+    source = sqlite3.connect(sqlite_path)
+    target = psycopg2.connect(url or database_url())
+    counts = {}
+    try:
+        sequences = dict(source.execute("SELECT name, seq FROM sqlite_sequence").fetchall()) \
+            if source.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone() else {}
+        tables = [row[0] for row in source.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        with target, target.cursor() as cursor:
+            for table in tables:
+                columns = source.execute(f"PRAGMA table_info({_quote(table)})").fetchall()
+                key_columns = [column[1] for column in sorted(columns, key=lambda column: column[5]) if column[5]]
+                definitions = []
+                identity = None
+                for _, name, sqlite_type, not_null, default, primary_key in columns:
+                    column_type = _postgres_type(table, name, sqlite_type)
+                    if primary_key and len(key_columns) == 1 and column_type == "BIGINT":
+                        identity = name
+                        definitions.append(f"{_pg_name(name)} BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY")
+                    else:
+                        definitions.append(f"{_pg_name(name)} {column_type}{' NOT NULL' if not_null else ''}"
+                                           f"{_postgres_default(default)}")
+                if key_columns and not identity:
+                    definitions.append(f"PRIMARY KEY ({', '.join(_pg_name(name) for name in key_columns)})")
+
+                indexes = []
+                for _, index_name, unique, origin, _ in source.execute(f"PRAGMA index_list({_quote(table)})"):
+                    index_columns = ", ".join(_pg_name(row[2]) for row in
+                                              source.execute(f"PRAGMA index_info({_quote(index_name)})"))
+                    if origin == "u":
+                        definitions.append(f"UNIQUE ({index_columns})")
+                    elif origin == "c":
+                        indexes.append(f"CREATE {'UNIQUE ' if unique else ''}INDEX {_pg_name(index_name)} "
+                                       f"ON {_pg_name(table)} ({index_columns})")
+
+                cursor.execute(f"DROP TABLE IF EXISTS {_pg_name(table)} CASCADE")
+                cursor.execute(f"CREATE TABLE {_pg_name(table)} ({', '.join(definitions)})")
+
+                names = [column[1] for column in columns]
+                binary = [i for i, name in enumerate(names)
+                          if _postgres_type(table, name, columns[i][2]) == "BYTEA"]
+                # SQLite keeps values that do not fit a numeric column's type as
+                # text; empty strings (e.g. an unset Broadcast.RelatedID) are copied as NULL
+                numeric = [i for i, name in enumerate(names)
+                           if _postgres_type(table, name, columns[i][2]) in ("BIGINT", "DOUBLE PRECISION")]
+                rows = source.execute(f"SELECT {', '.join(_quote(name) for name in names)} FROM {_quote(table)}")
+                insert = f"INSERT INTO {_pg_name(table)} ({', '.join(_pg_name(name) for name in names)}) VALUES %s"
+                counts[table] = 0
+                while True:
+                    batch = rows.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    if binary or numeric:
+                        batch = [tuple(value.encode() if i in binary and isinstance(value, str)
+                                       else None if i in numeric and value == "" else value
+                                       for i, value in enumerate(row)) for row in batch]
+                    psycopg2.extras.execute_values(cursor, insert, batch, page_size=batch_size)
+                    counts[table] += len(batch)
+
+                for statement in indexes:
+                    cursor.execute(statement)
+                cursor.execute(f"ANALYZE {_pg_name(table)}")
+                if identity:
+                    cursor.execute(
+                        f"SELECT setval(pg_get_serial_sequence(%s, %s), "
+                        f"GREATEST(%s, (SELECT COALESCE(MAX({_pg_name(identity)}), 0) FROM {_pg_name(table)})) + 1, false)",
+                        (_pg_name(table), identity.lower(), sequences.get(table, 0)))
+    finally:
+        source.close()
+        target.close()
+    return counts
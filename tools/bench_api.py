@@ -0,0 +1,214 @@
+"""
+Load benchmark for the broadcastr API.
+
+Drives the read endpoints of api.py against a database (typically one made by
+generate_dataset.py), either in process through Flask's test client or over
+HTTP against a running server (e.g. a local gunicorn), and reports
+p50/p95/p99 latency and throughput per endpoint.  --db is the database the
+test client serves; with --base-url it is only read for the users and artists
+to request, so the server must serve the same database (sql_query.BROADCASTR_DB).
+
+Examples:
+    python tools/bench_api.py --db data/synthetic.db --requests 200 --concurrency 4
+    gunicorn -w 4 api:app &  # serving sql_query.BROADCASTR_DB
+    python tools/bench_api.py --db data/broadcastr.db --base-url http://127.0.0.1:8000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bench_util
+
+import sql_query
+
+
+def _sample_values(db_path, rng):
+    """
+    Picks realistic request arguments from the benchmark database.
+    """
+    connection = sqlite3.connect(db_path)
+    users = [row[0] for row in connection.execute(
+        "SELECT LastFmProfileName FROM User WHERE UserID <> 1 ORDER BY RANDOM() LIMIT 200")]
+    artists = [row[0] for row in connection.execute(
+        """
+        SELECT Artist.ArtistName
+        FROM Artist
+        INNER JOIN TopArtist ON TopArtist.ArtistID = Artist.ArtistID
+        GROUP BY Artist.ArtistID
+        ORDER BY COUNT(*) DESC
+        LIMIT 200
+        """)]
+    artist_ids = [row[0] for row in connection.execute("SELECT ArtistID FROM Artist LIMIT 200")]
+    connection.close()
+    rng.shuffle(artists)
+    return users, artists or ["unknown"], artist_ids or [1]
+
+
+def build_endpoints(users, artists, artist_ids, rng):
+    """
+    Returns a dict of endpoint name to a function producing a request path.
+    Only read (GET) endpoints are included so benchmark runs are repeatable.
+    """
+    def user():
+        return rng.choice(users)
+
+    return {
+        "/api/get-broadcasts":
+            lambda: "/api/get-broadcasts?limit=50",
+        "/api/get-broadcasts (user)":
+            lambda: f"/api/get-broadcasts?user={user()}&limit=50",
+        "/api/get-song-swaps":
+            lambda: f"/api/get-song-swaps?user={user()}&limit=50",
+        "/api/user/profile":
+            lambda: f"/api/user/profile?user={user()}",
+        "/api/user/get-users":
+            lambda: "/api/user/get-users?includebootstrapped=1&limit=50",
+        "/api/user/followers":
+            lambda: f"/api/user/followers?user={user()}",
+        "/api/user/following":
+            lambda: f"/api/user/following?user={user()}",
+        "/api/user/conversations":
+            lambda: f"/api/user/conversations?user={user()}",
+        "/api/user/top-artists":
+            lambda: f"/api/user/top-artists?user={user()}&period=overall&limit=10",
+        "/api/user/top-tracks":
+            lambda: f"/api/user/top-tracks?user={user()}&period=overall&limit=10",
+        "/api/user/top-broadcasted-tracks":
+            lambda: f"/api/user/top-broadcasted-tracks?user={user()}&limit=10",
+        "/api/artist/top-listeners":
+            lambda: f"/api/artist/top-listeners?artist={rng.choice(artists)}&period=overall&limit=5",
+        "/api/artist/by-id":
+            lambda: f"/api/artist/by-id?id={rng.choice(artist_ids)}",
+        "/api/leaderboard":
+            lambda: "/api/leaderboard?board=swag&limit=10",
+    }
+
+
+def make_client(base_url):
+    """
+    Returns a function that performs a GET and returns the status code.
+    """
+    if base_url:
+        import requests
+        session_local = threading.local()
+
+        def http_get(path):
+            if not hasattr(session_local, "session"):
+                session_local.session = requests.Session()
+            return session_local.session.get(base_url + path).status_code
+        return http_get
+
+    import api
+    client_local = threading.local()
+
+    def test_client_get(path):
+        if not hasattr(client_local, "client"):
+            client_local.client = api.app.test_client()
+        return client_local.client.get(path).status_code
+    return test_client_get
+
+
+def check_cold_index():
+    """
+    Checks that, with no top artist index file, the first lookup returns None
+    at once (starting a build in the background) instead of blocking.
+    """
+    import top_artist_index
+
+    work_dir = tempfile.mkdtemp(prefix="broadcastr-index-")
+    index_path = top_artist_index.INDEX_PATH
+    top_artist_index.INDEX_PATH = os.path.join(work_dir, "top_artist_index.bin")
+    try:
+        results = []
+        lookup = threading.Thread(target=lambda: results.append(top_artist_index.snapshot()), daemon=True)
+        lookup.start()
+        lookup.join(5)
+        if lookup.is_alive():
+            raise SystemExit("top_artist_index.snapshot() blocked with no index file")
+        if results != [None]:
+            raise SystemExit(f"top_artist_index.snapshot() returned {results[0]!r} with no index file")
+        # Let the background build finish before the index path is restored
+        while top_artist_index._rebuilding:  # pylint: disable=protected-access
+            time.sleep(0.05)
+    finally:
+        top_artist_index.INDEX_PATH = index_path
+        top_artist_index._snapshot = None  # pylint: disable=protected-access
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_endpoint(get, make_path, requests_per_endpoint, concurrency):
+    """
+    Issues requests against one endpoint and returns (latencies, errors, wall seconds).
+    """
+    paths = [make_path() for _ in range(requests_per_endpoint)]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(path):
+        nonlocal errors
+        start = time.perf_counter()
+        status = get(path)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, paths))
+    return latencies, errors, time.perf_counter() - wall_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=sql_query.BROADCASTR_DB, help="database to benchmark against")
+    parser.add_argument("--base-url", default="", help="benchmark a running server instead of the test client")
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per endpoint")
+    parser.add_argument("--endpoint", action="append", default=[],
+                        help="only benchmark endpoints containing this text (repeatable)")
+    parser.add_argument("--seed", type=int, default=278)
+    args = parser.parse_args()
+
+    # Must be set before api (and db_query) are imported
+    sql_query.BROADCASTR_DB = args.db
+
+    rng = random.Random(args.seed)
+    users, artists, artist_ids = _sample_values(args.db, rng)
+    endpoints = build_endpoints(users, artists, artist_ids, rng)
+    if args.endpoint:
+        endpoints = {name: make_path for name, make_path in endpoints.items()
+                     if any(text in name for text in args.endpoint)}
+
+    if not args.base_url:
+        check_cold_index()
+    get = make_client(args.base_url)
+
+    results = {}
+    total_errors = 0
+    for name, make_path in endpoints.items():
+        for _ in range(args.warmup):
+            get(make_path())
+        latencies, errors, wall_seconds = run_endpoint(get, make_path, args.requests, args.concurrency)
+        results[name] = bench_util.summarize(latencies, wall_seconds)
+        total_errors += errors
+        if errors:
+            print(f"{name}: {errors} error responses")
+
+    target = args.base_url or f"test client ({args.db})"
+    bench_util.print_table(f"API benchmark against {target}, concurrency {args.concurrency}", results)
+    if total_errors:
+        print(f"{total_errors} requests returned an error status")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Benchmarks request concurrency of the WSGI (gunicorn gthread) and ASGI
+(uvicorn, asgi.py) server modes while Last.fm is slow.
+
+Starts the local Last.fm stub (in its own process, so its CPU use does not
+compete with the clients) with the given latency, then for each mode
+starts a one-process server with the same number of threads on a copy of the
+database and drives the Last.fm-bound routes (/api/artist/listens and
+/api/artist/top-listeners, with users/artists that are not stored locally so
+every request falls back to Last.fm) with many concurrent clients.  In WSGI
+mode throughput is capped near threads / latency; in ASGI mode requests
+waiting on Last.fm do not hold a thread.
+
+Example:
+    python tools/bench_async.py --db data/synthetic.db --latency-ms 200 --threads 4 --concurrency 64
+"""
+import argparse
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import bench_util
+
+import requests
+
+import sql_query
+
+MODES = {
+    "wsgi": lambda port, threads: [sys.executable, "-m", "gunicorn", "-w", "1", "-k", "gthread",
+                                   "--threads", str(threads), "-b", f"127.0.0.1:{port}", "api:app"],
+    "asgi": lambda port, threads: [sys.executable, "-m", "uvicorn", "--port", str(port),
+                                   "--no-access-log", "asgi:application"],
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _sample_paths(db_path, count, rng):
+    """
+    Builds request paths for user/artist pairs with no stored TopArtist row,
+    so each request calls Last.fm.
+    """
+    connection = sqlite3.connect(db_path)
+    users = [row[0] for row in connection.execute(
+        "SELECT LastFmProfileName FROM User WHERE UserID <> 1 ORDER BY UserID LIMIT 500")]
+    artists = [row[0] for row in connection.execute("SELECT ArtistName FROM Artist ORDER BY ArtistID LIMIT 500")]
+    connection.close()
+
+    paths = []
+    for i in range(count):
+        user = rng.choice(users)
+        artist = f"Unstored Artist {rng.randrange(1000000)}"
+        if i % 2 == 0:
+            paths.append("/api/artist/listens?" + urlencode({"user": user, "artist": artist, "period": "overall"}))
+        else:
+            paths.append("/api/artist/top-listeners?" + urlencode(
+                {"artist": rng.choice(artists), "period": "7day", "limit": 5, "current_user": user}))
+    return paths
+
+
+def _wait_ready(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            requests.get(base_url + "/api/debug/response-cache", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def run_mode(mode, work_dir, stub_url, threads, paths, concurrency):
+    """
+    Starts a server in the given mode and issues the requests against it.
+    Returns:
+        (latencies, errors, wall seconds)
+    """
+    port = _free_port()
+    env = dict(os.environ, PYTHONPATH=bench_util.REPO_ROOT, LAST_FM_API_BASE_URL=stub_url,
+               ASGI_THREADS=str(threads))
+    process = subprocess.Popen(MODES[mode](port, threads), cwd=work_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    session_local = threading.local()
+
+    def one(path):
+        nonlocal errors
+        if not hasattr(session_local, "session"):
+            session_local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = session_local.session.get(base_url + path, timeout=60).status_code
+        except requests.RequestException:
+            status = 599
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    try:
+        _wait_ready(base_url, process)
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, paths))
+        return latencies, errors, time.perf_counter() - wall_start
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=sql_query.BROADCASTR_DB, help="database to serve (a temporary copy is used)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per mode")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent clients")
+    parser.add_argument("--threads", type=int, default=4, help="server threads in both modes")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="simulated Last.fm latency")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--mode", action="append", choices=sorted(MODES), default=[],
+                        help="mode to benchmark (repeatable; default: all)")
+    parser.add_argument("--seed", type=int, default=278)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="broadcastr-async-")
+    os.makedirs(os.path.join(work_dir, "data"))
+    db_copy = os.path.join(work_dir, "data", "broadcastr.db")
+    shutil.copyfile(args.db, db_copy)
+
+    stub_port = _free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(bench_util.REPO_ROOT, "tools", "lastfm_stub.py"),
+                             "--port", str(stub_port), "--latency-ms", str(args.latency_ms),
+                             "--jitter-ms", str(args.jitter_ms)], stdout=subprocess.DEVNULL)
+    stub_url = f"http://127.0.0.1:{stub_port}/2.0/"
+
+    paths = _sample_paths(db_copy, args.requests, random.Random(args.seed))
+    results = {}
+    try:
+        for mode in args.mode or sorted(MODES, reverse=True):
+            latencies, errors, wall_seconds = run_mode(mode, work_dir, stub_url, args.threads,
+                                                       paths, args.concurrency)
+            results[mode] = bench_util.summarize(latencies, wall_seconds)
+            print(f"{mode}: {errors} errors")
+    finally:
+        stub.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    bench_util.print_table(
+        f"Async benchmark: {args.requests} requests, {args.concurrency} clients, {args.threads} server threads, "
+        f"stub latency {args.latency_ms} ms", results)
+
+
+if __name__ == "__main__":
+    main()
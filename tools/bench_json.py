@@ -0,0 +1,121 @@
+"""
+Benchmarks JSON serialization of the list endpoints.
+
+For /api/get-broadcasts, /api/get-song-swaps and /api/user/get-users this
+compares the per-request CPU time of the previous response path (copy each
+sqlite3.Row into a dict, then jsonify) against json_response.rows_response
+(column-to-key mapping over tuple rows, encoded with orjson when installed).
+Both paths serialize the same query result, and the decoded payloads are
+checked to be identical.
+
+Example:
+    python tools/bench_json.py --db data/synthetic.db --limit 500 --iterations 200
+"""
+import argparse
+import json
+import sqlite3
+import time
+
+import bench_util
+
+import sql_query
+
+QUERIES = {
+    "/api/get-broadcasts": ("broadcasts", "/api/get-broadcasts?limit={limit}"),
+    "/api/get-song-swaps": ("songSwaps", "/api/get-song-swaps?limit={limit}"),
+    "/api/user/get-users": ("userProfile", "/api/user/get-users?includebootstrapped=1&limit={limit}"),
+}
+
+
+def capture_query(app, path):
+    """
+    Runs a route once and captures the SQL and parameters of its list query
+    (the last statement it executes).
+    """
+    captured = {}
+    original_execute = sql_query.TimedConnection.execute
+
+    def capturing_execute(self, sql, parameters=()):
+        captured["sql"], captured["parameters"] = sql, parameters
+        return original_execute(self, sql, parameters)
+
+    sql_query.TimedConnection.execute = capturing_execute
+    try:
+        app.test_client().get(path).get_data()
+    finally:
+        sql_query.TimedConnection.execute = original_execute
+    return captured["sql"], captured["parameters"]
+
+
+def query_only(db_path, sql, parameters):
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    connection.execute(sql, parameters).fetchall()
+    connection.close()
+
+
+def jsonify_path(app, key, db_path, sql, parameters):
+    from flask import jsonify
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    rows = connection.execute(sql, parameters).fetchall()
+    connection.close()
+    with app.app_context():
+        return jsonify({key: [{name: row[name] for name in row.keys()} for row in rows]}).get_data()
+
+
+def rows_response_path(app, key, db_path, sql, parameters):
+    import json_response
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    cursor = connection.execute(sql, parameters)
+    with app.test_request_context():
+        return b"".join(json_response.rows_response(key, cursor, connection).response)
+
+
+def measure(function, iterations):
+    """
+    Returns (per-call CPU seconds, per-call wall seconds) of function().
+    """
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return ((time.process_time() - cpu_start) / iterations,
+            (time.perf_counter() - wall_start) / iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=sql_query.BROADCASTR_DB, help="database to benchmark against")
+    parser.add_argument("--limit", type=int, default=500, help="rows per response")
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    sql_query.BROADCASTR_DB = args.db
+    import api
+    import json_response
+
+    print(f"encoder: {'orjson' if json_response.orjson is not None else 'json (orjson not installed)'}")
+    print("CPU ms per request; the query column is the part spent running the SQL, "
+          "and speedup compares serialization time only")
+    print(f"{'endpoint':<22}  {'rows':>6}  {'bytes':>9}  {'query':>8}  {'jsonify':>8}  "
+          f"{'fast':>8}  {'speedup':>8}")
+    for name, (key, path) in QUERIES.items():
+        sql, parameters = capture_query(api.app, path.format(limit=args.limit))
+
+        old_body = jsonify_path(api.app, key, args.db, sql, parameters)
+        new_body = rows_response_path(api.app, key, args.db, sql, parameters)
+        if json.loads(old_body) != json.loads(new_body):
+            raise SystemExit(f"{name}: payloads differ")
+
+        query_cpu, _ = measure(lambda: query_only(args.db, sql, parameters), args.iterations)
+        old_cpu, _ = measure(lambda: jsonify_path(api.app, key, args.db, sql, parameters), args.iterations)
+        new_cpu, _ = measure(lambda: rows_response_path(api.app, key, args.db, sql, parameters), args.iterations)
+        rows = len(json.loads(new_body)[key])
+        old_serialize, new_serialize = max(old_cpu - query_cpu, 0), max(new_cpu - query_cpu, 0)
+        print(f"{name:<22}  {rows:>6}  {len(new_body):>9}  {query_cpu * 1000:>8.2f}  {old_cpu * 1000:>8.2f}  "
+              f"{new_cpu * 1000:>8.2f}  {old_serialize / new_serialize if new_serialize else 0:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
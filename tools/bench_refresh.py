@@ -0,0 +1,98 @@
+"""
+Benchmarks the Last.fm refresh pipeline (db_query.refresh_user_data) offline.
+
+Starts the local Last.fm stub, points db_query at it, and refreshes a sample of
+users from a copy of the benchmark database, reporting refresh throughput
+(users per minute), per-user refresh latency, and failures.
+
+Example:
+    python tools/bench_refresh.py --db data/synthetic.db --users 50 --workers 4 --latency-ms 80
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bench_util
+import lastfm_stub
+
+import sql_query
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=sql_query.BROADCASTR_DB,
+                        help="database to refresh users from (a temporary copy is modified)")
+    parser.add_argument("--users", type=int, default=20, help="number of users to refresh")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent refreshes")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="simulated Last.fm latency")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--max-rps", type=float, default=0.0, help="stub rate limit (0 = unlimited)")
+    parser.add_argument("--no-sleep", action="store_true",
+                        help="disable the politeness sleep between Last.fm calls")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="broadcastr-refresh-")
+    db_copy = os.path.join(work_dir, "broadcastr.db")
+    shutil.copyfile(args.db, db_copy)
+
+    connection = sqlite3.connect(db_copy)
+    users = [row[0] for row in connection.execute(
+        "SELECT LastFmProfileName FROM User WHERE UserID <> 1 ORDER BY UserID LIMIT ?", (args.users,))]
+    connection.close()
+
+    options = lastfm_stub.StubOptions(args.latency_ms, args.jitter_ms, args.error_rate,
+                                      args.rate_limit_rate, args.max_rps)
+    server, stub_url, _, stub_stats = lastfm_stub.start_stub(options=options)
+
+    # Must be set before db_query is imported
+    sql_query.BROADCASTR_DB = db_copy
+    os.environ["LAST_FM_API_BASE_URL"] = stub_url
+    import constants
+    import db_query
+    db_query.base_url = stub_url
+    if args.no_sleep:
+        constants.LAST_FM_API_CALL_SLEEP_TIME = 0
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def refresh(username):
+        start = time.perf_counter()
+        try:
+            db_query.refresh_user_data(username)
+        except Exception as error:  # pylint: disable=broad-except
+            with lock:
+                failures.append((username, repr(error)))
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(refresh, users))
+    wall_seconds = time.perf_counter() - wall_start
+
+    server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = bench_util.summarize(latencies, wall_seconds)
+    bench_util.print_table(
+        f"Refresh benchmark: {len(users)} users, {args.workers} workers, "
+        f"stub latency {args.latency_ms} ms", {"refresh_user_data": summary})
+    print(f"users per minute: {summary['throughput'] * 60:.1f}")
+    print(f"failed refreshes: {len(failures)}")
+    for username, error in failures[:10]:
+        print(f"    {username}: {error}")
+    print(f"stub requests: {stub_stats.as_dict()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmarks building and serving related artists and similar users (similarity.py).
+
+Builds both files from a copy of the benchmark database, reporting the time
+of each build phase, the size of the input and of the results, and then the
+latency of /api/artist/related and /api/user/similar-users served from the
+memory-mapped files.  For comparison, the same related artists are also
+computed on demand with a SQL self-join of TopArtist for a few artists.
+
+Example:
+    python tools/bench_similarity.py --db data/synthetic.db --requests 500
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import bench_util
+
+import sql_query
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=sql_query.BROADCASTR_DB,
+                        help="database to build from (a temporary copy is used)")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--sql-artists", type=int, default=5,
+                        help="artists whose related artists are also computed with SQL")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="broadcastr-similarity-")
+    db_copy = os.path.join(work_dir, "broadcastr.db")
+    shutil.copyfile(args.db, db_copy)
+
+    # Must be set before the app is imported
+    sql_query.BROADCASTR_DB = db_copy
+    import api
+    import constants
+    import similarity
+    similarity.RELATED_ARTISTS_PATH = os.path.join(work_dir, "related_artists.bin")
+    similarity.SIMILAR_USERS_PATH = os.path.join(work_dir, "similar_users.bin")
+    if not similarity.enabled():
+        raise SystemExit("NumPy is required to build similarity")
+
+    connection = sql_query.get_db_connection()
+    counts = {table: connection.execute(
+        f"SELECT COUNT(*) FROM {table} INNER JOIN Period ON {table}.PeriodID = Period.PeriodID "
+        "WHERE Period.PeriodName = ?", (constants.SIMILARITY_PERIOD,)).fetchone()[0]
+        for table in ("TopArtist", "TopTrack")}
+    artists = [row[0] for row in connection.execute(
+        "SELECT DISTINCT Artist.ArtistName FROM Artist INNER JOIN TopArtist ON Artist.ArtistID = TopArtist.ArtistID")]
+    users = [row[0] for row in connection.execute("SELECT LastFmProfileName FROM User WHERE UserID <> 1")]
+
+    timings = similarity.build()
+    print(f"Similarity build ({constants.SIMILARITY_PERIOD}): {counts['TopArtist']} TopArtist rows, "
+          f"{counts['TopTrack']} TopTrack rows")
+    for name, seconds in timings.items():
+        print(f"    {name:<22} {seconds * 1000:>10.1f} ms")
+    print(f"    {'total':<22} {sum(timings.values()) * 1000:>10.1f} ms")
+    for path in (similarity.RELATED_ARTISTS_PATH, similarity.SIMILAR_USERS_PATH):
+        rows = len(similarity._load(path).arrays["indices"])  # pylint: disable=protected-access
+        print(f"{os.path.basename(path)}: {rows} neighbours, {os.path.getsize(path) / 1024:.0f} KiB")
+
+    client = api.app.test_client()
+    rng = random.Random(args.seed)
+    results = {}
+    for name, path, names in (("/api/artist/related", "/api/artist/related?artist={}&limit=10", artists),
+                              ("/api/user/similar-users", "/api/user/similar-users?user={}&limit=10", users)):
+        latencies = []
+        wall_start = time.perf_counter()
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            response = client.get(path.format(rng.choice(names)))
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.status_code
+        results[name] = bench_util.summarize(latencies, time.perf_counter() - wall_start)
+
+    # The on-demand alternative: co-occurrence counts of one artist with every other
+    latencies = []
+    wall_start = time.perf_counter()
+    for artist in rng.sample(artists, min(args.sql_artists, len(artists))):
+        start = time.perf_counter()
+        connection.execute(
+            "SELECT Other.ArtistID, COUNT(*) AS Shared FROM TopArtist AS Mine "
+            "INNER JOIN TopArtist AS Other ON Mine.UserID = Other.UserID AND Mine.PeriodID = Other.PeriodID "
+            "INNER JOIN Artist ON Mine.ArtistID = Artist.ArtistID "
+            "INNER JOIN Period ON Mine.PeriodID = Period.PeriodID "
+            "WHERE Artist.ArtistName = ? AND Period.PeriodName = ? AND Other.ArtistID <> Mine.ArtistID "
+            "GROUP BY Other.ArtistID ORDER BY Shared DESC LIMIT 10",
+            (artist, constants.SIMILARITY_PERIOD)).fetchall()
+        latencies.append(time.perf_counter() - start)
+    results["SQL self-join (related)"] = bench_util.summarize(latencies, time.perf_counter() - wall_start)
+    connection.close()
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    bench_util.print_table(f"Similarity lookups: {args.requests} requests per endpoint", results)
+
+
+if __name__ == "__main__":
+    main()
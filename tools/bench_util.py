@@ -0,0 +1,59 @@
+"""
+This module provides shared helpers for the broadcastr benchmark scripts.
+"""
+import os
+import sys
+
+# Benchmark scripts live in tools/ but import the backend modules from the repo root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the nearest-rank percentile of an already sorted list.
+    Args:
+        sorted_values: list of numbers sorted ascending
+        fraction: percentile as a fraction, e.g. 0.95
+    Returns:
+        the percentile value (0 for an empty list)
+    """
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, wall_seconds):
+    """
+    Summarizes a list of latencies (in seconds).
+    Returns:
+        dict with count, p50/p95/p99/max in milliseconds and throughput per second
+    """
+    ordered = sorted(latencies)
+    return {
+        "count":        len(ordered),
+        "p50_ms":       percentile(ordered, 0.50) * 1000,
+        "p95_ms":       percentile(ordered, 0.95) * 1000,
+        "p99_ms":       percentile(ordered, 0.99) * 1000,
+        "max_ms":       (ordered[-1] * 1000) if ordered else 0,
+        "throughput":   len(ordered) / wall_seconds if wall_seconds > 0 else 0,
+    }
+
+
+def print_table(title, results):
+    """
+    Prints benchmark summaries as an aligned table.
+    Args:
+        title: heading printed above the table
+        results: dict of row name to a summarize() result
+    """
+    print(title)
+    width = max([len(name) for name in results] + [8])
+    print(f"{'name':<{width}}  {'count':>7}  {'p50 ms':>9}  {'p95 ms':>9}  {'p99 ms':>9}  "
+          f"{'max ms':>9}  {'req/s':>9}")
+    for name, summary in results.items():
+        print(f"{name:<{width}}  {summary['count']:>7}  {summary['p50_ms']:>9.2f}  "
+              f"{summary['p95_ms']:>9.2f}  {summary['p99_ms']:>9.2f}  {summary['max_ms']:>9.2f}  "
+              f"{summary['throughput']:>9.1f}")
@@ -0,0 +1,275 @@
+"""
+Generates a synthetic, schema-compatible broadcastr database for load testing.
+
+The schema and reference data (Period, RelatedType, SongSwapReaction, Config,
+Version) are copied from a template database (data/broadcastr.db by default).
+Users, artists, tracks, top artist/track data, broadcasts, likes, direct
+messages, followings, and song swaps are then generated with power-law (Zipf)
+distributions, so a few artists/users/broadcasts are very popular and most
+are in the long tail, as in real listening and social data.
+
+Example:
+    python tools/generate_dataset.py --output data/synthetic.db --users 5000
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import bench_util
+
+import constants
+import related_type_enum
+
+REFERENCE_TABLES = ("Period", "RelatedType", "SongSwapReaction", "Config", "Version")
+
+TOP_ARTISTS_PER_PERIOD = 20
+TOP_TRACKS_PER_PERIOD = 50
+
+
+class ZipfSampler:
+    """
+    Samples 1-based ranks in [1, n] with probability proportional to 1/rank^exponent.
+    """
+
+    def __init__(self, rng, n, exponent):
+        self._rng = rng
+        self._cumulative = list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, n + 1)))
+
+    def sample(self):
+        """
+        Returns a single rank.
+        """
+        return bisect.bisect_left(self._cumulative, self._rng.random() * self._cumulative[-1]) + 1
+
+    def sample_distinct(self, count):
+        """
+        Returns up to count distinct ranks, most popular ranks being most likely.
+        """
+        count = min(count, len(self._cumulative))
+        chosen = set()
+        attempts = 0
+        while len(chosen) < count and attempts < count * 20:
+            chosen.add(self.sample())
+            attempts += 1
+        return list(chosen)
+
+
+def _timestamp(rng, now, max_days):
+    return (now - timedelta(seconds=rng.randint(0, max_days * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def copy_schema(template_path, connection):
+    """
+    Creates the template database's tables/indexes in a new database and copies
+    its reference data.
+    """
+    template = sqlite3.connect(template_path)
+    for (sql,) in template.execute(
+            """
+            SELECT sql
+            FROM sqlite_master
+            WHERE sql IS NOT NULL
+                AND name NOT LIKE 'sqlite_%'
+            ORDER BY CASE type WHEN 'table' THEN 0 ELSE 1 END
+            """):
+        connection.execute(sql)
+    for table in REFERENCE_TABLES:
+        rows = template.execute(f"SELECT * FROM {table}").fetchall()
+        if rows:
+            placeholders = ", ".join("?" for _ in rows[0])
+            connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+    template.close()
+
+
+def generate(connection, args):
+    """
+    Fills a database (with schema already created) with synthetic data.
+    Returns:
+        dict of table name to number of generated rows
+    """
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    counts = {}
+
+    period_ids = dict(connection.execute("SELECT PeriodName, PeriodID FROM Period"))
+
+    # Users (UserID 1 is the system account)
+    users = [(constants.SYSTEM_ACCOUNT_ID, "System", "System", "Account", "", "", "", "",
+              0, 0, "", "", "", "", "", constants.SWAG_STARTING_BALANCE)]
+    for user_id in range(2, args.users + 2):
+        name = f"synth_user_{user_id}"
+        pfp = f"https://lastfm.freetls.fastly.net/i/u/avatar/{user_id}.png"
+        users.append((user_id, name, f"First{user_id}", f"Last{user_id}",
+                      f"{name}@example.edu", f"https://www.last.fm/user/{name}", "", "",
+                      1 if rng.random() < 0.2 else 0, 0, _timestamp(rng, now, 30),
+                      pfp, pfp, pfp, pfp, rng.randint(0, 50)))
+    connection.executemany(f"INSERT INTO User VALUES ({', '.join('?' * 16)})", users)
+    user_ids = [user[0] for user in users[1:]]
+    counts["User"] = len(users)
+
+    connection.executemany(
+        "INSERT INTO Artist (ArtistID, ArtistName, LastFmMbid) VALUES (?, ?, '')",
+        ((artist_id, f"Synthetic Artist {artist_id}") for artist_id in range(1, args.artists + 1)))
+    counts["Artist"] = args.artists
+
+    artist_sampler = ZipfSampler(rng, args.artists, args.zipf)
+    tracks_by_artist = {}
+    track_rows = []
+    for track_id in range(1, args.tracks + 1):
+        artist_id = artist_sampler.sample()
+        tracks_by_artist.setdefault(artist_id, []).append(track_id)
+        track_rows.append((track_id, f"Synthetic Track {track_id}", artist_id, "",
+                           f"https://www.last.fm/music/Synthetic+Artist+{artist_id}/_/Synthetic+Track+{track_id}"))
+    connection.executemany(
+        "INSERT INTO Track (TrackID, TrackName, ArtistID, MBID, LastFmTrackUrl) VALUES (?, ?, ?, ?, ?)",
+        track_rows)
+    counts["Track"] = args.tracks
+
+    # Top artists/tracks: each user's listening is drawn from the global popularity curve
+    track_sampler = ZipfSampler(rng, args.tracks, args.zipf)
+    top_artist_rows = []
+    top_track_rows = []
+    for user_id in user_ids:
+        last_updated = _timestamp(rng, now, 3)
+        scale = rng.paretovariate(1.5)
+        for period in constants.REFRESH_PERIODS:
+            period_id = period_ids[period]
+            period_scale = {"7day": 1, "1month": 4, "12month": 40}.get(period, 120) * scale
+            for rank, artist_id in enumerate(artist_sampler.sample_distinct(TOP_ARTISTS_PER_PERIOD), 1):
+                top_artist_rows.append((user_id, artist_id, period_id,
+                                        max(1, int(200 * period_scale / rank)), last_updated))
+            for rank, track_id in enumerate(track_sampler.sample_distinct(TOP_TRACKS_PER_PERIOD), 1):
+                top_track_rows.append((user_id, track_id, period_id,
+                                       max(1, int(40 * period_scale / rank)), last_updated))
+    connection.executemany(
+        "INSERT INTO TopArtist (UserID, ArtistID, PeriodID, Playcount, LastUpdated) VALUES (?, ?, ?, ?, ?)",
+        top_artist_rows)
+    connection.executemany(
+        "INSERT INTO TopTrack (UserID, TrackID, PeriodID, Playcount, LastUpdated) VALUES (?, ?, ?, ?, ?)",
+        top_track_rows)
+    counts["TopArtist"] = len(top_artist_rows)
+    counts["TopTrack"] = len(top_track_rows)
+
+    # Social activity is concentrated in a minority of very active users
+    user_sampler = ZipfSampler(rng, len(user_ids), args.zipf)
+
+    def sample_user():
+        return user_ids[user_sampler.sample() - 1]
+
+    broadcast_rows = []
+    for broadcast_id in range(1, args.broadcasts + 1):
+        if rng.random() < 0.3:
+            broadcast_rows.append((broadcast_id, constants.SYSTEM_ACCOUNT_ID, "New Broadcastr",
+                                   "Synthetic system broadcast", related_type_enum.RelatedType.USER.value,
+                                   sample_user(), _timestamp(rng, now, 90), 0))
+        else:
+            broadcast_rows.append((broadcast_id, sample_user(), f"Broadcast {broadcast_id}",
+                                   "Synthetic broadcast body", related_type_enum.RelatedType.TRACK.value,
+                                   track_sampler.sample(), _timestamp(rng, now, 90),
+                                   1 if rng.random() < 0.02 else 0))
+    connection.executemany(
+        "INSERT INTO Broadcast (BroadcastID, UserID, Title, Body, RelatedTypeID, RelatedID, "
+        "Timestamp, Deleted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        broadcast_rows)
+    counts["Broadcast"] = len(broadcast_rows)
+
+    if broadcast_rows:
+        broadcast_sampler = ZipfSampler(rng, len(broadcast_rows), args.zipf)
+        likes = set()
+        attempts = 0
+        while len(likes) < args.likes and attempts < args.likes * 5:
+            likes.add((sample_user(), broadcast_rows[broadcast_sampler.sample() - 1][0]))
+            attempts += 1
+        connection.executemany(
+            "INSERT INTO Like (UserID, RelatedID, RelatedTypeID, Timestamp) VALUES (?, ?, ?, ?)",
+            ((user_id, broadcast_id, str(related_type_enum.RelatedType.BROADCAST.value),
+              _timestamp(rng, now, 90)) for user_id, broadcast_id in likes))
+        counts["Like"] = len(likes)
+
+    followings = set()
+    attempts = 0
+    while len(followings) < args.followings and attempts < args.followings * 5:
+        follower_id, followee_id = rng.choice(user_ids), sample_user()
+        if follower_id != followee_id:
+            followings.add((follower_id, followee_id))
+        attempts += 1
+    connection.executemany(
+        "INSERT INTO Following (FollowerID, FolloweeID, FollowingSince) VALUES (?, ?, ?)",
+        ((follower_id, followee_id, _timestamp(rng, now, 180)) for follower_id, followee_id in followings))
+    counts["Following"] = len(followings)
+
+    message_rows = []
+    for _ in range(args.messages):
+        sender_id, recipient_id = sample_user(), sample_user()
+        if sender_id != recipient_id:
+            message_rows.append((sender_id, recipient_id, "Synthetic message",
+                                 _timestamp(rng, now, 60), 1 if rng.random() < 0.7 else 0))
+    connection.executemany(
+        "INSERT INTO DirectMessage (SenderID, RecipientID, MessageBody, TimeSent, Read) VALUES (?, ?, ?, ?, ?)",
+        message_rows)
+    counts["DirectMessage"] = len(message_rows)
+
+    swap_rows = []
+    for _ in range(args.song_swaps):
+        initiated_id, matched_id = sample_user(), rng.choice(user_ids)
+        if initiated_id == matched_id:
+            continue
+        started = _timestamp(rng, now, 60)
+        completed = rng.random() < 0.6
+        swap_rows.append((initiated_id, matched_id, track_sampler.sample(),
+                          track_sampler.sample() if completed else None,
+                          rng.randint(1, 5) if completed else None,
+                          rng.randint(1, 5) if completed else None,
+                          started, started, started if completed else None,
+                          started if completed else None, started if completed else None))
+    connection.executemany(
+        "INSERT INTO SongSwap (InitiatedUserID, MatchedUserID, InitiatedTrackID, MatchedTrackID, "
+        "InitiatedReaction, MatchedReaction, SwapInitiatedTimestamp, InitiatedTrackTimestamp, "
+        "MatchedTrackTimestamp, InitiatedReactionTimestamp, MatchedReactionTimestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        swap_rows)
+    counts["SongSwap"] = len(swap_rows)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="data/synthetic.db", help="path of the database to create")
+    parser.add_argument("--template", default=os.path.join(bench_util.REPO_ROOT, "data", "broadcastr.db"),
+                        help="database to copy the schema and reference data from")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--artists", type=int, default=5000)
+    parser.add_argument("--tracks", type=int, default=20000)
+    parser.add_argument("--broadcasts", type=int, default=5000)
+    parser.add_argument("--likes", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--followings", type=int, default=5000)
+    parser.add_argument("--song-swaps", type=int, default=2000)
+    parser.add_argument("--zipf", type=float, default=1.1, help="power-law exponent for popularity")
+    parser.add_argument("--seed", type=int, default=278)
+    parser.add_argument("--force", action="store_true", help="overwrite the output database if it exists")
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        if not args.force:
+            parser.error(f"{args.output} already exists (use --force to overwrite)")
+        os.remove(args.output)
+
+    connection = sqlite3.connect(args.output)
+    with connection:
+        copy_schema(args.template, connection)
+        counts = generate(connection, args)
+    connection.close()
+
+    print(f"Generated {args.output}:")
+    for table, count in counts.items():
+        print(f"    {table}: {count}")
+
+
+if __name__ == "__main__":
+    main()
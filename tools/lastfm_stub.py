@@ -0,0 +1,303 @@
+"""
+A local fake Last.fm API for offline benchmarking and load testing.
+
+Serves user.gettopartists, user.gettoptracks, user.gettopalbums,
+user.getrecenttracks, user.getinfo and artist.gettoptags with deterministic
+synthetic data (seeded by user/artist name), plus configurable latency,
+error rates and rate-limit responses.  Point the backend at it with the
+LAST_FM_API_BASE_URL environment variable (or db_query.base_url).
+
+Example:
+    python tools/lastfm_stub.py --port 8765 --latency-ms 80 --error-rate 0.01
+    LAST_FM_API_BASE_URL=http://127.0.0.1:8765/2.0/ python api.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Last.fm error codes (https://www.last.fm/api/errorcodes)
+ERROR_OPERATION_FAILED = 8
+ERROR_INVALID_PARAMETERS = 6
+ERROR_RATE_LIMIT_EXCEEDED = 29
+
+ARTIST_POOL = 2000
+TRACK_POOL = 10000
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server with a listen backlog large enough for many
+    concurrent clients (the socketserver default of 5 drops connections).
+    """
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class StubOptions:
+    """
+    Behaviour of the stub server; may be changed while the server is running.
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 max_requests_per_second=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_requests_per_second = max_requests_per_second
+
+
+class StubStats:
+    """
+    Request counters for the stub server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.by_method = {}
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+
+    def count(self, method):
+        with self.lock:
+            self.requests += 1
+            self.by_method[method] = self.by_method.get(method, 0) + 1
+
+    def over_rate(self, max_requests_per_second):
+        """
+        Returns whether this request exceeds the per-second request budget.
+        """
+        if max_requests_per_second <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_requests = 0
+            self._window_requests += 1
+            return self._window_requests > max_requests_per_second
+
+    def as_dict(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors,
+                    "rate_limited": self.rate_limited, "by_method": dict(self.by_method)}
+
+
+def _rng(*parts):
+    seed = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return random.Random(int(seed[:16], 16))
+
+
+def _ranked_playcounts(rng, limit, scale):
+    base = rng.randint(50, 500) * scale
+    return [max(1, int(base / rank ** 0.8)) for rank in range(1, limit + 1)]
+
+
+def _period_scale(period):
+    return {"7day": 1, "1month": 4, "3month": 12, "6month": 24, "12month": 48}.get(period, 150)
+
+
+def top_artists(user, period, limit):
+    rng = _rng("artists", user, period)
+    artists = rng.sample(range(1, ARTIST_POOL + 1), limit)
+    return {"topartists": {
+        "artist": [
+            {"name": f"Stub Artist {artist}", "mbid": "", "playcount": str(playcount),
+             "url": f"https://www.last.fm/music/Stub+Artist+{artist}",
+             "@attr": {"rank": str(rank)}}
+            for rank, (artist, playcount)
+            in enumerate(zip(artists, _ranked_playcounts(rng, limit, _period_scale(period))), 1)
+        ],
+        "@attr": {"user": user, "page": "1", "perPage": str(limit), "totalPages": "1", "total": str(limit)}
+    }}
+
+
+def top_tracks(user, period, limit):
+    rng = _rng("tracks", user, period)
+    tracks = rng.sample(range(1, TRACK_POOL + 1), limit)
+    return {"toptracks": {
+        "track": [
+            {"name": f"Stub Track {track}", "mbid": "", "playcount": str(playcount),
+             "url": f"https://www.last.fm/music/Stub+Artist+{track % ARTIST_POOL + 1}/_/Stub+Track+{track}",
+             "artist": {"name": f"Stub Artist {track % ARTIST_POOL + 1}", "mbid": ""},
+             "@attr": {"rank": str(rank)}}
+            for rank, (track, playcount)
+            in enumerate(zip(tracks, _ranked_playcounts(rng, limit, _period_scale(period) / 4)), 1)
+        ],
+        "@attr": {"user": user, "page": "1", "perPage": str(limit), "totalPages": "1", "total": str(limit)}
+    }}
+
+
+def top_albums(user, period, limit):
+    rng = _rng("albums", user, period)
+    albums = rng.sample(range(1, TRACK_POOL // 10 + 1), min(limit, TRACK_POOL // 10))
+    return {"topalbums": {
+        "album": [
+            {"name": f"Stub Album {album}", "mbid": "", "playcount": str(playcount),
+             "artist": {"name": f"Stub Artist {album % ARTIST_POOL + 1}", "mbid": ""},
+             "@attr": {"rank": str(rank)}}
+            for rank, (album, playcount)
+            in enumerate(zip(albums, _ranked_playcounts(rng, len(albums), _period_scale(period) / 2)), 1)
+        ],
+        "@attr": {"user": user, "page": "1", "perPage": str(limit), "totalPages": "1", "total": str(limit)}
+    }}
+
+
+def recent_tracks(user, limit, page, from_timestamp=None, to_timestamp=None):
+    """
+    Thirty days of scrobbles, one every 20 minutes at times fixed per user,
+    newest first as Last.fm returns them; from/to bound the times (inclusive).
+    """
+    offset = _rng("recent", user).randint(0, 1199)
+    now = int(time.time())
+    newest = min(now, int(to_timestamp or now))
+    newest -= (newest - offset) % 1200
+    oldest = max(int(from_timestamp or 0), now - 30 * 86400)
+    timestamps = list(range(newest, oldest - 1, -1200))
+    total_pages = max(1, (len(timestamps) + limit - 1) // limit)
+    tracks = []
+    for timestamp in timestamps[(page - 1) * limit:page * limit]:
+        track = _rng("recent", user, timestamp).randint(1, TRACK_POOL)
+        tracks.append({
+            "name": f"Stub Track {track}", "mbid": "",
+            "url": f"https://www.last.fm/music/Stub+Artist+{track % ARTIST_POOL + 1}/_/Stub+Track+{track}",
+            "artist": {"#text": f"Stub Artist {track % ARTIST_POOL + 1}", "mbid": ""},
+            "album": {"#text": f"Stub Album {track % (TRACK_POOL // 10) + 1}", "mbid": ""},
+            "date": {"uts": str(timestamp)}
+        })
+    return {"recenttracks": {
+        "track": tracks,
+        "@attr": {"user": user, "page": str(page), "perPage": str(limit),
+                  "totalPages": str(total_pages), "total": str(len(timestamps))}
+    }}
+
+
+def user_info(user):
+    rng = _rng("info", user)
+    playcount = rng.randint(1000, 100000)
+    return {"user": {
+        "name": user, "url": f"https://www.last.fm/user/{user}", "playcount": str(playcount),
+        "image": [{"size": size, "#text": f"https://lastfm.freetls.fastly.net/i/u/{size}/{user}.png"}
+                  for size in ("small", "medium", "large", "extralarge")]
+    }}
+
+
+def artist_top_tags(artist):
+    rng = _rng("tags", artist)
+    tags = rng.sample(["rock", "pop", "hip-hop", "indie", "electronic", "jazz", "rnb", "folk",
+                       "metal", "country", "soul", "alternative", "punk", "classical"], 5)
+    return {"toptags": {
+        "tag": [{"name": tag, "count": count, "url": f"https://www.last.fm/tag/{tag}"}
+                for tag, count in zip(tags, (100, 60, 35, 20, 10))],
+        "@attr": {"artist": artist}
+    }}
+
+
+def handle(params):
+    """
+    Dispatches a Last.fm API method.
+    Returns:
+        (http status, response dict)
+    """
+    method = params.get("method", "")
+    user = params.get("user", "")
+    period = params.get("period", "overall")
+    limit = max(1, min(1000, int(params.get("limit", "50") or 50)))
+
+    if method == "user.gettopartists":
+        return 200, top_artists(user, period, limit)
+    if method == "user.gettoptracks":
+        return 200, top_tracks(user, period, limit)
+    if method == "user.gettopalbums":
+        return 200, top_albums(user, period, limit)
+    if method == "user.getrecenttracks":
+        return 200, recent_tracks(user, min(limit, 200), int(params.get("page", "1") or 1),
+                                  params.get("from"), params.get("to"))
+    if method == "user.getinfo":
+        return 200, user_info(user)
+    if method == "artist.gettoptags":
+        return 200, artist_top_tags(params.get("artist", ""))
+    return 400, {"error": ERROR_INVALID_PARAMETERS, "message": f"Invalid Method - {method}"}
+
+
+def make_handler(options, stats):
+    """
+    Builds a request handler class bound to the given options and stats.
+    """
+    class LastFmStubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+            stats.count(params.get("method", ""))
+
+            delay = options.latency_ms + random.uniform(-options.jitter_ms, options.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+            if stats.over_rate(options.max_requests_per_second) or random.random() < options.rate_limit_rate:
+                with stats.lock:
+                    stats.rate_limited += 1
+                status, body = 429, {"error": ERROR_RATE_LIMIT_EXCEEDED, "message": "Rate Limit Exceeded"}
+            elif random.random() < options.error_rate:
+                with stats.lock:
+                    stats.errors += 1
+                status, body = 500, {"error": ERROR_OPERATION_FAILED, "message": "Operation failed"}
+            else:
+                status, body = handle(params)
+
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return LastFmStubHandler
+
+
+def start_stub(port=0, options=None):
+    """
+    Starts the stub server on a background thread.
+    Args:
+        port: port to listen on (0 picks a free port)
+        options: StubOptions controlling latency and failures
+    Returns:
+        (server, base url, StubOptions, StubStats); call server.shutdown() to stop
+    """
+    options = options or StubOptions()
+    stats = StubStats()
+    server = StubServer(("127.0.0.1", port), make_handler(options, stats))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/2.0/", options, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests returning 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="fraction of requests returning a rate-limit error")
+    parser.add_argument("--max-rps", type=float, default=0.0,
+                        help="return rate-limit errors above this many requests per second (0 = unlimited)")
+    args = parser.parse_args()
+
+    options = StubOptions(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, args.max_rps)
+    server = StubServer(("127.0.0.1", args.port), make_handler(options, StubStats()))
+    print(f"Last.fm stub listening on http://127.0.0.1:{args.port}/2.0/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
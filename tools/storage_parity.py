@@ -0,0 +1,206 @@
+"""
+Parity tests of the PostgreSQL storage backend against SQLite.
+
+Copies a SQLite database into the PostgreSQL database at DATABASE_URL
+(storage.copy_sqlite_to_postgres, replacing the tables there and dropping
+every other table, so tables created on first use start out missing on both
+backends), then, through
+Flask's test client, issues the same requests on both backends: the read
+endpoints of bench_api.py, then a sequence of writes (broadcasts, likes,
+follows, direct messages, swag) followed by reads of the data they changed.
+Responses must have the same status and body, except for timestamps written
+during the run; lists whose order is not fully determined by the query (ties)
+are compared as sets.
+
+The tests are skipped unless DATABASE_URL is a postgresql:// url.
+
+Example:
+    DATABASE_URL=postgresql://localhost/broadcastr_test python tools/storage_parity.py --db data/synthetic.db
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+import bench_util
+import bench_api
+
+import artist_tags
+import data_version
+import leaderboard
+import refresh_lease
+import refresh_scheduler
+import refresh_state
+import response_cache
+import scrobbles
+import sql_query
+import storage
+
+_TIMESTAMP_RE = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$")
+
+# Overridden by the command line (see main())
+OPTIONS = {"db": sql_query.BROADCASTR_DB, "samples": 5, "seed": 278}
+
+
+def _normalize(value, started):
+    """
+    Replaces timestamps written during the run (the same writes are made on
+    the two backends moments apart) and turns lists into sorted lists of
+    their normalized items, so rows tied on the sort key may come back in
+    either order.
+    """
+    if isinstance(value, dict):
+        return {key: _normalize(item, started) for key, item in value.items()}
+    if isinstance(value, list):
+        return sorted((_normalize(item, started) for item in value),
+                      key=lambda item: json.dumps(item, sort_keys=True))
+    if isinstance(value, str):
+        return "<written during the run>" if _TIMESTAMP_RE.match(value) and value >= started else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _copy_to_postgres(db_path, url):
+    """
+    Copies a SQLite database into PostgreSQL and drops the tables and views it does not have.
+    """
+    source = sqlite3.connect(db_path)
+    try:
+        tables = {row[0].lower() for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        source.close()
+    target = storage.psycopg2.connect(url)
+    try:
+        with target, target.cursor() as cursor:
+            cursor.execute("SELECT table_name, table_type FROM information_schema.tables "
+                           "WHERE table_schema = current_schema()")
+            for name, table_type in cursor.fetchall():
+                if name not in tables:
+                    kind = "VIEW" if table_type == "VIEW" else "TABLE"
+                    cursor.execute(f"DROP {kind} IF EXISTS {storage._quote(name)} CASCADE")
+    finally:
+        target.close()
+    storage.copy_sqlite_to_postgres(db_path, url)
+
+
+def _use_backend(db_path, url):
+    """
+    Points the app at a backend and drops the per-process state read from the
+    other: cached data, memoized data versions, and the flags of the modules
+    creating their tables on first use (so they are created in this backend too).
+    """
+    if url:
+        os.environ["DATABASE_URL"] = url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+    sql_query.BROADCASTR_DB = db_path
+    sql_query._reference = None
+    data_version._table_ready = False
+    data_version._memo.clear()
+    for module in (artist_tags, refresh_lease, refresh_scheduler, refresh_state, scrobbles):
+        module._tables_ready = False
+    response_cache.clear()
+    leaderboard.rebuild()
+
+
+def _requests(db_path, samples, seed):
+    """
+    Builds the (method, path) requests issued on each backend.
+    Returns:
+        (read requests, write requests followed by reads of what they changed)
+    """
+    rng = random.Random(seed)
+    users, artists, artist_ids = bench_api._sample_values(db_path, rng)
+    endpoints = bench_api.build_endpoints(users, artists, artist_ids, rng)
+    reads = [("GET", make_path()) for make_path in endpoints.values() for _ in range(samples)]
+
+    a, b, c = users[:3]
+    writes = [
+        ("POST", f"/api/create-broadcast?user={a}&title=Parity&body=check%25+100&relatedtype=track&relatedid=1"),
+        ("POST", f"/api/user/follow?follower={a}&followee={b}"),
+        ("POST", f"/api/user/follow?follower={a}&followee={b}"),
+        ("POST", f"/api/send-direct-message?user={a}&recipient={c}&message=hello"),
+        ("POST", f"/api/user/add-swag?user={b}&swag=5"),
+        ("GET", f"/api/get-broadcasts?user={a}&limit=5"),
+        ("GET", f"/api/user/following?user={a}"),
+        ("GET", f"/api/user/conversations?user={c}"),
+        ("GET", f"/api/user/profile?user={b}"),
+        ("GET", "/api/leaderboard?board=swag&limit=10"),
+    ]
+    return reads, writes
+
+
+def run(requests_to_issue):
+    """
+    Issues the requests and returns their (status, decoded body).
+    """
+    import api
+    client = api.app.test_client()
+    responses = []
+    for method, path in requests_to_issue:
+        response = client.open(path, method=method)
+        body = response.get_json(silent=True)
+        responses.append((response.status_code, body if body is not None else response.get_data(as_text=True)))
+    return responses
+
+
+@unittest.skipUnless(storage.database_url().startswith(("postgres://", "postgresql://")),
+                     "DATABASE_URL is not a postgresql:// url")
+class StorageParityTest(unittest.TestCase):
+    """
+    Issues the same requests on a SQLite database and its PostgreSQL copy.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pg_url = storage.database_url()
+        work_dir = tempfile.mkdtemp(prefix="broadcastr-parity-")
+        try:
+            db_copy = os.path.join(work_dir, "broadcastr.db")
+            shutil.copyfile(OPTIONS["db"], db_copy)
+            _copy_to_postgres(db_copy, pg_url)
+
+            cls.reads, cls.writes = _requests(db_copy, OPTIONS["samples"], OPTIONS["seed"])
+            cls.started = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            _use_backend(db_copy, "")
+            cls.expected = run(cls.reads + cls.writes)
+            _use_backend(db_copy, pg_url)
+            cls.actual = run(cls.reads + cls.writes)
+        finally:
+            os.environ["DATABASE_URL"] = pg_url
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _assert_same(self, first, requests_to_issue):
+        for offset, (method, path) in enumerate(requests_to_issue, first):
+            (expected_status, expected_body), (actual_status, actual_body) = self.expected[offset], self.actual[offset]
+            with self.subTest(method=method, path=path):
+                self.assertEqual(actual_status, expected_status)
+                self.assertEqual(_normalize(actual_body, self.started), _normalize(expected_body, self.started))
+
+    def test_reads(self):
+        self._assert_same(0, self.reads)
+
+    def test_writes(self):
+        self._assert_same(len(self.reads), self.writes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=OPTIONS["db"], help="SQLite database (a temporary copy is used)")
+    parser.add_argument("--samples", type=int, default=OPTIONS["samples"], help="requests per read endpoint")
+    parser.add_argument("--seed", type=int, default=OPTIONS["seed"])
+    args, unittest_args = parser.parse_known_args()
+    OPTIONS.update(db=args.db, samples=args.samples, seed=args.seed)
+    unittest.main(argv=[sys.argv[0]] + unittest_args)
+
+
+if __name__ == "__main__":
+    main()
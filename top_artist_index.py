@@ -0,0 +1,277 @@
+"""
+This module keeps a read-optimized, columnar snapshot of the TopArtist table
+for the artist pages (listener rankings and playcounts).
+
+The snapshot holds every (UserID, ArtistID, PeriodID, Playcount) row in NumPy
+arrays twice: ordered by artist and by user (each then by period and
+playcount descending), with offset arrays indexed by artist and user id, so
+an artist's or a user's rows are one contiguous slice found without a search.
+It is written to a single file (INDEX_PATH, see mapped_arrays.py) that every
+process memory-maps read-only, so gunicorn workers share one copy through the
+page cache.
+
+Like the leaderboards, the snapshot is built from the database on first use,
+maintained incrementally by the write paths (record_user() replaces one
+user's rows after their data is refreshed) and rebuilt in the background,
+by whichever process notices first, once it is older than
+constants.TOP_ARTIST_INDEX_MAX_AGE_SECONDS (to pick up writes made outside
+those paths).  Readers get None while there is no snapshot of the database in
+use (the file records which database it was built from) and fall back to SQL;
+NumPy is optional, and without it the snapshot is never used.
+"""
+import fcntl
+import threading
+import time
+
+import constants
+import mapped_arrays
+import sql_query
+
+try:
+    import numpy
+except ImportError:     # the index is disabled without NumPy
+    numpy = None
+
+INDEX_PATH = constants.TOP_ARTIST_INDEX_PATH
+
+# Arrays stored in the file: rows ordered by artist, rows ordered by user, and
+# the offsets of each artist's and user's rows (offsets[id]:offsets[id + 1])
+_ARRAYS = {
+    "artist_users": "int32", "artist_periods": "int16", "artist_playcounts": "int32", "artist_offsets": "int64",
+    "user_artists": "int32", "user_periods": "int16", "user_playcounts": "int32", "user_offsets": "int64",
+}
+
+_lock = threading.Lock()
+_snapshot = None
+_rebuilding = False
+
+
+def enabled():
+    """
+    Returns whether the index can be used (NumPy is installed).
+    """
+    return numpy is not None
+
+
+class Snapshot(mapped_arrays.MappedArrays):
+    """
+    A mapped snapshot file, with its arrays (see _ARRAYS) as attributes.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        if set(self.arrays) != set(_ARRAYS):
+            raise ValueError(f"{path} is not a top artist index")
+        self.built = self.metadata["built"]
+        self.source = self.metadata["source"]
+        for name, array in self.arrays.items():
+            setattr(self, name, array)
+
+    def _slice(self, offsets, member_id):
+        if member_id < 0 or member_id + 1 >= len(offsets):
+            return 0, 0
+        return int(offsets[member_id]), int(offsets[member_id + 1])
+
+    def _period_slice(self, periods, start, end, period_id):
+        within = periods[start:end]
+        return (start + int(numpy.searchsorted(within, period_id, "left")),
+                start + int(numpy.searchsorted(within, period_id, "right")))
+
+    def artist_slice(self, artist_id, period_id):
+        """
+        Returns (user ids, playcounts) of an artist's listeners in a period, by playcount descending.
+        """
+        start, end = self._period_slice(self.artist_periods, *self._slice(self.artist_offsets, artist_id), period_id)
+        return self.artist_users[start:end], self.artist_playcounts[start:end]
+
+    def user_slice(self, user_id, period_id):
+        """
+        Returns (artist ids, playcounts) of a user's top artists in a period, by playcount descending.
+        """
+        start, end = self._period_slice(self.user_periods, *self._slice(self.user_offsets, user_id), period_id)
+        return self.user_artists[start:end], self.user_playcounts[start:end]
+
+    def rows(self):
+        """
+        Returns every row as (user ids, artist ids, period ids, playcounts) arrays.
+        """
+        users = numpy.repeat(numpy.arange(len(self.user_offsets) - 1, dtype="int32"), numpy.diff(self.user_offsets))
+        return users, self.user_artists, self.user_periods, self.user_playcounts
+
+
+#################################################
+#   Building                                     #
+#################################################
+
+def _read_rows(user_id=None):
+    """
+    Reads TopArtist rows (of existing users; of one user if given) into arrays.
+    """
+    sql = "SELECT TopArtist.UserID, TopArtist.ArtistID, TopArtist.PeriodID, TopArtist.Playcount " \
+          "FROM TopArtist INNER JOIN User ON TopArtist.UserID = User.UserID"
+    connection = sql_query.get_db_connection(primary=True)
+    try:
+        if user_id is None:
+            rows = connection.execute(sql).fetchall()
+        else:
+            rows = connection.execute(sql + " WHERE TopArtist.UserID = ?", (user_id,)).fetchall()
+    finally:
+        connection.close()
+    table = numpy.array([tuple(row) for row in rows], dtype="int64").reshape(-1, 4)
+    return table[:, 0], table[:, 1], table[:, 2], table[:, 3]
+
+
+def _write(path, users, artists, periods, playcounts, built=None):
+    """
+    Sorts rows both ways and writes them to a new snapshot file, renamed over
+    the previous one so processes that mapped it keep reading it until they
+    reopen.  built is the time of the last full build (now if not given).
+    """
+    def offsets(ids):
+        return numpy.searchsorted(ids, numpy.arange((int(ids.max()) if len(ids) else -1) + 2))
+
+    by_artist = numpy.lexsort((-playcounts, periods, artists))
+    by_user = numpy.lexsort((-playcounts, periods, users))
+    arrays = {
+        "artist_users": users[by_artist], "artist_periods": periods[by_artist],
+        "artist_playcounts": playcounts[by_artist], "artist_offsets": offsets(artists[by_artist]),
+        "user_artists": artists[by_user], "user_periods": periods[by_user],
+        "user_playcounts": playcounts[by_user], "user_offsets": offsets(users[by_user]),
+    }
+    mapped_arrays.write(path, {name: array.astype(_ARRAYS[name]) for name, array in arrays.items()},
+                        {"built": built or time.time(), "source": sql_query.database_identity()})
+
+
+def _locked(function):
+    """
+    Runs function while holding the snapshot file's lock, shared by all processes.
+    """
+    with open(INDEX_PATH + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return function()
+
+
+def rebuild():
+    """
+    Builds the snapshot from the TopArtist table.
+    Returns:
+        True if a snapshot was written (False without NumPy)
+    """
+    if not enabled():
+        return False
+    _locked(lambda: _write(INDEX_PATH, *_read_rows()))
+    return True
+
+
+def record_user(user_id):
+    """
+    Replaces a user's rows in the snapshot with their current TopArtist rows
+    (removing them if the user was deleted); called after writing them.
+    """
+    if not enabled():
+        return
+
+    def update():
+        try:
+            current = Snapshot(INDEX_PATH)
+        except (OSError, ValueError):
+            current = None
+        if current is None or current.source != sql_query.database_identity():
+            _write(INDEX_PATH, *_read_rows())
+            return
+        users, artists, periods, playcounts = current.rows()
+        keep = users != user_id
+        rows = [numpy.concatenate((column[keep].astype("int64"), new_column))
+                for column, new_column in zip((users, artists, periods, playcounts), _read_rows(user_id))]
+        _write(INDEX_PATH, *rows, built=current.built)
+
+    _locked(update)
+
+
+def _rebuild_in_background():
+    global _rebuilding
+    try:
+        rebuild()
+    except Exception as error:  # pylint: disable=broad-except
+        print(f"Top artist index rebuild failed: {error!r}")
+    finally:
+        _rebuilding = False
+
+
+def _maybe_rebuild(snapshot):
+    global _rebuilding
+    if snapshot is not None and time.time() - snapshot.built < constants.TOP_ARTIST_INDEX_MAX_AGE_SECONDS:
+        return
+    with _lock:
+        if _rebuilding:
+            return
+        _rebuilding = True
+    threading.Thread(target=_rebuild_in_background, name="broadcastr-top-artist-index", daemon=True).start()
+
+
+#################################################
+#   Reading                                      #
+#################################################
+
+def snapshot():
+    """
+    Returns the current snapshot, mapping the file again if it was replaced,
+    or None if there is none yet (a build is then started in the background).
+    """
+    global _snapshot
+    if not enabled():
+        return None
+
+    current = _snapshot
+    if current is None or current.replaced():
+        with _lock:
+            current = _snapshot
+            if current is None or current.replaced():
+                try:
+                    current = _snapshot = Snapshot(INDEX_PATH)
+                except (OSError, ValueError):
+                    current = None
+        # _maybe_rebuild takes the lock itself
+        if current is None:
+            _maybe_rebuild(None)
+            return None
+    if current.source != sql_query.database_identity():
+        _maybe_rebuild(None)
+        return None
+    _maybe_rebuild(current)
+    return current
+
+
+def top_listeners(artist_id, period_id, limit):
+    """
+    Returns up to limit (user id, playcount) pairs of an artist's top listeners
+    in a period, or None if there is no snapshot.
+    """
+    current = snapshot()
+    if current is None:
+        return None
+    users, playcounts = current.artist_slice(artist_id, period_id)
+    return list(zip(users[:limit].tolist(), playcounts[:limit].tolist()))
+
+
+def playcount(user_id, artist_id, period_id):
+    """
+    Returns a user's playcount of an artist in a period (0 if the artist is not
+    among their top artists), or None if there is no snapshot.
+    """
+    current = snapshot()
+    if current is None:
+        return None
+    artists, playcounts = current.user_slice(user_id, period_id)
+    matches = numpy.flatnonzero(artists == artist_id)
+    return int(playcounts[matches[0]]) if len(matches) else 0
+
+
+def reset_after_fork():
+    """
+    Resets the rebuild state inherited from the master process; called in a
+    new gunicorn worker (see gunicorn.conf.py).  The mapped snapshot is kept.
+    """
+    global _lock, _rebuilding
+    _lock = threading.Lock()
+    _rebuilding = False